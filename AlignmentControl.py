@@ -0,0 +1,108 @@
+# Python Script containing the nozzle alignment controller used by TAMV.
+#
+# ConvergenceController decides, after each nozzle measurement in the alignment
+# stage, whether to move (and with which gain on the transform-predicted
+# correction), to measure again, or to stop:
+#   - the base gain comes from the camera calibration residual: a transform that
+#     fits its calibration points well gets a gain close to 1
+#   - after every move the correction actually achieved is compared with the one
+#     commanded and the gain adapts to it (a transform that over- or under-
+#     estimates moves is compensated), as long as the error was well above noise
+#   - the nozzle has converged once the error is within tolerance for
+#     stableMeasurements measurements in a row (the nozzle is not moved between
+#     them), the tolerance never being tighter than the detection noise or the
+#     smallest move the G-code can express
+#   - maxMoves bounds the number of moves per tool
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3 and numpy
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.AlignmentControl')
+
+import numpy as np
+
+class ConvergenceController:
+    def __init__(self, tolerance=None, toleranceMM=None, stableMeasurements=2, maxMoves=20, minGain=0.55, maxGain=1.0, resolution=0.001):
+        # tolerance in pixels, or in mm when toleranceMM is given (needs mpp).
+        # Without either, as tight as noise and move resolution allow, at most
+        # half a pixel.
+        self.tolerance = tolerance
+        self.toleranceMM = toleranceMM
+        self.stableMeasurements = stableMeasurements
+        self.maxMoves = maxMoves
+        self.minGain = minGain
+        self.maxGain = maxGain
+        # smallest move sent to the printer (mm)
+        self.resolution = resolution
+        # (tool, moves, converged) of every finished alignment
+        self.history = []
+        self.start()
+
+    def start(self, residual=None, points=11, moveLength=0.5, mpp=None):
+        # New alignment. residual is the least squares residual of the camera
+        # calibration (mean sum of squared errors per axis, mm^2) over points
+        # calibration positions moveLength mm from the centre.
+        self.moves = 0
+        self.stable = 0
+        self.mpp = mpp
+        self.previous = None
+        # transform scale error seen on the moves so far (1: moves as predicted)
+        self.scale = 1.0
+        if residual is not None and points > 0:
+            relative = np.sqrt(max(float(residual), 0) / points) / moveLength
+            self.baseGain = float(np.clip(1 - 2*relative, self.minGain, self.maxGain))
+        else:
+            self.baseGain = self.minGain
+        self.gain = self.baseGain
+
+    def target(self, sigma=0.0):
+        # pixel error accepted as converged
+        floor = 2*sigma
+        if self.mpp is not None and self.mpp > 0:
+            # moves are rounded to the resolution, the noise adds to that
+            floor = float(np.hypot(floor, self.resolution / self.mpp))
+        if self.toleranceMM is not None and self.mpp is not None and self.mpp > 0:
+            return(max(self.toleranceMM / self.mpp, floor))
+        if self.tolerance is not None:
+            return(max(self.tolerance, floor))
+        return(min(floor, 0.5))
+
+    def update(self, error, sigma=0.0):
+        # Next step for the measured pixel error (dx, dy) of the nozzle from the
+        # target: 'move' (by gain times the predicted correction), 'measure'
+        # (again, without moving), 'done' or 'limit' (maxMoves reached)
+        error = np.asarray(error, dtype=float)
+        distance = float(np.hypot(*error))
+        if self.previous is not None:
+            (last, gain) = self.previous
+            lastDistance = float(np.hypot(*last))
+            # adapt only on moves that were clearly above the noise
+            if lastDistance > 4*max(sigma, 0.05):
+                achieved = 1 - float(np.dot(error, last)) / lastDistance**2
+                self.scale = 0.5*self.scale + 0.5*float(np.clip(achieved / gain, 0.5, 2.0))
+                self.gain = float(np.clip(self.baseGain / self.scale, self.minGain, self.maxGain))
+            self.previous = None
+        if distance <= self.target(sigma):
+            self.stable += 1
+            if self.stable >= self.stableMeasurements:
+                return('done')
+            return('measure')
+        self.stable = 0
+        if self.moves >= self.maxMoves:
+            return('limit')
+        self.moves += 1
+        self.previous = (error, self.gain)
+        return('move')
+
+    def finish(self, tool, converged=True):
+        self.history.append((tool, self.moves, converged))
+        if converged:
+            logger.info('T' + str(tool) + ' converged in ' + str(self.moves) + ' moves (gain {0:.2f})'.format(self.gain))
+        else:
+            logger.warning('T' + str(tool) + ' did not converge within ' + str(self.maxMoves) + ' moves')
+        moves = [ m for (t, m, c) in self.history if c ]
+        if len(moves) > 0:
+            logger.debug('Moves to converge so far: mean {0:.1f}, max {1}'.format(np.mean(moves), max(moves)))
@@ -0,0 +1,185 @@
+# Python Script to tune the TAMV nozzle detection parameters offline.
+#
+# Runs every candidate detection parameter set (backend, threshold sweep, minimum
+# area and circularity) over recorded nozzle frames in parallel worker processes
+# and picks the fastest set that finds exactly one nozzle on at least the target
+# fraction of frames, with its centres within a pixel tolerance of the reference.
+# The result is stored with the camera profile in settings.json and used by TAMV
+# the next time it starts:
+#   python AutoTune.py FRAMES [--settings settings.json] [--target 0.95] [--tolerance 1.0] [--workers N]
+# FRAMES is a directory of images or a video file of the nozzle standing still
+# under the camera; the reference centre is the median of the detections. Without
+# FRAMES the tuner runs on synthetic frames with known centres
+# (NozzleDetection.syntheticTruth) to check the tuner itself; that result says
+# nothing about a real camera and is never saved.
+# A missing settings file or camera profile is created (see UserSettings).
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3, OpenCV and numpy
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.AutoTune')
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import cv2
+import numpy as np
+
+import NozzleDetection
+import UserSettings
+
+# default search space
+minAreas = (200, 300, 400, 600, 800, 1000, 1200)
+minCircularities = (0.5, 0.6, 0.7, 0.8, 0.9)
+# SimpleBlobDetector threshold sweeps (th1, th2, thstep), the first is the TAMV default
+thresholdSweeps = ((1, 50, 1), (1, 50, 5), (1, 50, 10))
+
+def candidates(backends=('blob', 'ellipse', 'template', 'hough'), simpleBlob=True):
+    # Parameter sets to evaluate, as dicts of CalibrateNozzles detection settings
+    result = []
+    for backend in backends:
+        for minArea in minAreas:
+            # the Hough backend has no circularity setting
+            for minCircularity in (minCircularities if backend != 'hough' else (0.8,)):
+                result.append({ 'backend': backend, 'binary': True, 'th1': 1, 'th2': 50, 'thstep': 1,
+                    'minArea': minArea, 'minCircularity': minCircularity })
+                if backend == 'blob' and simpleBlob:
+                    for (th1, th2, thstep) in thresholdSweeps:
+                        result.append({ 'backend': backend, 'binary': False, 'th1': th1, 'th2': th2, 'thstep': thstep,
+                            'minArea': minArea, 'minCircularity': minCircularity })
+    return(result)
+
+# frames and their true centres (or None) of the worker process, set once by _initWorker
+_frames = None
+_truths = None
+
+def _initWorker(frames, truths=None):
+    global _frames, _truths
+    _frames = frames
+    _truths = truths
+    # one process per core already, keep OpenCV from starting its own threads
+    cv2.setNumThreads(1)
+
+def centroidError(centres, truths=None):
+    # RMS distance (pixels) of the detected centres (None for a frame without a
+    # single detection) from the true ones, or from their median for a nozzle
+    # that did not move. nan without any detection.
+    if truths is None:
+        found = [ c for c in centres if c is not None ]
+        if len(found) == 0:
+            return(float('nan'))
+        median = tuple(np.median(np.array(found), axis=0))
+        truths = [ median ] * len(centres)
+    errors = [ np.hypot(c[0] - t[0], c[1] - t[1]) for c, t in zip(centres, truths) if c is not None ]
+    if len(errors) == 0:
+        return(float('nan'))
+    return(float(np.sqrt(np.mean(np.square(errors)))))
+
+def evaluate(params, frames=None, targetRate=0, truths=None):
+    # Returns (single detection rate, ms per frame, centroid error) of a parameter
+    # set, see centroidError. Stops as soon as targetRate can no longer be reached;
+    # the rate is then an upper bound below targetRate.
+    if frames is None:
+        frames = _frames
+        truths = _truths
+    backend = NozzleDetection.createBackend(params['backend'], binary=params['binary'], th1=params['th1'],
+        th2=params['th2'], thstep=params['thstep'], minArea=params['minArea'], minCircularity=params['minCircularity'])
+    pipeline = NozzleDetection.PreprocessPipeline()
+    allowedMisses = int((1 - targetRate) * len(frames))
+    single = 0
+    centres = []
+    start = time.perf_counter()
+    for (count, frame) in enumerate(frames, 1):
+        keypoints = backend.find(frame, pipeline)
+        if len(keypoints) == 1:
+            single += 1
+            centres.append(keypoints[0].pt)
+        else:
+            centres.append(None)
+            if count - single > allowedMisses:
+                break
+    elapsed = (time.perf_counter() - start) / count * 1000
+    error = centroidError(centres, truths[:count] if truths is not None else None)
+    return((single + len(frames) - count) / max(1, len(frames)), elapsed, error)
+
+def tune(frames, targetRate=0.95, workers=None, params=None, truths=None, tolerance=1.0):
+    # Evaluate all parameter sets in parallel and return (best, results) where
+    # results is a list of (params, rate, ms, error). Sets with a centroid error
+    # above tolerance pixels are rejected; best is the fastest of the others
+    # reaching targetRate, or the one with the highest rate if none does.
+    if params is None:
+        params = candidates()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    logger.info('Tuning ' + str(len(params)) + ' parameter sets on ' + str(len(frames)) + ' frames with ' + str(workers) + ' workers')
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(frames, truths)) as pool:
+        scores = list(pool.map(partial(evaluate, targetRate=targetRate), params))
+    results = [ (p, rate, ms, error) for p, (rate, ms, error) in zip(params, scores) ]
+    accurate = [ r for r in results if r[3] <= tolerance ]
+    if len(accurate) == 0:
+        logger.warning('No parameter set found the nozzle centre within ' + str(tolerance) + 'px')
+        accurate = [ r for r in results if not np.isnan(r[3]) ] or results
+    passing = [ r for r in accurate if r[1] >= targetRate ]
+    if len(passing) > 0:
+        best = min(passing, key=lambda r: r[2])
+    else:
+        logger.warning('No parameter set reached a single detection rate of ' + str(targetRate))
+        best = max(accurate, key=lambda r: (r[1], -r[3] if not np.isnan(r[3]) else -np.inf, -r[2]))
+    return(best, results)
+
+def saveDetection(params, path='settings.json', camera=0):
+    # Store the detection settings with a camera profile, returns True once saved
+    def update(options):
+        UserSettings.profile(options, 'camera', camera)['detection'] = { key: params[key] for key in detectionKeys }
+    return(UserSettings.updateSettings(update, path))
+
+# settings stored by the tuner, same names as the CalibrateNozzles arguments
+detectionKeys = ('backend', 'binary', 'th1', 'th2', 'thstep', 'minArea', 'minCircularity')
+
+def loadDetection(options, camera=0):
+    # Detection settings stored with a camera profile, or None
+    try:
+        detection = options['camera'][camera]['detection']
+        return({ key: detection[key] for key in detectionKeys if key in detection })
+    except (KeyError, IndexError, TypeError):
+        return(None)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='TAMV nozzle detection auto-tuner')
+    parser.add_argument('frames', nargs='?', default=None, help='directory of nozzle images or a video file (default: synthetic frames, implies --dry-run)')
+    parser.add_argument('--settings', default='settings.json', help='settings file to store the result in')
+    parser.add_argument('--camera', type=int, default=0, help='camera profile index in the settings file')
+    parser.add_argument('--target', type=float, default=0.95, help='required fraction of frames with exactly one nozzle')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='maximum RMS centroid error (pixels) of a parameter set')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--limit', type=int, default=100, help='maximum number of frames to load')
+    parser.add_argument('--dry-run', action='store_true', help='report only, do not write the settings file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    truths = None
+    if args.frames is None:
+        (frames, truths) = NozzleDetection.syntheticTruth(count=min(args.limit, 50))
+        logger.info('Tuning on synthetic frames, the result is not saved')
+        args.dry_run = True
+    else:
+        frames = NozzleDetection.loadFrames(args.frames, limit=args.limit)
+        if len(frames) == 0:
+            raise SystemExit('No frames found in ' + args.frames)
+    start = time.perf_counter()
+    (best, results) = tune(frames, targetRate=args.target, workers=args.workers, truths=truths, tolerance=args.tolerance)
+    logger.info('Evaluated ' + str(len(results)) + ' parameter sets in {0:.1f}s'.format(time.perf_counter() - start))
+    for (params, rate, ms, error) in sorted(results, key=lambda r: (-r[1], r[2]))[:10]:
+        logger.info('  {0:5.1f}% {1:8.2f} ms/frame {2:6.3f}px  {3}'.format(rate*100, ms, error, params))
+    (params, rate, ms, error) = best
+    logger.info('Selected: {0} ({1:.1f}% single detections, {2:.2f} ms/frame, centroid error {3:.3f}px)'.format(params, rate*100, ms, error))
+    if not args.dry_run:
+        if not saveDetection(params, args.settings, args.camera):
+            raise SystemExit('Detection settings not saved, selected: ' + json.dumps(params))
+        logger.info('Saved to camera profile ' + str(args.camera) + ' in ' + args.settings)
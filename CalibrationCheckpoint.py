@@ -0,0 +1,160 @@
+# Python Script containing the calibration run checkpoint used by TAMV.
+#
+# Long multi-cycle runs save their progress after every tool alignment, so a
+# run ended by an error or a disconnect can be resumed where it stopped instead
+# of starting over. The checkpoint file holds:
+#   - the printer, CP, number of tools and cycles the run was started with
+#   - the schedule (ordered (tool, cycle, pickup) steps) and the index of the
+#     next step to run, and the adaptive cycles settings if any (the steps of a
+#     tool that needs no more cycles are dropped from the schedule)
+#   - the camera calibration in use (transform, mpp, residual, information)
+#   - the results of every finished step and the offsets applied to each tool
+#     (X, Y and the Z offset chained from cycle to cycle)
+# The file is replaced atomically, so a crash while writing leaves the previous
+# checkpoint. It is removed once the run completes.
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3 and numpy
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.CalibrationCheckpoint')
+
+import json
+import os
+import time
+
+import numpy as np
+
+defaultPath = 'checkpoint.json'
+
+class Checkpoint:
+    def __init__(self, printer, cp, tools, cycles, steps, strategy='interleaved', redock=2, path=defaultPath, adaptive=None):
+        self.path = path
+        self.printer = printer
+        self.cp = { axis: float(cp[axis]) for axis in 'XYZ' }
+        self.tools = int(tools)
+        self.cycles = int(cycles)
+        self.steps = [ (int(tool), int(cycle), bool(pickup)) for (tool, cycle, pickup) in steps ]
+        self.strategy = strategy
+        self.redock = int(redock)
+        # adaptive cycles ({'target':, 'minCycles':}, see CalibrationSchedule.EarlyStopping),
+        # cycles is their maximum
+        self.adaptive = None if adaptive is None else dict(adaptive)
+        # index of the next step to run
+        self.position = 0
+        self.calibration = None
+        self.results = []
+        # last offsets applied per tool: { tool: {'X':, 'Y':, 'Z':} }
+        self.offsets = {}
+        self.zOffsets = []
+
+    def setCalibration(self, transform, mpp, residual=None, information=None):
+        self.calibration = {
+            'transform': np.asarray(transform, dtype=float).tolist(),
+            'mpp': float(mpp),
+            'residual': None if residual is None else float(residual),
+            'information': None if information is None else np.asarray(information, dtype=float).tolist()
+        }
+
+    def finishStep(self, result, offsets, zOffsets):
+        # A step is done: store its result and the offsets applied, then save
+        (tool, cycle, pickup) = self.steps[self.position]
+        self.results.append(result)
+        self.offsets[tool] = { axis: float(offsets[axis]) for axis in 'XYZ' }
+        self.zOffsets = [ float(z) for z in zOffsets ]
+        self.position += 1
+        self.save()
+
+    def dropTool(self, tool):
+        # Remove the steps of a tool after the current one (saved with the next
+        # step), returns how many were removed
+        later = self.steps[self.position+1:]
+        kept = [ step for step in later if step[0] != int(tool) ]
+        self.steps = self.steps[:self.position+1] + kept
+        return(len(later) - len(kept))
+
+    def skipStep(self):
+        # A step ended without offsets to apply (eg. the alignment did not converge)
+        self.position += 1
+        self.save()
+
+    @property
+    def remaining(self):
+        return(self.steps[self.position:])
+
+    @property
+    def complete(self):
+        return(self.position >= len(self.steps))
+
+    def record(self):
+        return({
+            'version': 1,
+            'time': time.time(),
+            'printer': self.printer,
+            'cp': self.cp,
+            'tools': self.tools,
+            'cycles': self.cycles,
+            'strategy': self.strategy,
+            'redock': self.redock,
+            'adaptive': self.adaptive,
+            'steps': [ list(step) for step in self.steps ],
+            'position': self.position,
+            'calibration': self.calibration,
+            'results': self.results,
+            'offsets': { str(tool): offsets for (tool, offsets) in self.offsets.items() },
+            'zOffsets': self.zOffsets
+        })
+
+    def save(self):
+        # write to a temporary file and replace the checkpoint with it
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'w') as outputfile:
+                json.dump(self.record(), outputfile)
+            os.replace(temporary, self.path)
+        except Exception as e1:
+            logger.warning('Cannot save the calibration checkpoint ' + str(self.path) + ': ' + str(e1))
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except Exception as e1:
+            logger.warning('Cannot remove the calibration checkpoint ' + str(self.path) + ': ' + str(e1))
+
+    @classmethod
+    def fromRecord(cls, record, path=defaultPath):
+        checkpoint = cls(record['printer'], record['cp'], record['tools'], record['cycles'], record['steps'],
+            record.get('strategy', 'interleaved'), record.get('redock', 2), path, record.get('adaptive'))
+        checkpoint.position = int(record['position'])
+        checkpoint.calibration = record.get('calibration')
+        checkpoint.results = list(record.get('results', []))
+        checkpoint.offsets = { int(tool): offsets for (tool, offsets) in record.get('offsets', {}).items() }
+        checkpoint.zOffsets = list(record.get('zOffsets', []))
+        return(checkpoint)
+
+def loadCheckpoint(path=defaultPath):
+    # Checkpoint of an unfinished run, or None
+    try:
+        with open(path, 'r') as inputfile:
+            checkpoint = Checkpoint.fromRecord(json.load(inputfile), path)
+    except FileNotFoundError:
+        return(None)
+    except Exception as e1:
+        logger.warning('Ignoring unreadable calibration checkpoint ' + str(path) + ': ' + str(e1))
+        return(None)
+    if checkpoint.complete:
+        return(None)
+    return(checkpoint)
+
+def resumable(checkpoint, printer, cp, tools, tolerance=0.01):
+    # the checkpoint was made on this printer, with this CP and number of tools
+    if checkpoint is None or checkpoint.printer != printer or checkpoint.tools != int(tools):
+        return(False)
+    try:
+        return(all(abs(checkpoint.cp[axis] - float(cp[axis])) <= tolerance for axis in 'XYZ'))
+    except (KeyError, TypeError, ValueError):
+        return(False)
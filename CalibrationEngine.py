@@ -0,0 +1,767 @@
+# Python Script containing the calibration engine used by TAMV.
+#
+# CalibrationEngine runs a complete tool alignment without any user interface:
+#   - CP capture: the current position, or centred on the endstop seen by the
+#     camera, plus the Z reference of the knob sensor when there is one
+#   - camera calibration (or the check of a stored one) and XY alignment of
+#     each tool on the camera, with the knob Z probe after it
+#   - applying the offsets (G10) and collecting the results, repeating the
+#     tools until adaptive cycles (CalibrationSchedule.EarlyStopping) are done
+# A run is an explicit state machine (see calibrate), every state returns the
+# next one:
+#   toolchange -> travel -> align -> zprobe -> apply -> (next step) .. -> park -> done
+# where align first runs the camera calibration (camera) or the check of a
+# stored one (check) when there is none; a run ends in done, stopped or failed.
+# Capturing the CP (capture) and the knob sensor reference (reference) happen
+# before a run and return to idle.
+# It talks to the printer (DuetWebAPI) and to a frame source (FrameSource)
+# only, and runs in the thread that calls it.
+# Progress is reported through an EngineListener: the default one logs, a user
+# interface subclasses it and passes the calls on as queued signals. Nothing is
+# drawn on frames unless the listener asks for them, and waiting for the printer
+# sleeps between polls: no thread is ever busy-waited on.
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3, OpenCV and numpy
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.CalibrationEngine')
+
+import json
+import time
+
+import numpy as np
+
+import CameraCalibration
+import CalibrationSchedule
+import MotionPlanner
+import NozzleDetection
+from AlignmentControl import ConvergenceController
+from EndstopDetection import EndstopDetector
+
+class CalibrationStopped(Exception):
+    pass
+
+class EngineListener:
+    # Called from the thread running the engine.
+    # frames are only passed to frame() when showFrames is set
+    showFrames = False
+
+    def state(self, state):
+        logger.debug('Calibration state: ' + state)
+
+    def status(self, text):
+        logger.info(text)
+
+    def message(self, text):
+        logger.debug(text)
+
+    def report(self, text):
+        # text for the run report (debug window)
+        pass
+
+    def frame(self, frame, keypoints=None, center=None):
+        # keypoints of the nozzle, or the center of the endstop found in frame
+        pass
+
+    def result(self, result):
+        pass
+
+class CalibrationEngine:
+    # camera calibration move set (0.5mm radius circle over 10 moves)
+    calibrationCoordinates = [ [0,-0.5], [0.294,-0.405], [0.476,-0.155], [0.476,0.155], [0.294,0.405], [0,0.5], [-0.294,0.405], [-0.476,0.155], [-0.476,-0.155], [-0.294,-0.405] ]
+
+    def __init__(self, printer, frames, width, height, detection=None, listener=None, motion=None, costs=None, settingsPath='settings.json', workers=0, poll=0.05):
+        self.printer = printer
+        self.frames = frames
+        self.width = int(width)
+        self.height = int(height)
+        self.listener = listener if listener is not None else EngineListener()
+        self.motion = motion if motion is not None else MotionPlanner.TravelPlanner()
+        self.costs = costs if costs is not None else CalibrationSchedule.RunCosts()
+        self.settingsPath = settingsPath
+        # seconds between printer status polls
+        self.poll = poll
+        # detection settings, see AutoTune.detectionKeys
+        self.detection = { 'backend': 'blob', 'binary': True, 'th1': 1, 'th2': 50, 'thstep': 1, 'minArea': 600, 'minCircularity': 0.8 }
+        if detection is not None:
+            self.detection.update(detection)
+        # detection settings changed from another thread, see setDetection
+        self.pendingDetection = None
+        self.preprocessor = NozzleDetection.PreprocessPipeline(gamma=1.2)
+        self.tracker = NozzleDetection.NozzleTracker()
+        self.endstop = EndstopDetector()
+        self.centroid = NozzleDetection.CentroidEstimator()
+        self.burst = NozzleDetection.CentroidBurst()
+        self.settle = NozzleDetection.SettleDetector()
+        self.settledSeq = None
+        # worker processes for burst detection (DetectionPool), 0 detects in this thread
+        self.workers = workers
+        self.pool = None
+        self.convergence = ConvergenceController()
+        self.refiner = CameraCalibration.TransformRefiner()
+        self.refinedStored = 0
+        # check moves (mm, from the start position) confirming a stored camera
+        # calibration, and the relative move error above which it is redone
+        self.checkCoordinates = [ [0.5,0], [0,0.5] ]
+        self.calibrationTolerance = 0.05
+        # camera calibration
+        self.transform = None
+        self.mpp = None
+        self.residual = None
+        # controlled point, start position of the endstop search
+        self.cp = None
+        self.start = None
+        # knob sensor Z reference (see probeReference)
+        self.hasKnob = False
+        self.probeHeight = 0
+        self.endstopPoint = None
+        self.zOffsets = []
+        self.sigma = 0.5
+        # run state, see calibrate
+        self.state = 'idle'
+        self.checkpoint = None
+        self.apply = True
+        self.step = None
+        self.loaded = None
+        self.aligned = None
+        self.z = None
+        self.stopping = None
+        self.running = True
+        self.createDetector()
+
+    def stop(self):
+        # ends the calibration at the next wait (safe to call from another thread)
+        self.running = False
+
+    def _check(self):
+        if not self.running:
+            raise CalibrationStopped('Calibration stopped')
+
+    def setState(self, state):
+        if state != self.state:
+            self.state = state
+            self.listener.state(state)
+
+    def setDetection(self, detection):
+        # new detection settings, used from the next measurement on (safe to call
+        # from another thread)
+        self.pendingDetection = dict(detection)
+
+    def setWorkers(self, workers):
+        # number of detection processes (0 detects in this thread), a running
+        # pool of another size is closed and started again by the next burst
+        workers = int(workers)
+        if workers != self.workers and self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        self.workers = workers
+
+    def _updateDetection(self):
+        detection = self.pendingDetection
+        if detection is not None:
+            self.pendingDetection = None
+            self.detection.update(detection)
+            self.createDetector()
+
+    def createDetector(self):
+        settings = dict(self.detection)
+        self.detector = NozzleDetection.createBackend(settings.pop('backend'), **settings)
+        factor = NozzleDetection.pyramidFactor(self.width, self.height, self.detection['minArea'])
+        if factor > 1:
+            self.pyramid = NozzleDetection.PyramidDetector(self.preprocessor, self.scaledDetector, self.detection['minArea'], factor=factor)
+        else:
+            self.pyramid = None
+
+    def scaledDetector(self, minArea, maxArea=5000):
+        settings = dict(self.detection, minArea=minArea, maxArea=maxArea)
+        return(NozzleDetection.createBackend(settings.pop('backend'), **settings))
+
+    def normalize(self, xy):
+        return(xy[0] / self.width - 0.5, xy[1] / self.height - 0.5)
+
+    ####
+    # Waiting and measuring
+    ####
+
+    def waitIdle(self):
+        # wait for the printer to finish its moves
+        while self.printer.getStatus() not in 'idle':
+            self._check()
+            if self.listener.showFrames:
+                frame = self.frames.latest()[2]
+                if frame is not None:
+                    self.listener.frame(frame)
+            time.sleep(self.poll)
+
+    def waitSettled(self):
+        # Wait for the image to stop moving after the last motion command and
+        # return the time.monotonic() stamp of the first steady frame, see
+        # NozzleDetection.SettleDetector
+        motion = self.printer.motionSeq
+        if motion == self.settledSeq:
+            return(time.monotonic())
+        self.settle.reset()
+        luma = self.frames.rawLuma
+        (seq, stamp, frame) = self.frames.wait(afterSeq=self.frames.sequence, luma=luma)
+        while frame is not None:
+            self._check()
+            self.settle.add(frame)
+            if self.settle.done:
+                break
+            (seq, stamp, frame) = self.frames.wait(afterSeq=seq, luma=luma)
+        if self.settle.settled:
+            logger.debug('Image settled after ' + str(self.settle.count) + ' frames')
+            settled = stamp - 1e-6
+        else:
+            logger.debug('No settled motion seen in ' + str(self.settle.count) + ' frames, waiting for idle')
+            self.waitIdle()
+            settled = time.monotonic()
+        self.settledSeq = motion
+        return(settled)
+
+    def findNozzle(self):
+        # Detect frames until exactly one nozzle is seen, telling the listener
+        # what is wrong meanwhile. Returns its keypoint.
+        self._updateDetection()
+        fullFrame = self.pyramid.detect if self.pyramid is not None else None
+        complaint = None
+        while True:
+            self._check()
+            (seq, stamp, frame) = self.frames.wait(afterSeq=self.frames.sequence)
+            if frame is None:
+                continue
+            keypoints = self.tracker.detect(frame, self.preprocessor, self.detector, fullFrame=fullFrame)
+            if len(keypoints) == 1:
+                return(keypoints[0])
+            text = 'No circles found.' if len(keypoints) == 0 else 'Too many circles found. Please stop and clean the nozzle.'
+            if text != complaint:
+                self.listener.message(text)
+                complaint = text
+            if self.listener.showFrames:
+                self.listener.frame(frame, keypoints)
+
+    def burstInThread(self, after, count, fullFrame=None):
+        # Grab count frames captured after time after and detect them as one batch.
+        # Returns (timestamp of the last frame, [(frame, keypoints, estimate or None)])
+        luma = self.frames.rawLuma
+        batch = []
+        (seq, stamp, frame) = self.frames.waitAfter(after, luma=luma)
+        while frame is not None:
+            batch.append(frame)
+            if len(batch) >= count:
+                break
+            (seq, stamp, frame) = self.frames.wait(afterSeq=seq, luma=luma)
+        results = []
+        for (frame, keypoints) in zip(batch, self.tracker.detectBatch(batch, self.preprocessor, self.detector, fullFrame=fullFrame)):
+            estimate = self.centroid.estimate(frame, keypoints[0]) if len(keypoints) == 1 else None
+            results.append((frame, keypoints, estimate))
+        return(stamp, results)
+
+    def burstPooled(self, after, count):
+        # Same as burstInThread with detection in the worker processes, see DetectionPool
+        if self.pool is None:
+            from DetectionPool import DetectionPool
+            self.pool = DetectionPool(workers=self.workers, shape=self.frames.shape or (self.height, self.width, 3))
+        elif self.frames.shape is not None:
+            self.pool.resize(self.frames.shape)
+        (height, width) = self.pool.shape[:2]
+        window = self.tracker.roi(width, height)
+        settings = dict(self.detection, gamma=self.preprocessor.gamma, pyramid=self.pyramid.factor if self.pyramid is not None else 1)
+        (seq, stamp) = (0, 0.0)
+        for i in range(count):
+            (slot, view) = self.pool.acquire()
+            if i == 0:
+                (seq, stamp, frame) = self.frames.waitAfter(after, out=view)
+            else:
+                (seq, stamp, frame) = self.frames.wait(afterSeq=seq, out=view)
+            if frame is not view:
+                self.pool.release(slot)
+                break
+            self.pool.submit(slot, seq, window=window, settings=settings)
+        detections = self.pool.collect()
+        hits = [ d for d in detections if d.estimate is not None ]
+        if len(hits) > 0:
+            self.tracker.hit(hits[-1].cvKeypoints()[0])
+        elif len(detections) > 0:
+            self.tracker.miss()
+        results = []
+        for detection in detections:
+            frame = self.pool.frames[detection.slot].copy() if len(hits) > 0 and detection is hits[-1] else None
+            results.append((frame, detection.cvKeypoints(), detection.estimate))
+        return(stamp, results)
+
+    def measureNozzle(self):
+        # Robust nozzle position from a burst of frames once motion has settled.
+        # Returns (xy, machine coordinates, radius); self.sigma is its uncertainty.
+        settled = self.waitSettled()
+        coords = self.printer.getCachedCoords()
+        fullFrame = self.pyramid.detect if self.pyramid is not None else None
+        self.burst.reset()
+        misses = 0
+        last = None
+        while not self.burst.done():
+            self._check()
+            if misses > self.burst.maxFrames:
+                # find the nozzle again, then continue the burst
+                self.findNozzle()
+                misses = 0
+                settled = time.monotonic()
+            if self.workers > 0:
+                (stamp, results) = self.burstPooled(settled, self.burst.needed())
+            else:
+                (stamp, results) = self.burstInThread(settled, self.burst.needed(), fullFrame)
+            if len(results) == 0:
+                continue
+            settled = stamp
+            for (frame, keypoints, estimate) in results:
+                if estimate is not None:
+                    self.burst.add(*estimate)
+                    if frame is not None:
+                        last = (frame, keypoints)
+                else:
+                    misses += 1
+        (u, v, spread, self.sigma) = self.burst.result()
+        logger.debug('Burst of ' + str(self.burst.count) + ' frames: U{0:.3f} V{1:.3f} spread {2:.3f}px'.format(u, v, spread))
+        radius = np.around(last[1][0].size/2) if last is not None else 0
+        self.listener.message('U{0:5.1f} V{1:5.1f} R{2:2.0f}'.format(u, v, radius))
+        if self.listener.showFrames and last is not None:
+            (frame, keypoints) = last
+            if frame.ndim == 2:
+                frame = self.frames.latest()[2]
+            self.listener.frame(frame, keypoints)
+        return(np.array([u, v]), coords, radius)
+
+    def measureEndstop(self):
+        # Endstop centre in the next frame it is found in. Returns (xy, machine coordinates).
+        while True:
+            self._check()
+            (seq, stamp, frame) = self.frames.wait(afterSeq=self.frames.sequence)
+            if frame is None:
+                continue
+            center = self.endstop.detect(frame)
+            if self.listener.showFrames:
+                self.listener.frame(frame, center=center)
+            if center is not None:
+                return(np.array(center, dtype=float), self.printer.getCachedCoords())
+            self.listener.message('Cannot find endstop!')
+
+    ####
+    # Camera calibration
+    ####
+
+    def useCalibration(self, record):
+        # camera calibration from a stored record (transform, mpp, residual and
+        # optionally the fit information)
+        self.transform = np.array(record['transform'], dtype=float)
+        self.mpp = record['mpp']
+        self.residual = record.get('residual')
+        information = record.get('information')
+        if information is None:
+            # stored without the fit information: assume the calibration circle
+            circle = np.array(self.calibrationCoordinates + [[0,0]])
+            cameraPoints = circle @ np.linalg.inv(self.transform[3:5])
+        else:
+            cameraPoints = None
+        self.refiner.start(self.transform, cameraPoints=cameraPoints, information=information)
+        self.refinedStored = 0
+
+    def calibrationPoint(self, tool):
+        # CP the camera calibration is kept for
+        return(self.cp if tool != 'endstop' else self.start)
+
+    def restoreCalibration(self, tool):
+        cp = self.calibrationPoint(tool)
+        if cp is None:
+            return(False)
+        try:
+            with open(self.settingsPath, 'r') as inputfile:
+                options = json.load(inputfile)
+        except Exception:
+            return(False)
+        record = CameraCalibration.findCalibration(options, self.frames.src, self.width, self.height, cp)
+        if record is None:
+            return(False)
+        self.useCalibration(record)
+        logger.info('Restored camera calibration: MPP ' + str(self.mpp) + ', residual ' + str(self.residual))
+        return(True)
+
+    def storeCalibration(self, tool):
+        cp = self.calibrationPoint(tool)
+        if cp is None:
+            return
+        information = self.refiner.information if self.refiner.transform is not None else None
+        CameraCalibration.saveCalibration(CameraCalibration.calibrationRecord(self.frames.src, self.width, self.height,
+            cp, self.transform, self.mpp, self.residual, information=information), self.settingsPath)
+
+    def _relativeMove(self, dx, dy, feed=3000, transform=None, mpp=None):
+        self.printer.gCode('G91 G1 X' + str(dx) + ' Y' + str(dy) + ' F' + str(feed) + ' G90 ')
+        self.tracker.predictMove(dx, dy, transform=transform, mpp=mpp, size=(self.width, self.height))
+
+    def calibrateCamera(self, tool):
+        # Camera calibration on the nozzle (or endstop) over the calibration
+        # circle: least squares transform from normalized camera positions to
+        # machine XY, then the nozzle is moved to the camera centre
+        self.listener.status('Calibrating camera..')
+        self.listener.report('Calibrating camera...\n')
+        started = time.time()
+        space = []
+        camera = []
+        (xy, coords) = self.measure(tool)
+        space.append((coords['X'], coords['Y']))
+        camera.append(tuple(xy))
+        mpp = None
+        for (i, (dx, dy)) in enumerate(self.calibrationCoordinates):
+            self.listener.message('Calibrating rotation.. (' + str((i+1)*10) + '%)')
+            if i > 0:
+                # back to the centre on the way to the next point
+                (px, py) = self.calibrationCoordinates[i-1]
+                self._relativeMove(-px, -py, mpp=mpp)
+            self._relativeMove(dx, dy, mpp=mpp)
+            (moved, coords) = self.measure(tool)
+            if i == 0:
+                mpp = float(np.around(0.5/np.hypot(*(moved - xy)), 4))
+            space.append((coords['X'], coords['Y']))
+            camera.append(tuple(moved))
+        self.mpp = mpp
+        points = [ self.normalize(c) for c in camera ]
+        A = np.array([ CameraCalibration._features(p) for p in points ])
+        fit = np.linalg.lstsq(A, np.array(space), rcond=None)
+        self.transform = fit[0]
+        self.residual = float(fit[1].mean()) if len(fit[1]) > 0 else 0.0
+        self.refiner.start(self.transform, cameraPoints=points)
+        self.refinedStored = 0
+        self.storeCalibration(tool)
+        logger.info('Camera calibration completed in {0:.1f} seconds, MPP {1}'.format(time.time() - started, self.mpp))
+        self.listener.report('Camera calibration completed in {0:.1f} seconds.\nMillimeters per pixel: {1}\n\n'.format(time.time() - started, self.mpp))
+        self.listener.message('Calibrating rotation.. (100%) - MPP = ' + str(self.mpp))
+        # camera centre in machine coordinates
+        center = self.transform.T @ np.array([0, 0, 0, 0, 0, 1])
+        self.printer.gCode('G90 G1 X{0:-1.3f} Y{1:-1.3f} F1000 G90 '.format(center[0], center[1]))
+        self.tracker.expect(self.width/2, self.height/2)
+
+    def checkCalibration(self, tool):
+        # Confirm a restored camera calibration with the check moves, False if it is off
+        self.listener.status('Checking camera calibration..')
+        space = []
+        camera = []
+        previous = [0, 0]
+        for (i, target) in enumerate([[0,0]] + self.checkCoordinates):
+            if i > 0:
+                self._relativeMove(np.around(target[0] - previous[0], 3), np.around(target[1] - previous[1], 3), transform=self.transform)
+                previous = target
+            (xy, coords) = self.measure(tool)
+            space.append((coords['X'], coords['Y']))
+            camera.append(self.normalize(xy))
+        self._relativeMove(-previous[0], -previous[1], transform=self.transform)
+        error = CameraCalibration.checkCalibration(self.transform, camera, space)
+        if error <= self.calibrationTolerance:
+            logger.info('Stored camera calibration confirmed, check moves off by {0:.1f}%'.format(error*100))
+            self.listener.report('Camera calibration restored (MPP ' + str(self.mpp) + ', check moves off by {0:.1f}%).\n'.format(error*100))
+            return(True)
+        logger.info('Stored camera calibration off by {0:.1f}% on the check moves, recalibrating'.format(error*100))
+        self.transform = None
+        return(False)
+
+    def measure(self, tool):
+        self._updateDetection()
+        if tool == 'endstop':
+            return(self.measureEndstop())
+        (xy, coords, radius) = self.measureNozzle()
+        return(xy, coords)
+
+    ####
+    # Alignment
+    ####
+
+    def align(self, tool, rep=0):
+        # Centre a tool (or the endstop) on the camera. Returns (machine
+        # coordinates, moves, converged, seconds).
+        self.tracker.reset()
+        self.detector.reset()
+        if self.pool is not None:
+            self.pool.reset()
+        self.endstop.reset()
+        if self.transform is None and self.restoreCalibration(tool):
+            self.setState('check')
+            self.checkCalibration(tool)
+        if self.transform is None:
+            self.setState('camera')
+            self.calibrateCamera(tool)
+        self.setState('align')
+        if tool != 'endstop':
+            self.listener.report('\nCalibrating T' + str(tool) + ':C' + str(rep) + ': ')
+        else:
+            self.listener.report('\nCP Autocalibration..')
+        started = time.time()
+        self.convergence.start(residual=self.residual, points=len(self.calibrationCoordinates)+1, mpp=self.mpp)
+        last = None
+        while True:
+            if tool != 'endstop':
+                self.listener.message('Tool calibration move #' + str(self.convergence.moves))
+            else:
+                self.listener.message('CP calibration move #' + str(self.convergence.moves))
+            (xy, coords) = self.measure(tool)
+            (cx, cy) = self.normalize(xy)
+            if last is not None:
+                # the last move and the displacement it caused refine the transform
+                (lastCamera, lastX, lastY) = last
+                if self.refiner.update(lastCamera, (cx, cy), (coords['X'] - lastX, coords['Y'] - lastY), sigma=self.sigma*self.mpp):
+                    self.transform = self.refiner.transform.copy()
+                last = None
+            action = self.convergence.update((cx*self.width, cy*self.height), self.sigma)
+            if action == 'move':
+                v = [cx**2, cy**2, cx*cy, cx, cy, 0]
+                offsets = np.around(-1*(self.convergence.gain*self.transform.T @ v), 3)
+                if offsets[0] == 0.0 and offsets[1] == 0.0:
+                    # correction below the move resolution
+                    action = 'done'
+            if action == 'move':
+                last = ((cx, cy), coords['X'], coords['Y'])
+                self.printer.gCode('M564 S1')
+                self.printer.gCode('G91 G1 X{0:-1.3f} Y{1:-1.3f} F1000 G90 '.format(offsets[0], offsets[1]))
+                self.tracker.predictMove(offsets[0], offsets[1], transform=self.transform, size=(self.width, self.height))
+            if action in ('move', 'measure'):
+                continue
+            self.convergence.finish(tool, converged=(action == 'done'))
+            if self.refiner.accepted > self.refinedStored:
+                logger.debug('Camera transform refined with ' + str(self.refiner.accepted) + ' alignment moves (' + str(self.refiner.rejected) + ' rejected)')
+                self.refinedStored = self.refiner.accepted
+                self.storeCalibration(tool)
+            self.listener.report(str(self.convergence.moves) + ' moves.\n')
+            self.printer.gCode('G1 F13200')
+            return(coords, self.convergence.moves, action == 'done', float(np.around(time.time() - started, 1)))
+
+    def captureCP(self, auto=False):
+        # The controlled point: the current position, or with auto the position
+        # centred on the endstop seen from there
+        self.setState('capture')
+        self.listener.status('Capturing CP..')
+        self.printer.gCode('T-1')
+        self.waitIdle()
+        if auto:
+            self.start = self.printer.getCoords()
+            self.listener.message('Searching for endstop..')
+            self.align('endstop')
+            self.waitIdle()
+            self.listener.message('CP auto-calibrated.')
+        self.cp = self.printer.getCoords()
+        logger.info('CP: X{0} Y{1} Z{2}'.format(self.cp['X'], self.cp['Y'], self.cp['Z']))
+        self.setState('idle')
+        return(self.cp)
+
+    def probeReference(self):
+        # Z reference for the knob sensor (probe K3): trigger height of probe K0
+        # and the Z the switch triggers at, probed 40mm right of the CP
+        try:
+            probes = self.printer.getProbes()
+            self.probeHeight = probes[0].triggerHeight
+        except Exception as e1:
+            probes = []
+            self.probeHeight = 0
+            logger.warning('Probe data not returned: ' + str(e1))
+        try:
+            self.hasKnob = not probes[3].triggered
+        except Exception:
+            self.hasKnob = False
+        logger.info('Knob sensor: ' + str(self.hasKnob))
+        if not self.hasKnob:
+            return(False)
+        self.setState('reference')
+        self.motion.travel(self.printer, { 'X': self.cp['X'] + 40 })
+        self.waitIdle()
+        self.printer.gCode('G30 S-1 K0')
+        self.waitIdle()
+        self.endstopPoint = self.printer.getCoords()['Z']
+        logger.info('Omron switch triggered at Z: ' + str(self.endstopPoint))
+        self.motion.travel(self.printer, self.cp)
+        self.waitIdle()
+        self.setState('idle')
+        return(True)
+
+    def probeZ(self, tool):
+        # Z offset of the loaded tool from the knob sensor, None if it cannot be probed
+        try:
+            if self.printer.getProbes()[3].triggered:
+                logger.warning('Knob sensor triggered before probing T' + str(tool) + ', skipping its Z offset')
+                return(None)
+        except Exception as e1:
+            logger.warning('Probe data not returned, skipping the Z offset of T' + str(tool) + ': ' + str(e1))
+            return(None)
+        self.motion.travel(self.printer, { 'X': self.cp['X'] + 40 })
+        self.waitIdle()
+        self.printer.gCode('G30 S-1 K3')
+        self.waitIdle()
+        try:
+            z = self.printer.getCoords()['Z']
+            offset = round((self.zOffsets[tool] - self.probeHeight) - (z - self.endstopPoint), 3)
+            logger.info('T' + str(tool) + ' knob triggered at Z ' + str(z) + ', Z offset ' + str(self.zOffsets[tool]) + ' -> ' + str(offset))
+        except Exception as e1:
+            offset = None
+            logger.warning('Tool coordinates cannot be determined: ' + str(e1))
+        self.motion.travel(self.printer, { 'Z': self.cp['Z'] })
+        self.waitIdle()
+        return(offset)
+
+    ####
+    # Calibration run
+    ####
+
+    def calibrate(self, checkpoint, apply=True):
+        # Run the remaining steps of a run (see CalibrationCheckpoint), saving
+        # progress after every step. Returns the results of the whole run.
+        if checkpoint.calibration is not None and self.transform is None:
+            self.useCalibration(checkpoint.calibration)
+        if len(self.zOffsets) == 0:
+            # the Z offsets kept for tools the probe does not measure
+            try:
+                snapshot = self.printer.getMachineSnapshot()
+                self.zOffsets = [ snapshot.tools[i].offset('Z') for i in range(checkpoint.tools) ]
+            except Exception as e1:
+                logger.error('Cannot read the tool offsets, calibration not started: ' + str(e1))
+                self.listener.status('Error reading tool offsets from the printer.')
+                self.setState('failed')
+                raise
+        if len(checkpoint.zOffsets) == len(self.zOffsets):
+            self.zOffsets = list(checkpoint.zOffsets)
+        if apply:
+            for (tool, offsets) in sorted(checkpoint.offsets.items()):
+                self.printer.gCode('G10 P' + str(tool) + ' X' + str(offsets['X']) + ' Y' + str(offsets['Y']) + ' Z' + str(offsets['Z']))
+        # adaptive cycles: statistics of the steps done so far
+        self.stopping = None
+        if checkpoint.adaptive is not None:
+            self.stopping = CalibrationSchedule.EarlyStopping(maxCycles=checkpoint.cycles, **checkpoint.adaptive)
+            for result in checkpoint.results:
+                self.stopping.add(result['tool'], result['X'], result['Y'])
+        self.checkpoint = checkpoint
+        self.apply = apply
+        self.loaded = None
+        transitions = {
+            'toolchange': self.toolChangeState,
+            'travel': self.travelState,
+            'align': self.alignState,
+            'zprobe': self.zProbeState,
+            'apply': self.applyState,
+            'park': self.parkState
+        }
+        try:
+            state = self.nextStep()
+            while state != 'done':
+                self._check()
+                self.setState(state)
+                state = transitions[state]()
+        except CalibrationStopped:
+            self.setState('stopped')
+            raise
+        except Exception:
+            self.setState('failed')
+            raise
+        self.setState('done')
+        return(checkpoint.results)
+
+    def nextStep(self):
+        # state the next step of the run starts in, park when all are done
+        if self.checkpoint.complete:
+            return('park')
+        self.step = self.checkpoint.remaining[0]
+        (tool, rep, pickup) = self.step
+        self.listener.status('Calibrating T' + str(tool) + ', cycle: ' + str(rep+1) + '/' + str(self.checkpoint.cycles))
+        if tool != self.loaded:
+            return('toolchange')
+        return('travel')
+
+    def toolChangeState(self):
+        tool = self.step[0]
+        started = time.time()
+        self.printer.gCode('T' + str(tool))
+        self.waitIdle()
+        self.costs.measure('toolChange', time.time() - started)
+        self.loaded = tool
+        return('travel')
+
+    def travelState(self):
+        started = time.time()
+        self.motion.travel(self.printer, self.cp)
+        self.waitIdle()
+        self.costs.measure('move', time.time() - started)
+        return('align')
+
+    def alignState(self):
+        (tool, rep, pickup) = self.step
+        self.listener.message('Searching for nozzle..')
+        started = time.time()
+        self.aligned = self.align(tool, rep)
+        self.costs.measure('alignment', time.time() - started)
+        if not self.aligned[2]:
+            # the nozzle is not centred: its position is no offset, leave the
+            # current one and record the step as failed
+            text = 'T' + str(tool) + ', cycle ' + str(rep+1) + ': alignment did not converge after ' + str(self.aligned[1]) + ' moves, offsets not changed.'
+            logger.error(text)
+            self.listener.message(text)
+            self.listener.report(text + '\n')
+            self.checkpoint.skipStep()
+            return(self.nextStep())
+        self.z = self.zOffsets[tool]
+        if self.hasKnob:
+            return('zprobe')
+        return('apply')
+
+    def zProbeState(self):
+        tool = self.step[0]
+        z = self.probeZ(tool)
+        if z is None:
+            # the XY alignment still holds, keep the Z offset the tool had
+            logger.warning('T' + str(tool) + ': Z probe failed, Z offset not updated (' + str(self.z) + ')')
+            self.listener.report('T' + str(tool) + ': Z probe failed, Z offset not updated.\n')
+            return('apply')
+        self.z = z
+        return('apply')
+
+    def applyState(self):
+        (tool, rep, pickup) = self.step
+        (coords, moves, converged, seconds) = self.aligned
+        offsets = self.printer.getG10ToolOffset(tool)
+        x = float(np.around((self.cp['X'] + offsets['X']) - coords['X'], 3))
+        y = float(np.around((self.cp['Y'] + offsets['Y']) - coords['Y'], 3))
+        z = self.z
+        self.zOffsets[tool] = z
+        if self.apply:
+            self.printer.gCode('G10 P' + str(tool) + ' X' + str(x) + ' Y' + str(y) + ' Z' + str(z))
+        result = {
+            'tool': str(tool),
+            'cycle': str(rep),
+            'mpp': str(self.mpp),
+            'X': '{:.3f}'.format(x),
+            'Y': '{:.3f}'.format(y),
+            'Z': str(z),
+            'moves': moves,
+            'converged': converged,
+            'time': seconds
+        }
+        logger.info('T' + str(tool) + ', cycle ' + str(rep+1) + ': G10 P' + str(tool) + ' X' + result['X'] + ' Y' + result['Y'] + ' Z' + result['Z'])
+        self.listener.message('T' + str(tool) + ', cycle ' + str(rep+1) + ' completed in ' + str(seconds) + ' seconds.')
+        self.listener.report('T' + str(tool) + ', cycle ' + str(rep+1) + ' completed in ' + str(seconds) + ' seconds.\n')
+        self.listener.report('G10 P' + str(tool) + ' X' + result['X'] + ' Y' + result['Y'] + '\n')
+        self.listener.result(result)
+        if self.stopping is not None:
+            self.stopping.add(tool, x, y)
+            if self.stopping.done(tool) and self.checkpoint.dropTool(tool) > 0:
+                text = 'T{0} done after {1} cycles, offsets within +/-{2:.4f}mm (95%)'.format(tool, self.stopping.cycles(tool), self.stopping.halfWidth(tool))
+                logger.info(text)
+                self.listener.report(text + '\n')
+        self.checkpoint.setCalibration(self.transform, self.mpp, self.residual, self.refiner.information if self.refiner.transform is not None else None)
+        self.checkpoint.finishStep(result, { 'X': x, 'Y': y, 'Z': z }, self.zOffsets)
+        return(self.nextStep())
+
+    def parkState(self):
+        self.listener.status('Calibration complete: Resetting machine.')
+        self.motion.travel(self.printer, self.cp, tools=['T-1'])
+        self.waitIdle()
+        return('done')
+
+    def release(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
@@ -0,0 +1,220 @@
+# Python Script containing the calibration run scheduler used by TAMV.
+#
+# A calibration run aligns every tool once per cycle. The order the (tool, cycle)
+# alignments are run in decides how often tools are changed, the most expensive
+# operation on a toolchanger:
+#   - interleaved: every tool once per cycle, cycle after cycle (each cycle sees
+#     a fresh pickup of every tool, as needed for repeatability testing)
+#   - grouped: all cycles of a tool after a single pickup
+#   - hybrid: cycles in blocks of redock cycles, every tool picked up once per
+#     block (re-docks every redock cycles)
+# RunCosts keeps the measured durations of a tool change, a move to the CP and
+# an alignment (running averages, stored with the printer profile in
+# settings.json as "costs") and estimates the run time of a schedule from them.
+# With adaptive cycles the number of cycles is a maximum: EarlyStopping keeps
+# the running mean and variance of each tool's offsets and a tool is not aligned
+# again once the confidence intervals of its X and Y offsets are narrow enough,
+# so the run takes as long as the machine's repeatability needs. Stored with the
+# schedule of the printer profile:
+#   "schedule": { "strategy": "grouped", "redock": 2, "adaptive": true, "target": 0.01, "minCycles": 3 }
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.CalibrationSchedule')
+
+import math
+
+import UserSettings
+
+strategies = ('interleaved', 'grouped', 'hybrid')
+
+def schedule(tools, cycles, strategy='interleaved', redock=2):
+    # Ordered list of (tool, cycle, pickup) steps. pickup: the tool has to be
+    # selected before the step (it is not the tool the previous step used, or
+    # a new block starts).
+    tools = int(tools)
+    cycles = int(cycles)
+    if strategy == 'grouped':
+        block = max(cycles, 1)
+    elif strategy == 'hybrid':
+        block = max(int(redock), 1)
+    elif strategy == 'interleaved':
+        block = 1
+    else:
+        raise ValueError('Unknown calibration schedule: ' + str(strategy))
+    steps = []
+    for first in range(0, cycles, block):
+        for tool in range(tools):
+            for cycle in range(first, min(first + block, cycles)):
+                steps.append((tool, cycle, cycle == first))
+    return(steps)
+
+def toolChanges(steps):
+    # tool changes the firmware makes for a schedule: selecting the tool already
+    # loaded does nothing, the final unload counts as one
+    changes = 0
+    loaded = None
+    for (tool, cycle, pickup) in steps:
+        if pickup and tool != loaded:
+            changes += 1
+            loaded = tool
+    if loaded is not None:
+        changes += 1
+    return(changes)
+
+# two-sided 95% quantiles of Student's t distribution, by degrees of freedom
+_t95 = [ 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042 ]
+
+def tQuantile(df):
+    if df < 1:
+        return(math.inf)
+    if df <= len(_t95):
+        return(_t95[df-1])
+    return(1.96)
+
+class RunningStats:
+    # mean and variance of a stream of values (Welford's algorithm)
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = float(value) - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (float(value) - self.mean)
+
+    @property
+    def variance(self):
+        # sample variance
+        if self.count < 2:
+            return(0.0)
+        return(self.m2 / (self.count - 1))
+
+    def halfWidth(self):
+        # half width of the 95% confidence interval of the mean
+        if self.count < 2:
+            return(math.inf)
+        return(tQuantile(self.count - 1) * math.sqrt(self.variance / self.count))
+
+class EarlyStopping:
+    # Adaptive cycles: a tool is done once the 95% confidence intervals of its X
+    # and Y offsets are at most target (mm, half width) after at least minCycles
+    # cycles, or after maxCycles cycles
+    defaults = { 'target': 0.01, 'minCycles': 3 }
+
+    def __init__(self, target=0.01, minCycles=3, maxCycles=10):
+        self.target = float(target)
+        self.maxCycles = max(int(maxCycles), 1)
+        # the spread needs two cycles at least
+        self.minCycles = min(max(int(minCycles), 2), self.maxCycles)
+        # { tool: (X, Y) RunningStats }
+        self.stats = {}
+
+    def add(self, tool, x, y):
+        (statsX, statsY) = self.stats.setdefault(int(tool), (RunningStats(), RunningStats()))
+        statsX.add(x)
+        statsY.add(y)
+
+    def cycles(self, tool):
+        if int(tool) not in self.stats:
+            return(0)
+        return(self.stats[int(tool)][0].count)
+
+    def halfWidth(self, tool):
+        # widest confidence interval half width of X and Y
+        if int(tool) not in self.stats:
+            return(math.inf)
+        return(max(stats.halfWidth() for stats in self.stats[int(tool)]))
+
+    def done(self, tool):
+        cycles = self.cycles(tool)
+        if cycles >= self.maxCycles:
+            return(True)
+        return(cycles >= self.minCycles and self.halfWidth(tool) <= self.target)
+
+    def record(self):
+        return({ 'target': self.target, 'minCycles': self.minCycles })
+
+class RunCosts:
+    # durations in seconds, defaults until measured
+    defaults = { 'toolChange': 20.0, 'move': 2.0, 'alignment': 30.0 }
+
+    def __init__(self, costs=None, smoothing=0.3):
+        # smoothing: weight of a new measurement in the running average
+        self.smoothing = smoothing
+        self.costs = dict(self.defaults)
+        self.measured = { name: 0 for name in self.defaults }
+        if costs is not None:
+            for name in self.defaults:
+                try:
+                    self.costs[name] = float(costs[name])
+                    self.measured[name] = int(costs.get('measured', {}).get(name, 1))
+                except (KeyError, TypeError, ValueError, AttributeError):
+                    pass
+
+    def measure(self, name, seconds):
+        if seconds is None or seconds < 0:
+            return
+        if self.measured[name] == 0:
+            self.costs[name] = float(seconds)
+        else:
+            self.costs[name] += self.smoothing * (float(seconds) - self.costs[name])
+        self.measured[name] += 1
+
+    def estimate(self, steps):
+        # seconds for a schedule
+        return(toolChanges(steps) * self.costs['toolChange'] + len(steps) * (self.costs['move'] + self.costs['alignment']))
+
+    def estimates(self, tools, cycles, redock=2):
+        # {strategy: (tool changes, seconds)}
+        result = {}
+        for strategy in strategies:
+            steps = schedule(tools, cycles, strategy, redock)
+            result[strategy] = (toolChanges(steps), self.estimate(steps))
+        return(result)
+
+    def report(self, tools, cycles, redock=2):
+        # one line per strategy, for the log
+        lines = []
+        for (strategy, (changes, seconds)) in self.estimates(tools, cycles, redock).items():
+            name = strategy if strategy != 'hybrid' else 'hybrid (k=' + str(redock) + ')'
+            lines.append('{0:18s} {1:3d} tool changes, about {2:.0f} min'.format(name, changes, seconds / 60))
+        return(lines)
+
+    def record(self):
+        record = dict(self.costs)
+        record['measured'] = dict(self.measured)
+        return(record)
+
+def loadCosts(options, printer=0):
+    # RunCosts from a printer profile of settings.json (defaults if none stored)
+    try:
+        return(RunCosts(options['printer'][printer].get('costs')))
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return(RunCosts())
+
+def loadAdaptive(options, printer=0):
+    # Adaptive cycles settings ({'target':, 'minCycles':}) of a printer profile
+    # of settings.json, None when adaptive cycles are off
+    try:
+        schedule = options['printer'][printer].get('schedule', {})
+        if not schedule.get('adaptive', False):
+            return(None)
+        return({ name: type(value)(schedule.get(name, value)) for (name, value) in EarlyStopping.defaults.items() })
+    except (KeyError, IndexError, TypeError, AttributeError, ValueError) as e1:
+        logger.warning('Invalid adaptive cycles settings, adaptive cycles are off: ' + str(e1))
+        return(None)
+
+def saveCosts(costs, path='settings.json', printer=0):
+    # Store the measured costs with a printer profile, returns True once saved
+    def update(options):
+        UserSettings.profile(options, 'printer', printer)['costs'] = costs.record()
+    return(UserSettings.updateSettings(update, path))
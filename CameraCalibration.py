@@ -0,0 +1,165 @@
+# Python Script containing the camera calibration store used by TAMV.
+#
+# The camera calibration (transform matrix from normalized pixel coordinates to
+# machine coordinates, millimeters per pixel and the least squares residual) only
+# depends on the camera, its resolution and the height the nozzles are seen at,
+# so it is kept in the camera profile of settings.json between sessions:
+#   "calibrations": [ { "src": 0, "width": 640, "height": 480, "cp": [X, Y, Z],
+#                       "transform": [[..], ..], "mpp": 0.01, "residual": 1e-6, "time": .. }, ... ]
+# A stored calibration is confirmed with a quick check (two moves from the start
+# position) before use; checkCalibration measures how far the moves predicted
+# from the camera are off the moves made.
+#
+# TransformRefiner keeps improving the transform while the nozzles are aligned:
+# every alignment move (machine move made and the camera positions before and
+# after it) is folded in with recursive least squares, starting from the
+# information of the calibration fit. Observations that disagree with the
+# current transform by more than the measurement noise allows are rejected.
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3 and numpy
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.CameraCalibration')
+
+import time
+
+import numpy as np
+
+import UserSettings
+
+# calibrations kept per camera profile, the oldest are dropped
+maxRecords = 8
+
+def _features(point):
+    # quadratic terms of a normalized camera position, as used by the transform matrix
+    (x, y) = point
+    return(np.array([x**2, y**2, x*y, x, y, 1.0]))
+
+def matches(record, src, width, height, cp, xyTolerance=2.0, zTolerance=0.05):
+    # same camera and resolution, CP at the same height and close by
+    try:
+        if str(record['src']) != str(src) or (int(record['width']), int(record['height'])) != (int(width), int(height)):
+            return(False)
+        (x, y, z) = record['cp']
+        return(abs(x - cp['X']) <= xyTolerance and abs(y - cp['Y']) <= xyTolerance and abs(z - cp['Z']) <= zTolerance)
+    except (KeyError, TypeError, ValueError):
+        return(False)
+
+def findCalibration(options, src, width, height, cp, camera=0):
+    # Stored calibration record for a camera, resolution and CP, or None
+    try:
+        records = options['camera'][camera].get('calibrations', [])
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return(None)
+    found = [ record for record in records if matches(record, src, width, height, cp) ]
+    if len(found) == 0:
+        return(None)
+    return(max(found, key=lambda record: record.get('time', 0)))
+
+def calibrationRecord(src, width, height, cp, transform, mpp, residual, information=None):
+    # information: normal matrix of the fit (see TransformRefiner.information)
+    record = {
+        'src': src,
+        'width': int(width),
+        'height': int(height),
+        'cp': [ float(cp['X']), float(cp['Y']), float(cp['Z']) ],
+        'transform': np.asarray(transform, dtype=float).tolist(),
+        'mpp': float(mpp),
+        'residual': float(residual),
+        'time': time.time()
+    }
+    if information is not None:
+        record['information'] = np.asarray(information, dtype=float).tolist()
+    return(record)
+
+def saveCalibration(record, path='settings.json', camera=0):
+    # Store a calibration with a camera profile, replacing the one for the same
+    # camera, resolution and CP. Returns True once saved.
+    def update(options):
+        profile = UserSettings.profile(options, 'camera', camera)
+        cp = dict(zip('XYZ', record['cp']))
+        records = [ r for r in profile.get('calibrations', []) if not matches(r, record['src'], record['width'], record['height'], cp) ]
+        records.append(record)
+        profile['calibrations'] = sorted(records, key=lambda r: r.get('time', 0))[-maxRecords:]
+    return(UserSettings.updateSettings(update, path))
+
+def checkCalibration(transform, cameraPoints, machinePoints):
+    # Relative error of a transform on check moves: cameraPoints are normalized
+    # camera positions and machinePoints the (X, Y) machine positions they were
+    # seen at, the first of each being the start. Returns the largest distance
+    # between a predicted and a made move, as a fraction of the move length.
+    transform = np.asarray(transform, dtype=float)
+    start = transform.T @ _features(cameraPoints[0])
+    worst = 0.0
+    for (camera, machine) in zip(cameraPoints[1:], machinePoints[1:]):
+        made = np.asarray(machine, dtype=float) - np.asarray(machinePoints[0], dtype=float)
+        predicted = transform.T @ _features(camera) - start
+        length = np.hypot(*made)
+        if length <= 0:
+            continue
+        worst = max(worst, float(np.hypot(*(predicted - made)) / length))
+    return(worst)
+
+class TransformRefiner:
+    # Recursive least squares on the transform matrix (6x2, quadratic features
+    # of normalized camera positions to machine XY). A move changes the machine
+    # position by transform.T @ (features(after) - features(before)), which is
+    # linear in the transform, so each move is one RLS step shared by both axes.
+    def __init__(self, gate=4.0, relativeTolerance=0.05, minMove=0.005, forgetting=1.0, moveNoise=2.0):
+        # gate: rejection threshold in standard deviations of the predicted move,
+        # plus relativeTolerance of the move length for model mismatch
+        self.gate = gate
+        self.relativeTolerance = relativeTolerance
+        # moves shorter than this (mm) are mostly rounding and not used
+        self.minMove = minMove
+        self.forgetting = forgetting
+        # noise of a move observation relative to a calibration point (two
+        # positions measured instead of one)
+        self.moveNoise = moveNoise
+        self.transform = None
+        self.accepted = 0
+        self.rejected = 0
+
+    def start(self, transform, cameraPoints=None, information=None, prior=1e-6):
+        # Start from a fitted transform and the normalized camera positions it was
+        # fitted on, or the stored information matrix of that fit
+        self.transform = np.array(transform, dtype=float)
+        if information is None:
+            A = np.array([ _features(p) for p in (cameraPoints if cameraPoints is not None else []) ]).reshape(-1, 6)
+            information = A.T @ A
+        information = np.asarray(information, dtype=float)
+        # the prior keeps directions the fit did not see invertible (and uncertain)
+        self.P = np.linalg.inv(information + prior * np.eye(6))
+        self.accepted = 0
+        self.rejected = 0
+
+    @property
+    def information(self):
+        return(np.linalg.inv(self.P))
+
+    def update(self, before, after, move, sigma=0.0, resolution=0.001):
+        # Fold in one move: before/after are normalized camera positions, move the
+        # machine move made (mm). sigma is the measurement noise of one position
+        # (mm). Returns True if the move was used.
+        if self.transform is None:
+            return(False)
+        move = np.asarray(move, dtype=float)
+        length = float(np.hypot(*move))
+        if length < self.minMove:
+            return(False)
+        phi = _features(after) - _features(before)
+        error = move - self.transform.T @ phi
+        s = self.moveNoise + float(phi @ self.P @ phi)
+        noise = float(np.hypot(sigma, resolution))
+        if float(np.hypot(*error)) > self.gate * noise * np.sqrt(s) + self.relativeTolerance * length:
+            self.rejected += 1
+            logger.debug('Rejected transform update: move {0} off by {1}'.format(move, error))
+            return(False)
+        k = (self.P @ phi) / s
+        self.transform += np.outer(k, error)
+        self.P = (self.P - np.outer(k, phi @ self.P)) / self.forgetting
+        self.accepted += 1
+        return(True)
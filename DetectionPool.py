@@ -0,0 +1,291 @@
+# Python Script containing the multi-process nozzle detection used by TAMV.
+#
+# A DetectionPool runs nozzle detection in worker processes so that image
+# processing does not compete for the GIL with the Qt main thread. Frames are
+# exchanged through a ring of slots in one multiprocessing.shared_memory block:
+# the producer writes a frame straight into a slot (eg. FrameGrabber.wait(out=view))
+# and the workers map the same memory, so a frame is never pickled or copied
+# between processes. Tasks and results are small records (slot, window, detection
+# settings / keypoints and sub-pixel estimate).
+#
+#   pool = DetectionPool(workers=2, shape=(480,640,3))
+#   (slot, view) = pool.acquire()
+#   frames.wait(afterSeq=seq, out=view)
+#   pool.submit(slot, seq, window=tracker.roi(640,480), settings=detectionSettings)
+#   for detection in pool.collect(): ...
+#   pool.reset()    # next nozzle: workers forget what they learned (eg. templates)
+#   pool.close()
+#
+# Workers are started with the spawn method, so the Qt process is never forked;
+# the worker code itself only uses NozzleDetection, OpenCV and numpy.
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3 (3.8+ for shared_memory), OpenCV and numpy
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.DetectionPool')
+
+import multiprocessing as mp
+import os
+import queue
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+class DetectionError(Exception):
+    # a worker failed on a frame, or the workers did not respond
+    pass
+
+class Detection:
+    # Result record of one frame: keypoints as (x, y, size) tuples in frame
+    # coordinates and the sub-pixel estimate (x, y, sigma) of a single detection.
+    # error is the message of the exception a worker raised on the frame.
+    __slots__ = ('slot', 'seq', 'window', 'keypoints', 'estimate', 'elapsed', 'error')
+
+    def __init__(self, slot, seq, window, keypoints, estimate, elapsed, error=None):
+        self.slot = slot
+        self.seq = seq
+        self.window = window
+        self.keypoints = keypoints
+        self.estimate = estimate
+        self.elapsed = elapsed
+        self.error = error
+
+    def __getstate__(self):
+        return(tuple(getattr(self, name) for name in self.__slots__))
+
+    def __setstate__(self, state):
+        for (name, value) in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def cvKeypoints(self):
+        return([ cv2.KeyPoint(x, y, size) for (x, y, size) in self.keypoints ])
+
+def _detector(settings):
+    # detection objects of a worker for a settings dict (see AutoTune.detectionKeys,
+    # plus gamma and pyramid factor)
+    import NozzleDetection
+    def backend(minArea, maxArea=5000):
+        return(NozzleDetection.createBackend(settings.get('backend', 'blob'), binary=settings.get('binary', True),
+            th1=settings.get('th1', 1), th2=settings.get('th2', 50), thstep=settings.get('thstep', 1),
+            minArea=minArea, maxArea=maxArea, minCircularity=settings.get('minCircularity', 0.8)))
+    minArea = settings.get('minArea', 600)
+    pipeline = NozzleDetection.PreprocessPipeline(gamma=settings.get('gamma', 1.2))
+    detector = backend(minArea)
+    factor = settings.get('pyramid', 1)
+    pyramid = NozzleDetection.PyramidDetector(pipeline, backend, minArea, factor=factor) if factor > 1 else None
+    return(pipeline, detector, pyramid, NozzleDetection.CentroidEstimator())
+
+def _worker(tasks, results):
+    # Worker process main loop. Tasks are (name, shape, slot, seq, window, settings,
+    # generation) tuples, None stops the worker. The detector is reset whenever the
+    # generation changes (see DetectionPool.reset).
+    import time
+    # the pool already uses one process per core
+    cv2.setNumThreads(1)
+    memory = None
+    frames = None
+    current = None
+    detection = None
+    generation = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        (name, shape, slot, seq, window, settings, taskGeneration) = task
+        start = time.perf_counter()
+        try:
+            if memory is None or memory.name != name:
+                if memory is not None:
+                    frames = None
+                    memory.close()
+                    memory = None
+                memory = shared_memory.SharedMemory(name=name)
+                frames = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+            if settings != current:
+                current = None
+                detection = _detector(settings)
+                current = settings
+            (pipeline, detector, pyramid, estimator) = detection
+            if taskGeneration != generation:
+                detector.reset()
+                if pyramid is not None:
+                    pyramid.fineDetector.reset()
+                    pyramid.coarseDetector.reset()
+                generation = taskGeneration
+            frame = frames[slot]
+            if window is None:
+                keypoints = pyramid.detect(frame) if pyramid is not None else detector.find(frame, pipeline)
+            else:
+                (x, y, w, h) = window
+                keypoints = [ cv2.KeyPoint(k.pt[0] + x, k.pt[1] + y, k.size) for k in detector.find(frame[y:y+h, x:x+w], pipeline) ]
+            estimate = estimator.estimate(frame, keypoints[0]) if len(keypoints) == 1 else None
+        except Exception as e:
+            # every task gets a result, so the parent frees the slot
+            results.put(Detection(slot, seq, window, [], None, time.perf_counter() - start, error=type(e).__name__ + ': ' + str(e)))
+            continue
+        results.put(Detection(slot, seq, window, [ (k.pt[0], k.pt[1], k.size) for k in keypoints ],
+            estimate, time.perf_counter() - start))
+    frames = None
+    if memory is not None:
+        memory.close()
+
+class DetectionPool:
+    # Ring of shared memory frame slots and the worker processes reading them.
+    # Slots are handed out by acquire() and become free again when the result
+    # for them has been collected.
+    def __init__(self, workers=None, shape=(480,640,3), slots=None):
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 1) - 1)
+        self.workers = int(workers)
+        self.slots = int(slots) if slots is not None else 2 * self.workers + 2
+        self._context = mp.get_context('spawn')
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        self._memory = None
+        # tasks of another generation reset the worker's detector first
+        self.generation = 0
+        self._allocate(tuple(shape))
+        self._processes = []
+        for i in range(self.workers):
+            process = self._context.Process(target=_worker, args=(self._tasks, self._results), name='TAMV-Detection-' + str(i), daemon=True)
+            process.start()
+            self._processes.append(process)
+        logger.debug('Started ' + str(self.workers) + ' detection workers with ' + str(self.slots) + ' slots')
+
+    def _allocate(self, shape):
+        if self._memory is not None:
+            self.frames = None
+            self._memory.close()
+            self._memory.unlink()
+        self.shape = shape
+        self._memory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * self.slots)
+        self.frames = np.ndarray((self.slots,) + shape, dtype=np.uint8, buffer=self._memory.buf)
+        self._free = list(range(self.slots))
+        self._pending = {}
+        # results collected by acquire() and not handed out yet
+        self._finished = []
+
+    def resize(self, shape):
+        # new frame size (eg. camera resolution change): waits for outstanding work,
+        # its results are dropped
+        if tuple(shape) != self.shape:
+            self.collect()
+            self._allocate(tuple(shape))
+
+    def acquire(self, timeout=10):
+        # Returns (slot, view) of a free slot; view is the slot's frame array to
+        # write the frame into. Collects finished work if no slot is free, raises
+        # DetectionError when none is freed within timeout seconds.
+        if len(self._free) == 0:
+            self._finished.extend(self._receive(1, timeout))
+        if len(self._free) == 0:
+            raise DetectionError('No frame slot freed within ' + str(timeout) + 's, ' + str(len(self._pending)) + ' detections outstanding')
+        slot = self._free.pop(0)
+        return(slot, self.frames[slot])
+
+    def release(self, slot):
+        # give back an acquired slot that was not submitted
+        self._free.append(slot)
+
+    def submit(self, slot, seq=0, window=None, settings=None):
+        # Queue detection of the frame in slot, in window (x, y, w, h) or the full frame
+        self._pending[slot] = seq
+        self._tasks.put((self._memory.name, (self.slots,) + self.shape, slot, seq, window, settings if settings is not None else {}, self.generation))
+
+    def reset(self):
+        # Detection of another nozzle starts: every worker resets its detector
+        # (see DetectorBackend.reset) before its next task
+        self.generation += 1
+
+    def collect(self, count=None, timeout=10):
+        # Wait for count (default: all outstanding) results and free their slots.
+        # Returns Detection records ordered by sequence number, raises
+        # DetectionError when a worker failed on one of the frames.
+        # Results already received are kept for the next collect.
+        done = self._finished + self._receive(count, timeout)
+        self._finished = []
+        return(sorted(done, key=lambda d: d.seq))
+
+    def _receive(self, count=None, timeout=10):
+        done = []
+        if count is None:
+            count = len(self._pending)
+        while count > 0 and len(self._pending) > 0:
+            try:
+                detection = self._results.get(timeout=timeout)
+            except queue.Empty:
+                logger.error('Detection workers did not respond within ' + str(timeout) + 's')
+                break
+            self._pending.pop(detection.slot, None)
+            self._free.append(detection.slot)
+            if detection.error is not None:
+                self._finished.extend(done)
+                raise DetectionError('Detection of frame ' + str(detection.seq) + ' failed: ' + detection.error)
+            done.append(detection)
+            count -= 1
+        return(done)
+
+    @property
+    def pending(self):
+        return(len(self._pending))
+
+    def close(self):
+        for process in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+        self.frames = None
+        if self._memory is not None:
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+def benchmark(workers=None, count=40, width=640, height=480):
+    # Burst detection throughput in process (one thread) against the pool
+    import time
+    import NozzleDetection
+    frames = NozzleDetection.syntheticFrames(width, height, count=count, radius=16)
+    settings = { 'backend': 'blob', 'minArea': 600 }
+    (pipeline, detector, pyramid, estimator) = _detector(settings)
+    start = time.perf_counter()
+    for frame in frames:
+        keypoints = detector.find(frame, pipeline)
+        if len(keypoints) == 1:
+            estimator.estimate(frame, keypoints[0])
+    single = (time.perf_counter() - start) / count * 1000
+    pool = DetectionPool(workers=workers, shape=frames[0].shape)
+    try:
+        # first task per worker builds its detector
+        for i in range(pool.workers):
+            (slot, view) = pool.acquire()
+            view[:] = frames[0]
+            pool.submit(slot, -1, settings=settings)
+        pool.collect()
+        start = time.perf_counter()
+        for (seq, frame) in enumerate(frames):
+            (slot, view) = pool.acquire()
+            np.copyto(view, frame)
+            pool.submit(slot, seq, settings=settings)
+        results = pool.collect()
+        pooled = (time.perf_counter() - start) / count * 1000
+    finally:
+        pool.close()
+    print('Detection of ' + str(count) + ' frames of ' + str(width) + 'x' + str(height) + ':')
+    print('  in process:             {0:8.2f} ms/frame'.format(single))
+    print('  pool of {0:2d} workers:    {1:8.2f} ms/frame, {2} results'.format(pool.workers, pooled, len(results)))
+    return(single, pooled)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='TAMV multi-process detection benchmark')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: cores - 1)')
+    parser.add_argument('--frames', type=int, default=40, help='frames per run')
+    args = parser.parse_args()
+    benchmark(workers=args.workers, count=args.frames)
@@ -18,6 +18,97 @@
 import logging
 logger = logging.getLogger('TAMV.DuetWebAPI')
 
+import re
+from array import array
+
+# G-code that moves the machine or changes what the user coordinates mean: moves,
+# homing/probing, offsets and workplaces, set position, macros and tool changes.
+# G0/G1 only count with an axis word before the next command (G1 F6000 only sets
+# the feed rate).
+_motionCode = re.compile(r'(?<![A-Z0-9.])(G0*[01](?![0-9.])(?=[^GMT;]*(?<![A-Z])[XYZUVWABC]\s*[-+.0-9])|(G0*[23]|G10|G2[89]|G3[0-2]|G5[3-9]|G92|M98|M121|T-?[0-9]+)(?![0-9.]))', re.IGNORECASE)
+
+####
+# Object model records. These are built once per model fetch so callers can read
+# positions, offsets and probe values without walking the raw JSON every time.
+####
+class AxisState:
+    __slots__ = ('letter', 'index', 'userPosition', 'machinePosition', 'homed')
+
+    def __init__(self, letter, index, userPosition=0.0, machinePosition=0.0, homed=False):
+        self.letter = letter
+        self.index = index
+        self.userPosition = userPosition
+        self.machinePosition = machinePosition
+        self.homed = homed
+
+    def __repr__(self):
+        return('AxisState(' + self.letter + ': ' + str(self.userPosition) + ')')
+
+class ToolState:
+    __slots__ = ('number', 'name', 'state', 'offsets', '_axisIndex')
+
+    def __init__(self, number, offsets, axisIndex, name='', state=''):
+        self.number = number
+        self.name = name
+        self.state = state
+        # offsets are stored in axis order, use offset('X') to look one up by letter
+        self.offsets = array('d', offsets)
+        self._axisIndex = axisIndex
+
+    def offset(self, letter):
+        return(self.offsets[self._axisIndex[letter]])
+
+    def offsetDict(self):
+        # legacy {'X':..,'Y':..} format returned by getG10ToolOffset
+        return({ letter: self.offsets[i] for letter, i in self._axisIndex.items() if i < len(self.offsets) })
+
+    def __repr__(self):
+        return('ToolState(T' + str(self.number) + ': ' + str(self.offsetDict()) + ')')
+
+class ProbeState:
+    __slots__ = ('index', 'type', 'value', 'threshold', 'triggerHeight')
+
+    def __init__(self, index, type=0, value=(), threshold=0, triggerHeight=0.0):
+        self.index = index
+        self.type = type
+        self.value = array('l', [int(v) for v in value])
+        self.threshold = threshold
+        self.triggerHeight = triggerHeight
+
+    @property
+    def triggered(self):
+        return(len(self.value) > 0 and self.value[0] != 0)
+
+    def __repr__(self):
+        return('ProbeState(K' + str(self.index) + ': ' + str(list(self.value)) + ')')
+
+class MachineSnapshot:
+    __slots__ = ('status', 'currentTool', 'axisNames', 'userPosition', 'machinePosition', 'tools', 'probes', '_axisIndex')
+
+    def __init__(self, axisNames, axisIndex, userPosition, machinePosition, tools=(), probes=(), status='', currentTool=-1):
+        self.status = status
+        self.currentTool = currentTool
+        self.axisNames = axisNames
+        self._axisIndex = axisIndex
+        self.userPosition = array('d', userPosition)
+        self.machinePosition = array('d', machinePosition)
+        self.tools = list(tools)
+        self.probes = list(probes)
+
+    @property
+    def axes(self):
+        return([ AxisState(letter, i, self.userPosition[i], self.machinePosition[i]) for i, letter in enumerate(self.axisNames) ])
+
+    def position(self, letter):
+        return(self.userPosition[self._axisIndex[letter]])
+
+    def coords(self):
+        # legacy {'X':..,'Y':..} format returned by getCoords
+        return(dict(zip(self.axisNames, self.userPosition)))
+
+    def coordsAbs(self):
+        return(dict(zip(self.axisNames, self.machinePosition)))
+
 class DuetWebAPI:
     import requests
     import json
@@ -28,6 +119,13 @@ class DuetWebAPI:
     pt = 0
     _base_url = ''
     _rrf2 = False
+    # axis letter cache, filled on first model fetch for this connection
+    _axisNames = None
+    _axisIndex = None
+    # incremented by every motion command sent through this connection
+    _motionSeq = 0
+    # (motion sequence number, coordinates) of the last position read
+    _positionCache = None
 
     def __init__(self,base_url):
         logger.debug('Starting DuetWebAPI..')
@@ -83,6 +181,66 @@ class DuetWebAPI:
     def baseURL(self):
         return(self._base_url)
 
+    def _cacheAxisNames(self, axisNames):
+        # axis letters rarely change while connected, so the letter->index map is
+        # only rebuilt when they do (eg. an axis remapped with M584)
+        axisNames = tuple(axisNames)
+        if self._axisNames != axisNames:
+            self._axisNames = axisNames
+            self._axisIndex = { letter: i for i, letter in enumerate(self._axisNames) }
+        return(self._axisNames)
+
+    def _axisNamesRRF3(self, axes):
+        return(self._cacheAxisNames([ axis['letter'] for axis in axes ]))
+
+    def _probeStates(self, probes):
+        # keep empty slots so list index matches the K number of the probe
+        if not isinstance(probes, list):
+            return([])
+        return([ None if p is None else ProbeState(i, type=p.get('type',0), value=p.get('value',()), threshold=p.get('threshold',0), triggerHeight=p.get('triggerHeight',0.0)) for i, p in enumerate(probes) ])
+
+    def _snapshotRRF2(self, j):
+        names = self._cacheAxisNames(j['axisNames'])
+        tools = [ ToolState(t.get('number',i), t['offsets'], self._axisIndex, name=t.get('name','')) for i, t in enumerate(j.get('tools',[])) ]
+        s = j['status']
+        status = { 'I': 'idle', 'P': 'processing', 'S': 'paused', 'B': 'canceling' }.get(s, s)
+        return(MachineSnapshot(names, self._axisIndex, j['coords']['xyz'], j['coords']['machine'], tools=tools, status=status, currentTool=j.get('currentTool',-1)))
+
+    def _snapshotRRF3(self, j):
+        ja = j['move']['axes']
+        names = self._axisNamesRRF3(ja)
+        tools = [ None if t is None else ToolState(t['number'], t['offsets'], self._axisIndex, name=t.get('name',''), state=t.get('state','')) for t in j['tools'] ]
+        probes = self._probeStates(j['sensors']['probes'])
+        return(MachineSnapshot(names, self._axisIndex, [a['userPosition'] for a in ja], [a['machinePosition'] for a in ja], tools=tools, probes=probes, status=str(j['state']['status']).lower(), currentTool=j['state']['currentTool']))
+
+    def getMachineSnapshot(self):
+        # Fetch the object model once and return it as a MachineSnapshot record.
+        # Errors (printer not responding, unexpected reply) are raised to the caller,
+        # which cannot go on without the tool offsets.
+        try:
+            if (self.pt == 2):
+                URL=(f'{self._base_url}'+'/rr_status?type=2')
+                r = self.requests.get(URL,timeout=2)
+                j = self.json.loads(r.text)
+                snapshot = self._snapshotRRF2(j)
+                if not self._rrf2:
+                    # RRF3 on a Duet Ethernet/Wifi board exposes probes through rr_model
+                    snapshot.probes = self.getProbes()
+                return(snapshot)
+            if (self.pt == 3):
+                URL=(f'{self._base_url}'+'/machine/status')
+                r = self.requests.get(URL,timeout=2)
+                j = self.json.loads(r.text)
+                if 'result' in j: j = j['result']
+                return(self._snapshotRRF3(j))
+        except Exception as e1:
+            logger.error('Unhandled exception in getMachineSnapshot: ' + str(e1))
+            raise
+        raise ValueError('Unsupported printer type: ' + str(self.pt))
+
+    def getProbes(self):
+        return(self._probeStates(self.getModelQuery(['sensors','probes'])))
+
     def getCoords(self):
         import time
         try:
@@ -121,11 +279,7 @@ class DuetWebAPI:
                 logger.debug('XX - calling endpoint again')
                 reply = self.requests.get(replyURL,timeout=2)
                 logger.debug('XX - coordinate response received')
-                jc=j['coords']['xyz']
-                an=j['axisNames']
-                ret=self.json.loads('{}')
-                for i in range(0,len(jc)):
-                    ret[ an[i] ] = jc[i]
+                ret=dict(zip(self._cacheAxisNames(j['axisNames']), j['coords']['xyz']))
                 logger.debug('XX - returning coordinates')
                 return(ret)
             if (self.pt == 3):
@@ -140,24 +294,45 @@ class DuetWebAPI:
                 j = self.json.loads(r.text)
                 if 'result' in j: j = j['result']
                 ja=j['move']['axes']
-                ret=self.json.loads('{}')
-                for i in range(0,len(ja)):
-                    ret[ ja[i]['letter'] ] = ja[i]['userPosition']
+                ret=dict(zip(self._axisNamesRRF3(ja), [a['userPosition'] for a in ja]))
                 logger.debug('XX - returning from machine/status call')
                 return(ret)
         except Exception as e1:
-            logger.error('Exception occurred in getCoords: ' + e1 )
+            logger.error('Exception occurred in getCoords: ' + str(e1) )
         
+    @property
+    def motionSeq(self):
+        return(self._motionSeq)
+
+    def invalidatePosition(self):
+        # the machine moved without going through gCode (eg. jogged from the web interface)
+        self._motionSeq += 1
+
+    def _countMotion(self, command):
+        if _motionCode.search(str(command)) is not None:
+            self._motionSeq += 1
+
+    def getCachedCoords(self):
+        # Position for frames taken while the machine stands still: the first read
+        # after a motion command (which waits for idle) is reused until the next
+        # motion command, so frames of the same position cost no requests.
+        seq = self._motionSeq
+        cache = self._positionCache
+        if cache is not None and cache[0] == seq:
+            return(dict(cache[1]))
+        coords = self.getCoords()
+        if coords is not None:
+            # a move sent while reading leaves seq behind, the next call reads again
+            self._positionCache = (seq, coords)
+            return(dict(coords))
+        return(coords)
+
     def getCoordsAbs(self):
         if (self.pt == 2):
             URL=(f'{self._base_url}'+'/rr_status?type=2')
             r = self.requests.get(URL,timeout=2)
             j = self.json.loads(r.text)
-            jc=j['coords']['machine']
-            an=j['axisNames']
-            ret=self.json.loads('{}')
-            for i in range(0,len(jc)):
-                ret[ an[i] ] = jc[i]
+            ret=dict(zip(self._cacheAxisNames(j['axisNames']), j['coords']['machine']))
             return(ret)
         if (self.pt == 3):
             URL=(f'{self._base_url}'+'/machine/status')
@@ -165,9 +340,7 @@ class DuetWebAPI:
             j = self.json.loads(r.text)
             if 'result' in j: j = j['result']
             ja=j['move']['axes']
-            ret=self.json.loads('{}')
-            for i in range(0,len(ja)):
-                ret[ ja[i]['letter'] ] = ja[i]['machinePosition']
+            ret=dict(zip(self._axisNamesRRF3(ja), [a['machinePosition'] for a in ja]))
             return(ret)
 
     def getLayer(self):
@@ -256,24 +429,14 @@ class DuetWebAPI:
             r = self.requests.get(URL,timeout=2)
             j = self.json.loads(r.text)
             if 'result' in j: j = j['result']
-            ja=j['move']['axes']
-            jt=j['tools']
-            ret=self.json.loads('{}')
-            to = jt[tool]['offsets']
-            for i in range(0,len(to)):
-                ret[ ja[i]['letter'] ] = to[i]
+            ret=dict(zip(self._axisNamesRRF3(j['move']['axes']), j['tools'][tool]['offsets']))
             logger.debug('Tool offset for T' + str(tool) +': ' + str(ret))
             return(ret)
         if (self.pt == 2):
             URL=(f'{self._base_url}'+'/rr_status?type=2')
             r = self.requests.get(URL,timeout=2)
             j = self.json.loads(r.text)
-            ja=j['axisNames']
-            jt=j['tools']
-            ret=self.json.loads('{}')
-            to = jt[tool]['offsets']
-            for i in range(0,len(to)):
-                ret[ ja[i] ] = to[i]
+            ret=dict(zip(self._cacheAxisNames(j['axisNames']), j['tools'][tool]['offsets']))
             logger.debug('Tool offset for T' + str(tool) +': ' + str(ret))
             return(ret)
         logger.warning('getG10ToolOffset entered unhandled exception state.')
@@ -364,6 +527,7 @@ class DuetWebAPI:
             return 'Error'
 
     def gCode(self,command):
+        self._countMotion(command)
         if (self.pt == 2):
             if not self._rrf2:
                 #RRF 3 on a Duet Ethernet/Wifi board, apply buffer checking
@@ -401,6 +565,7 @@ class DuetWebAPI:
     
     def gCodeBatch(self,commands):
         for command in commands:
+            self._countMotion(command)
             if (self.pt == 2):
                 if not self._rrf2:
                 #RRF 3 on a Duet Ethernet/Wifi board, apply buffer checking
@@ -0,0 +1,209 @@
+# Python Script containing the endstop (CP auto-calibration) detection used by TAMV.
+#
+# EndstopDetector finds the centre of the largest enclosed region outlined by
+# edges in the frame, the same result as the original analyzeEndstop algorithm:
+#   luma -> GaussianBlur 9x9,3 -> Canny 50/190 -> dilate x3 -> fill contours
+#   -> dilate x2 -> largest contour with a parent -> centroid
+# with less work per frame:
+#   - all intermediate images in buffers reused between frames
+#   - the filled contours are drawn all at once, so only the contour set matters
+#     and not the nesting: the first pass is RETR_LIST instead of RETR_TREE
+#   - the largest contour with a parent is always a hole (anything nested inside
+#     a hole is smaller than it), so the second pass only needs the two level
+#     RETR_CCOMP hierarchy
+#   - CHAIN_APPROX_SIMPLE contours: the dropped points are collinear, so fill,
+#     area and moments are unchanged
+#   - after a hit only a window around the found region is processed
+# Run this file directly to benchmark against the original algorithm:
+#   python EndstopDetection.py [image directory or video file]
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3, OpenCV and numpy
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.EndstopDetection')
+
+import time
+
+import cv2
+import numpy as np
+
+class EndstopDetector:
+    def __init__(self, blurSize=9, blurSigma=3, cannyLow=50, cannyHigh=190, edgeIterations=3, fillIterations=2, margin=0.25, border=32):
+        self.blurSize = blurSize
+        self.blurSigma = blurSigma
+        self.cannyLow = cannyLow
+        self.cannyHigh = cannyHigh
+        self.edgeIterations = edgeIterations
+        self.fillIterations = fillIterations
+        # window around the last hit: its bounding box grown on each side by margin
+        # times its size plus border pixels, enough for the outline enclosing it
+        self.margin = margin
+        self.border = border
+        self.kernel = np.ones((5,5),np.uint8)
+        self.shape = None
+        self.reset()
+
+    def reset(self):
+        # next detection runs on the full frame
+        self.window = None
+        self.contour = None
+
+    def _allocate(self, shape):
+        self.shape = shape
+        self.yuv = np.empty(shape + (3,), np.uint8)
+        self.luma = np.empty(shape, np.uint8)
+        self.blurred = np.empty(shape, np.uint8)
+        self.edges = np.empty(shape, np.uint8)
+        self.dilated = np.empty(shape, np.uint8)
+        self.filled = np.empty(shape, np.uint8)
+
+    def _find(self, image):
+        # Returns (contour, area) of the largest hole, or (None, 0)
+        if image.shape[:2] != self.shape:
+            self._allocate(image.shape[:2])
+        if image.ndim == 3:
+            cv2.cvtColor(image, cv2.COLOR_BGR2YUV, dst=self.yuv)
+            cv2.extractChannel(self.yuv, 0, dst=self.luma)
+        else:
+            np.copyto(self.luma, image)
+        cv2.GaussianBlur(self.luma, (self.blurSize, self.blurSize), self.blurSigma, dst=self.blurred)
+        cv2.Canny(self.blurred, self.cannyLow, self.cannyHigh, edges=self.edges)
+        cv2.dilate(self.edges, self.kernel, dst=self.dilated, iterations=self.edgeIterations)
+        contours, hierarchy = cv2.findContours(self.dilated, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        if len(contours) == 0:
+            return(None, 0)
+        self.filled.fill(0)
+        cv2.drawContours(self.filled, contours, -1, 255, -1)
+        cv2.dilate(self.filled, self.kernel, dst=self.dilated, iterations=self.fillIterations)
+        contours, hierarchy = cv2.findContours(self.dilated, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+        best = None
+        bestArea = -1
+        for (contour, link) in zip(contours, hierarchy[0] if hierarchy is not None else []):
+            if link[3] < 0:
+                continue
+            area = cv2.contourArea(contour)
+            if area > bestArea:
+                best = contour
+                bestArea = area
+        return(best, bestArea)
+
+    def detect(self, frame):
+        # Returns the endstop centre as integer pixel coordinates, or None
+        (height, width) = frame.shape[:2]
+        if self.window is not None:
+            (x, y, w, h) = self.window
+            (contour, area) = self._find(frame[y:y+h, x:x+w])
+            # a hole touching the window edge may continue outside of it
+            if contour is not None:
+                (cx, cy, cw, ch) = cv2.boundingRect(contour)
+                if cx <= 0 or cy <= 0 or cx + cw >= w or cy + ch >= h:
+                    contour = None
+            if contour is not None:
+                contour = contour + np.array([x, y], dtype=contour.dtype)
+            else:
+                self.window = None
+        if self.window is None:
+            (contour, area) = self._find(frame)
+        if contour is None:
+            self.reset()
+            return(None)
+        M = cv2.moments(contour)
+        if M['m00'] == 0:
+            self.reset()
+            return(None)
+        self.contour = contour
+        (bx, by, bw, bh) = cv2.boundingRect(contour)
+        grow = int(self.margin * max(bw, bh)) + self.border
+        left, top = max(bx - grow, 0), max(by - grow, 0)
+        self.window = (left, top, min(bx + bw + grow, width) - left, min(by + bh + grow, height) - top)
+        return((int(M['m10'] / M['m00']), int(M['m01'] / M['m00'])))
+
+def legacyEndstop(frame):
+    # original analyzeEndstop algorithm, kept for benchmarking
+    yuv = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV)
+    yuvPlanes = cv2.split(yuv)
+    still = yuvPlanes[0]
+    black = np.zeros((still.shape[0],still.shape[1]), np.uint8)
+    kernel = np.ones((5,5),np.uint8)
+    img_blur = cv2.GaussianBlur(still, (9, 9), 3)
+    img_canny = cv2.Canny(img_blur, 50, 190)
+    img_dilate = cv2.morphologyEx(img_canny, cv2.MORPH_DILATE, kernel, iterations=3)
+    cnt, hierarchy = cv2.findContours(img_dilate, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
+    black = cv2.drawContours(black, cnt, -1, (255, 0, 255), -1)
+    black = cv2.morphologyEx(black, cv2.MORPH_DILATE, kernel, iterations=2)
+    cnt2, hierarchy2 = cv2.findContours(black, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
+    if len(cnt2) > 0:
+        myContours = []
+        for k in range(len(cnt2)):
+            if hierarchy2[0][k][3] > -1:
+                myContours.append(cnt2[k])
+        if len(myContours) > 0:
+            blobContours = max(myContours, key=lambda el: cv2.contourArea(el))
+            if len(blobContours) > 0:
+                M = cv2.moments(blobContours)
+                return((int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"])))
+    return(None)
+
+def syntheticEndstop(width=640, height=480, center=None, radius=None, noise=20, seed=0):
+    # Endstop seen from below: a dashed circular outline (separate arcs, as the
+    # edge of a knurled or slotted part breaks up) on a textured background.
+    rng = np.random.default_rng(seed)
+    frame = np.full((height, width, 3), 90, np.uint8)
+    if center is None:
+        center = (width/2, height/2)
+    if radius is None:
+        radius = height/5
+    c = (int(round(center[0]*16)), int(round(center[1]*16)))
+    for start in range(0, 360, 45):
+        cv2.ellipse(frame, c, (int(radius*16), int(radius*16)), 0, start, start + 36, (230,230,230), 6, cv2.LINE_AA, 4)
+    # unrelated features elsewhere in the frame
+    cv2.rectangle(frame, (20, 20), (80, 60), (200,200,200), -1)
+    cv2.line(frame, (width - 100, 30), (width - 20, height - 30), (180,180,180), 3)
+    frame = cv2.add(frame, rng.integers(0, noise, frame.shape, dtype=np.uint8))
+    return(frame)
+
+def benchmark(frames, repeats=1):
+    # Original against streamlined detection (full frame and tracked window) on
+    # the same frames: latency and whether the detected centres match.
+    detector = EndstopDetector()
+    timings = {}
+    centres = {}
+    for (name, function) in (('legacy', legacyEndstop), ('full frame', None), ('tracked', None)):
+        found = []
+        start = time.perf_counter()
+        for r in range(repeats):
+            found = []
+            for frame in frames:
+                if name == 'full frame':
+                    detector.reset()
+                    found.append(detector.detect(frame))
+                elif name == 'tracked':
+                    found.append(detector.detect(frame))
+                else:
+                    found.append(function(frame))
+        timings[name] = (time.perf_counter() - start) / (repeats * max(1, len(frames))) * 1000
+        centres[name] = found
+    reference = centres['legacy']
+    print('Endstop detection on ' + str(len(frames)) + ' frames:')
+    for name in timings:
+        same = sum(1 for a, b in zip(reference, centres[name]) if a == b)
+        print('  {0:10s} {1:8.2f} ms/frame ({2:4.1f}x), detected {3}, same centre as legacy {4}/{5}'.format(
+            name, timings[name], timings['legacy'] / timings[name], sum(1 for c in centres[name] if c is not None), same, len(frames)))
+    return(timings, centres)
+
+if __name__ == '__main__':
+    import argparse
+    import NozzleDetection
+    parser = argparse.ArgumentParser(description='TAMV endstop detection benchmark')
+    parser.add_argument('frames', nargs='?', default=None, help='recorded endstop frames (image directory or video file), synthetic frames if omitted')
+    parser.add_argument('--repeats', type=int, default=3, help='runs over the frames')
+    args = parser.parse_args()
+    if args.frames is not None:
+        frames = NozzleDetection.loadFrames(args.frames)
+    else:
+        rng = np.random.default_rng(0)
+        frames = [ syntheticEndstop(center=(320 + rng.uniform(-3,3), 240 + rng.uniform(-3,3)), seed=i) for i in range(30) ]
+    benchmark(frames, repeats=args.repeats)
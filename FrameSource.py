@@ -0,0 +1,577 @@
+# Python Script containing the camera frame source used by TAMV.
+#
+# A FrameGrabber owns the cv2.VideoCapture object and runs a capture thread that
+# continuously reads frames into a small preallocated ring buffer. Every frame
+# is stamped with a monotonic timestamp and a sequence number, so consumers can
+# take the newest frame without blocking on camera I/O, or wait for a frame that
+# was captured after a given point (eg. after a move has finished).
+#
+# Camera (re)initialization lives in FrameGrabber.open(); nothing else should call
+# cap.open()/cap.set() for resolution or buffer size.
+#
+# The capture mode (FOURCC, resolution, frame rate) is negotiated once per camera
+# by negotiateMode(): every supported combination is probed, the one with the
+# highest useful frame rate wins, preferring modes the backend can hand over as
+# raw luma (YUYV/GREY without RGB conversion). The chosen mode is cached in the
+# camera profile of settings.json, so later starts skip probing. In raw luma mode
+# the ring buffer holds the raw frames; consumers asking for luma get the Y plane
+# without any colour conversion and BGR is only produced for frames taken as BGR.
+#   python FrameSource.py --probe SRC [--width 640] [--height 480]
+#
+# A ReplaySource has the same interface but plays back recorded frames (a
+# directory of images, a video file or a memory-mapped .npy frame archive) with
+# a JSON sidecar of timestamps and machine coordinates, either in real time or
+# as fast as the consumer takes them. openFrameSource() picks the right one for a
+# video_src setting. Profile the vision path on a replay with:
+#   python NozzleDetection.py --replay PATH [--realtime] [--output results.json] [--expect results.json]
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3, OpenCV and numpy
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.FrameSource')
+
+import json
+import os
+import threading
+import time
+from array import array
+
+import UserSettings
+
+import cv2
+import numpy as np
+
+# FOURCCs probed in order: compressed, packed YUV 4:2:2 and 8 bit grey
+probeFourccs = ('MJPG', 'YUYV', 'GREY')
+probeRates = (60, 30, 15)
+# raw frame layouts that can be handed over without RGB conversion: FOURCC ->
+# (bytes per pixel, conversion of the raw frame to BGR)
+rawFormats = {
+    'YUYV': (2, cv2.COLOR_YUV2BGR_YUYV),
+    'GREY': (1, cv2.COLOR_GRAY2BGR),
+    'Y800': (1, cv2.COLOR_GRAY2BGR)
+}
+
+def fourccName(value):
+    value = int(value)
+    return(''.join(chr((value >> 8*i) & 0xFF) for i in range(4)))
+
+def applyMode(cap, mode):
+    # request a capture mode; FOURCC goes first, it limits the sizes available
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*mode['fourcc']))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, mode['width'])
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, mode['height'])
+    if mode.get('fps', 0) > 0:
+        cap.set(cv2.CAP_PROP_FPS, mode['fps'])
+    cap.set(cv2.CAP_PROP_CONVERT_RGB, 0 if mode.get('luma', False) else 1)
+
+def _measureRate(cap, frames=12, warmup=3, timeout=3.0):
+    # frames per second actually delivered, 0 if the camera stalls
+    deadline = time.monotonic() + timeout
+    for i in range(warmup):
+        if not cap.grab() or time.monotonic() > deadline:
+            return(0.0)
+    start = time.monotonic()
+    for i in range(frames):
+        if not cap.grab() or time.monotonic() > deadline:
+            return(0.0)
+    return(frames / max(time.monotonic() - start, 1e-6))
+
+def _rawLuma(cap, mode):
+    # True if the backend delivers the raw frame of mode with RGB conversion off
+    if mode['fourcc'] not in rawFormats:
+        return(False)
+    cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    try:
+        (ret, image) = cap.read()
+        return(ret and image is not None and image.size == mode['width'] * mode['height'] * rawFormats[mode['fourcc']][0])
+    finally:
+        cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+
+def probeModes(src, width, height, fourccs=probeFourccs, rates=probeRates, frames=12):
+    # Capture modes of a camera at the given resolution with their measured frame
+    # rates, as a list of {fourcc, width, height, fps, measured, luma} dicts
+    modes = []
+    cap = cv2.VideoCapture(src)
+    if not cap.isOpened():
+        logger.warning('Cannot open camera ' + str(src) + ' for probing')
+        return(modes)
+    try:
+        for fourcc in fourccs:
+            for fps in rates:
+                mode = { 'fourcc': fourcc, 'width': int(width), 'height': int(height), 'fps': fps, 'luma': False }
+                applyMode(cap, mode)
+                actual = (fourccName(cap.get(cv2.CAP_PROP_FOURCC)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+                if actual != (fourcc, mode['width'], mode['height']):
+                    logger.debug('Camera ' + str(src) + ' does not support ' + str(mode) + ', got ' + str(actual))
+                    # the frame rate does not matter if the format is not there
+                    break
+                mode['measured'] = round(_measureRate(cap, frames), 1)
+                if mode['measured'] <= 0:
+                    continue
+                mode['luma'] = _rawLuma(cap, mode)
+                logger.debug('Camera ' + str(src) + ' mode ' + str(mode))
+                modes.append(mode)
+    finally:
+        cap.release()
+    return(modes)
+
+def chooseMode(modes, tolerance=0.9):
+    # Among the modes within tolerance of the highest measured frame rate prefer
+    # raw luma, then uncompressed (no JPEG decoding), then the fastest
+    if len(modes) == 0:
+        return(None)
+    best = max(mode['measured'] for mode in modes)
+    useful = [ mode for mode in modes if mode['measured'] >= tolerance * best ]
+    return(max(useful, key=lambda mode: (mode['luma'], mode['fourcc'] in rawFormats, mode['measured'])))
+
+def negotiateMode(src, width, height):
+    # Probe a camera and return the capture mode to use, None if nothing works
+    start = time.monotonic()
+    mode = chooseMode(probeModes(src, width, height))
+    logger.info('Camera ' + str(src) + ' capture mode ' + str(mode) + ' (probed in {0:.1f}s)'.format(time.monotonic() - start))
+    return(mode)
+
+def loadCaptureMode(options, src, width, height, camera=0):
+    # Cached capture mode of a camera profile, None if missing or for another
+    # camera or resolution
+    try:
+        mode = options['camera'][camera]['capture']
+        if str(mode['src']) == str(src) and (mode['width'], mode['height']) == (int(width), int(height)):
+            return(mode)
+    except (KeyError, IndexError, TypeError):
+        pass
+    return(None)
+
+def saveCaptureMode(mode, src, path='settings.json', camera=0):
+    # Store the capture mode with a camera profile, returns True once saved
+    def update(options):
+        UserSettings.profile(options, 'camera', camera)['capture'] = dict(mode, src=src)
+    return(UserSettings.updateSettings(update, path))
+
+class FrameGrabber:
+    # number of ring buffer slots. One slot is being written while the newest
+    # complete frame is read from another, so 3 is the useful minimum.
+    slots = 3
+    # delay before retrying a camera that returned no frame
+    _retryDelay = 0.05
+
+    def __init__(self, src, width, height, slots=3, mode=None):
+        self.src = src
+        self.width = int(width)
+        self.height = int(height)
+        self.slots = max(3,int(slots))
+        # negotiated capture mode (see negotiateMode), None for the backend default
+        self.mode = mode
+        # raw luma mode: (bytes per pixel, conversion to BGR) of the raw frames
+        self._raw = None
+        self._frameSize = None
+        self.cap = None
+        # guards the VideoCapture object (read/open/set from different threads)
+        self._capLock = threading.Lock()
+        # guards the ring buffer and wakes up waiting consumers
+        self._cond = threading.Condition()
+        self._buffers = [None] * self.slots
+        self._stamps = array('d', [0.0] * self.slots)
+        self._seqs = array('q', [0] * self.slots)
+        # sequence number of the newest published frame and the slot holding it
+        self._seq = 0
+        self._latest = -1
+        # sequence number of the last frame handed out by read()
+        self._readSeq = 0
+        self._running = False
+        self._thread = None
+        self.open()
+
+    def open(self):
+        # (re)initialize the capture device with the configured resolution
+        with self._capLock:
+            if self.cap is None:
+                self.cap = cv2.VideoCapture(self.src)
+            else:
+                self.cap.open(self.src)
+            if self.mode is not None:
+                applyMode(self.cap, self.mode)
+            else:
+                self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+                self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
+            h = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            w = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self._frameSize = (h, w)
+        self._raw = rawFormats.get(self.mode['fourcc']) if self.mode is not None and self.mode.get('luma', False) else None
+        if h > 0 and w > 0:
+            self._allocate((h, w, 3) if self._raw is None else (h, w * self._raw[0]))
+
+    def reset(self):
+        logger.debug('Resetting camera capture!')
+        self.open()
+        logger.debug('Camera source reset.')
+
+    def _allocate(self, shape):
+        with self._cond:
+            for i in range(self.slots):
+                if self._buffers[i] is None or self._buffers[i].shape != shape:
+                    self._buffers[i] = np.empty(shape, np.uint8)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._capture, name='TAMV-FrameGrabber', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2)
+        self._thread = None
+
+    def release(self):
+        self.stop()
+        with self._capLock:
+            if self.cap is not None:
+                self.cap.release()
+
+    def changeSource(self, newSrc):
+        self.release()
+        self.src = newSrc
+        self.open()
+        self.start()
+
+    def set(self, prop, value):
+        with self._capLock:
+            return(self.cap.set(prop, value))
+
+    def get(self, prop):
+        with self._capLock:
+            return(self.cap.get(prop))
+
+    def _grab(self, buffer):
+        # read the next frame, into buffer if possible: returns (ret, image)
+        with self._capLock:
+            if buffer is not None:
+                return(self.cap.read(buffer))
+            return(self.cap.read())
+
+    def _capture(self):
+        while self._running:
+            # never write into the slot holding the newest published frame
+            slot = (self._latest + 1) % self.slots
+            (ret, image) = self._grab(self._buffers[slot])
+            if not self._running:
+                break
+            if not ret or image is None:
+                self.reset()
+                time.sleep(self._retryDelay)
+                continue
+            stamp = time.monotonic()
+            with self._cond:
+                if image is not self._buffers[slot]:
+                    # first frame or the camera changed resolution: adopt its buffer
+                    self._buffers[slot] = image
+                self._seq += 1
+                self._seqs[slot] = self._seq
+                self._stamps[slot] = stamp
+                self._latest = slot
+                self._cond.notify_all()
+
+    def _copyLatest(self, out=None, luma=False):
+        # caller holds self._cond
+        frame = self._buffers[self._latest]
+        if self._raw is not None or luma:
+            out = self._convert(frame, out, luma)
+        elif out is None or out.shape != frame.shape:
+            out = frame.copy()
+        else:
+            np.copyto(out, frame)
+        return(self._seqs[self._latest], self._stamps[self._latest], out)
+
+    def _convert(self, frame, out, luma):
+        # BGR or luma image of a ring buffer frame, into out if it has the right shape
+        if self._raw is None:
+            return(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=out if out is not None and out.shape == frame.shape[:2] else None))
+        (h, w) = self._frameSize
+        (depth, code) = self._raw
+        raw = frame.reshape(h, w, depth) if depth > 1 else frame.reshape(h, w)
+        if luma:
+            if out is None or out.shape != (h, w):
+                out = np.empty((h, w), np.uint8)
+            if depth > 1:
+                cv2.extractChannel(raw, 0, dst=out)
+            else:
+                np.copyto(out, raw)
+            return(out)
+        return(cv2.cvtColor(raw, code, dst=out if out is not None and out.shape == (h, w, 3) else None))
+
+    def latest(self, out=None, luma=False):
+        # Non-blocking: returns (sequence, timestamp, frame) for the newest frame,
+        # or (0, 0.0, None) if nothing has been captured yet.
+        # The frame is a copy (into out if given) and safe to draw on; with luma
+        # set it is the single channel luma plane instead of BGR.
+        with self._cond:
+            if self._latest < 0:
+                return(0, 0.0, None)
+            return(self._copyLatest(out, luma))
+
+    def wait(self, afterSeq=0, timeout=1.0, out=None, luma=False):
+        # Block until a frame newer than afterSeq exists and return it as
+        # (sequence, timestamp, frame). Returns (afterSeq, 0.0, None) on timeout.
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > afterSeq or not self._running, timeout):
+                return(afterSeq, 0.0, None)
+            if self._seq <= afterSeq:
+                return(afterSeq, 0.0, None)
+            return(self._copyLatest(out, luma))
+
+    def waitAfter(self, timestamp, timeout=2.0, out=None, luma=False):
+        # Block until a frame captured after the given time.monotonic() value exists
+        deadline = time.monotonic() + timeout
+        seq = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return(seq, 0.0, None)
+            (seq, stamp, frame) = self.wait(afterSeq=seq, timeout=remaining, out=out, luma=luma)
+            if frame is not None and stamp > timestamp:
+                return(seq, stamp, frame)
+
+    def read(self, timeout=1.0):
+        # cv2.VideoCapture.read() compatible: returns (ret, frame) with the newest
+        # frame not yet returned by a previous read().
+        (seq, stamp, frame) = self.wait(afterSeq=self._readSeq, timeout=timeout)
+        if frame is None:
+            return(False, None)
+        self._readSeq = seq
+        return(True, frame)
+
+    @property
+    def sequence(self):
+        return(self._seq)
+
+    @property
+    def rawLuma(self):
+        # True if luma frames come straight from the camera, without conversion
+        return(self._raw is not None)
+
+    @property
+    def shape(self):
+        # shape of the newest frame as BGR, None before the first frame
+        with self._cond:
+            if self._latest < 0:
+                return(None)
+            if self._raw is not None:
+                return(self._frameSize + (3,))
+            return(self._buffers[self._latest].shape)
+
+class ReplaySource(FrameGrabber):
+    # Recorded frames with the FrameGrabber interface.
+    #
+    # path is a directory of images (sidecar: replay.json inside it), a video file
+    # or a .npy archive of shape (frames, height, width, 3) that is memory-mapped
+    # (sidecar: same name with .json). The sidecar holds
+    #   { "fps": 30, "frames": [ { "t": 0.0, "X": 10.0, "Y": 20.0, "Z": 0.0 }, ... ] }
+    # with one record per frame; t (seconds from the first frame) and the machine
+    # coordinates are optional.
+    # With realtime set frames are published at their recorded times and can be
+    # missed like camera frames, otherwise each frame is published once the
+    # previous one has been taken, so every frame is seen as fast as possible.
+    imageExtensions = ('.png','.jpg','.jpeg','.bmp','.tif','.tiff')
+
+    def __init__(self, path, realtime=False, loop=False, slots=3):
+        self.realtime = realtime
+        self.loop = loop
+        self.finished = False
+        self._taken = 0
+        self._loadSidecar(path)
+        FrameGrabber.__init__(self, path, 0, 0, slots)
+
+    @staticmethod
+    def sidecarPath(path):
+        if os.path.isdir(path):
+            return(os.path.join(path, 'replay.json'))
+        return(os.path.splitext(path)[0] + '.json')
+
+    @classmethod
+    def isReplay(cls, src):
+        # a directory of images, a .npy archive, or a video file with a sidecar
+        if not isinstance(src, str) or not os.path.exists(src):
+            return(False)
+        return(os.path.isdir(src) or src.lower().endswith('.npy') or os.path.exists(cls.sidecarPath(src)))
+
+    def _loadSidecar(self, path):
+        self.fps = 30.0
+        self.records = []
+        try:
+            with open(self.sidecarPath(path), 'r') as inputfile:
+                sidecar = json.load(inputfile)
+            self.fps = float(sidecar.get('fps', self.fps))
+            self.records = list(sidecar.get('frames', []))
+        except FileNotFoundError:
+            logger.debug('No replay sidecar for ' + str(path))
+
+    def open(self):
+        self._index = 0
+        self._started = None
+        self._files = None
+        self._archive = None
+        with self._capLock:
+            if self.cap is not None:
+                self.cap.release()
+                self.cap = None
+            if os.path.isdir(self.src):
+                self._files = [ os.path.join(self.src, name) for name in sorted(os.listdir(self.src))
+                    if name.lower().endswith(self.imageExtensions) ]
+                self.count = len(self._files)
+            elif self.src.lower().endswith('.npy'):
+                self._archive = np.load(self.src, mmap_mode='r')
+                self.count = len(self._archive)
+            else:
+                self.cap = cv2.VideoCapture(self.src)
+                self.count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        (ret, image) = self._readFrame(0, None)
+        if ret:
+            (self.height, self.width) = image.shape[:2]
+            self._allocate(image.shape)
+        logger.info('Replaying ' + str(self.count) + ' frames from ' + str(self.src))
+
+    def _readFrame(self, index, buffer):
+        if self._files is not None:
+            if index >= len(self._files):
+                return(False, None)
+            image = cv2.imread(self._files[index])
+        elif self._archive is not None:
+            if index >= len(self._archive):
+                return(False, None)
+            image = self._archive[index]
+        else:
+            with self._capLock:
+                if index == 0:
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                return(self.cap.read(buffer) if buffer is not None else self.cap.read())
+        if image is None:
+            return(False, None)
+        if buffer is not None and buffer.shape == image.shape:
+            np.copyto(buffer, image)
+            return(True, buffer)
+        return(True, np.array(image))
+
+    def frameTime(self, index):
+        # recorded time of a frame in seconds from the first one
+        if index < len(self.records) and 't' in self.records[index]:
+            return(float(self.records[index]['t']))
+        return(index / self.fps)
+
+    def _grab(self, buffer):
+        if self.realtime:
+            now = time.monotonic()
+            if self._started is None or self._index == 0:
+                self._started = now - self.frameTime(self._index)
+            delay = self._started + self.frameTime(self._index) - now
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            # publish the next frame only once the previous one has been taken
+            with self._cond:
+                self._cond.wait_for(lambda: self._taken >= self._seq or not self._running)
+        (ret, image) = self._readFrame(self._index, buffer)
+        if ret:
+            self._index += 1
+        return(ret, image)
+
+    def reset(self):
+        # end of the recording
+        if self.loop and self._index > 0:
+            self._index = 0
+            return
+        self.finished = True
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+
+    def _copyLatest(self, out=None, luma=False):
+        result = FrameGrabber._copyLatest(self, out, luma)
+        if result[0] > self._taken:
+            self._taken = result[0]
+            self._cond.notify_all()
+        return(result)
+
+    def index(self, seq):
+        # frame index in the recording of a published sequence number
+        return((seq - 1) % max(1, self.count))
+
+    def coords(self, seq=None):
+        # machine coordinates recorded with a frame (default: the last one taken),
+        # or None if the sidecar has none
+        if seq is None:
+            seq = self._taken
+        if seq <= 0 or len(self.records) == 0:
+            return(None)
+        record = self.records[self.index(seq) % len(self.records)]
+        coords = { key: value for key, value in record.items() if key not in ('t', 'file') }
+        return(coords if len(coords) > 0 else None)
+
+    def set(self, prop, value):
+        return(False)
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return(self.height)
+        if prop == cv2.CAP_PROP_FPS:
+            return(self.fps)
+        return(0)
+
+    def release(self):
+        self.stop()
+        with self._capLock:
+            if self.cap is not None:
+                self.cap.release()
+        self._archive = None
+
+    def changeSource(self, newSrc):
+        self.release()
+        self.src = newSrc
+        self.finished = False
+        self._taken = 0
+        self._loadSidecar(newSrc)
+        self.open()
+        self.start()
+
+def writeReplay(path, frames, records=None, fps=30):
+    # Store frames as a .npy archive with its sidecar (eg. from a recording session)
+    archive = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(len(frames),) + frames[0].shape)
+    for (i, frame) in enumerate(frames):
+        archive[i] = frame
+    archive.flush()
+    del archive
+    with open(ReplaySource.sidecarPath(path), 'w') as outputfile:
+        json.dump({ 'fps': fps, 'frames': list(records) if records is not None else [] }, outputfile)
+
+def openFrameSource(src, width, height, realtime=True, loop=True, mode=None):
+    # FrameGrabber for a camera (in the negotiated capture mode if given),
+    # ReplaySource for a recording
+    if ReplaySource.isReplay(src):
+        return(ReplaySource(src, realtime=realtime, loop=loop))
+    return(FrameGrabber(src, width, height, mode=mode))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='TAMV camera capture mode probe')
+    parser.add_argument('--probe', required=True, help='camera index or device path')
+    parser.add_argument('--width', type=int, default=640, help='frame width')
+    parser.add_argument('--height', type=int, default=480, help='frame height')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    src = int(args.probe) if args.probe.isdigit() else args.probe
+    modes = probeModes(src, args.width, args.height)
+    for mode in modes:
+        logger.info('  {0} {1}x{2} requested {3} fps: {4:.1f} fps{5}'.format(mode['fourcc'], mode['width'], mode['height'],
+            mode['fps'], mode['measured'], ', raw luma' if mode['luma'] else ''))
+    logger.info('Selected: ' + str(chooseMode(modes)))
@@ -0,0 +1,83 @@
+# Python Script containing the travel move helper used by TAMV.
+#
+# Travel to the CP (or back to a stored position) used to be sent as separate
+# G1 X, G1 Y and G1 Z commands: three requests to the controller and three
+# moves one after the other. TravelPlanner builds the whole travel (with an
+# optional tool change before it) as one block of G-code lines, sent to the
+# controller in a single request, in an order that keeps the carriage clear of
+# the camera and the parked tools:
+#   - xy-first: one XY move, then Z (the original X, Y, Z order, as one diagonal
+#     XY move)
+#   - z-first: Z first, then one XY move (for machines where the bed or
+#     carriage has to be clear before moving across)
+#   - direct: a single XYZ move
+# Feed rates are optional: without one the moves run at the current feed rate.
+# The path and feed rates are read from the printer profile of settings.json:
+#   "motion": { "path": "xy-first", "travelFeed": 13200, "zFeed": 1000 }
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.MotionPlanner')
+
+paths = ('xy-first', 'z-first', 'direct')
+
+def _word(axis, value):
+    return(axis + '{0:.3f}'.format(float(value)).rstrip('0').rstrip('.'))
+
+class TravelPlanner:
+    def __init__(self, path='xy-first', travelFeed=None, zFeed=None):
+        if path not in paths:
+            raise ValueError('Unknown travel path: ' + str(path))
+        self.path = path
+        # mm/min, None keeps the current feed rate
+        self.travelFeed = travelFeed
+        self.zFeed = zFeed
+
+    def _move(self, target, axes, feed):
+        words = [ _word(axis, target[axis]) for axis in axes if target.get(axis) is not None ]
+        if len(words) == 0:
+            return(None)
+        if feed is not None:
+            words.append('F' + str(int(feed)))
+        return('G1 ' + ' '.join(words))
+
+    def moves(self, target, tools=()):
+        # G-code lines for an absolute travel to target ({'X':, 'Y':, 'Z':}, axes
+        # missing or None are not moved), after the tool commands in tools
+        # (eg. ['T-1'] to unload first)
+        lines = [ str(tool) for tool in tools ]
+        if self.path == 'direct':
+            steps = [ ('XYZ', self.travelFeed) ]
+        elif self.path == 'z-first':
+            steps = [ ('Z', self.zFeed), ('XY', self.travelFeed) ]
+        else:
+            steps = [ ('XY', self.travelFeed), ('Z', self.zFeed) ]
+        first = True
+        for (axes, feed) in steps:
+            move = self._move(target, axes, feed)
+            if move is None:
+                continue
+            lines.append(('G90 ' if first else '') + move)
+            first = False
+        return(lines)
+
+    def travel(self, printer, target, tools=()):
+        # Send the travel as a single request, returns the printer's gCode result
+        lines = self.moves(target, tools)
+        if len(lines) == 0:
+            return(0)
+        logger.debug('Travel: ' + ' | '.join(lines))
+        return(printer.gCode('\n'.join(lines)))
+
+def loadPlanner(options, printer=0):
+    # TravelPlanner from a printer profile of settings.json (defaults if none stored)
+    try:
+        motion = options['printer'][printer].get('motion', {})
+        return(TravelPlanner(motion.get('path', 'xy-first'), motion.get('travelFeed'), motion.get('zFeed')))
+    except (KeyError, IndexError, TypeError, AttributeError, ValueError) as e1:
+        logger.warning('Invalid travel settings, using defaults: ' + str(e1))
+        return(TravelPlanner())
@@ -0,0 +1,1175 @@
+# Python Script containing the image processing used by TAMV to find nozzles.
+#
+# PreprocessPipeline turns a camera frame into the single-channel binary image the
+# blob detector runs on (gamma -> luma -> GaussianBlur -> adaptive threshold).
+# All intermediate images are kept in buffers that are reused between frames.
+#
+# Run this file directly to benchmark the pipeline or compare blob detectors:
+#   python NozzleDetection.py --benchmark
+#   python NozzleDetection.py --compare [image directory or video file]
+#   python NozzleDetection.py --pyramid [image directory or video file]
+#   python NozzleDetection.py --centroid
+#   python NozzleDetection.py --settle
+#   python NozzleDetection.py --backends [image directory or video file]
+#   python NozzleDetection.py --replay PATH [--realtime] [--output results.json] [--expect results.json]
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3, OpenCV and numpy
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.NozzleDetection')
+
+import time
+
+import cv2
+import numpy as np
+
+# gamma lookup tables, built once per gamma value
+_gammaTables = {}
+
+def gammaTable(gamma=1.2):
+    table = _gammaTables.get(gamma)
+    if table is None:
+        # map pixel values [0, 255] to their gamma adjusted values
+        table = (((np.arange(256) / 255.0) ** (1.0 / gamma)) * 255).astype('uint8')
+        _gammaTables[gamma] = table
+    return(table)
+
+class PreprocessPipeline:
+    # Detection algorithm 1:
+    #    luma (Y of YUV) -> gamma correction -> GaussianBlur (7,7),6 -> adaptive threshold
+    # Gamma is applied to the luma plane in one lookup pass instead of to all
+    # three colour channels before the conversion.
+    def __init__(self, gamma=1.2, blurSize=7, blurSigma=6, blockSize=35, thresholdC=1):
+        self.gamma = gamma
+        self.blurSize = blurSize
+        self.blurSigma = blurSigma
+        self.blockSize = blockSize
+        self.thresholdC = thresholdC
+        self.shape = None
+        self.luma = None
+        self.blurred = None
+        self.binary = None
+
+    def _allocate(self, shape):
+        self.shape = shape
+        self.luma = np.empty(shape, np.uint8)
+        self.blurred = np.empty(shape, np.uint8)
+        self.binary = np.empty(shape, np.uint8)
+
+    def toLuma(self, frame):
+        # BGR2GRAY uses the same weights as the Y plane of BGR2YUV
+        if frame.shape[:2] != self.shape:
+            self._allocate(frame.shape[:2])
+        if frame.ndim == 2:
+            np.copyto(self.luma, frame)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.luma)
+        return(self.luma)
+
+    def clone(self):
+        # same parameters, separate buffers (eg. for processing a region of interest)
+        return(PreprocessPipeline(gamma=self.gamma, blurSize=self.blurSize, blurSigma=self.blurSigma, blockSize=self.blockSize, thresholdC=self.thresholdC))
+
+    def process(self, frame):
+        # Returns the binary image. It is an internal buffer that is overwritten
+        # by the next call, copy it if it needs to be kept.
+        luma = self.toLuma(frame)
+        cv2.LUT(luma, gammaTable(self.gamma), dst=luma)
+        cv2.GaussianBlur(luma, (self.blurSize,self.blurSize), self.blurSigma, dst=self.blurred)
+        cv2.adaptiveThreshold(self.blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, self.blockSize, self.thresholdC, dst=self.binary)
+        return(self.binary)
+
+class BinaryBlobDetector:
+    # Blob detector for images that are already binarized (PreprocessPipeline output).
+    #
+    # SimpleBlobDetector re-thresholds its input at every level between
+    # minThreshold and maxThreshold and runs a contour pass for each; on a binary
+    # image every level gives the same contours. This runs one contour pass and
+    # applies the SimpleBlobDetector area/circularity/convexity/inertia/colour
+    # filters to all contours at once. detect() returns cv2.KeyPoint objects so it
+    # can be used in place of SimpleBlobDetector.
+    def __init__(self, minArea=600, maxArea=5000, minCircularity=0.8, maxCircularity=1,
+            minConvexity=0.3, maxConvexity=1, minInertiaRatio=0.3, maxInertiaRatio=np.inf,
+            blobColor=0, minDistBetweenBlobs=10):
+        self.minArea = minArea
+        self.maxArea = maxArea
+        self.minCircularity = minCircularity
+        self.maxCircularity = maxCircularity
+        self.minConvexity = minConvexity
+        self.maxConvexity = maxConvexity
+        self.minInertiaRatio = minInertiaRatio
+        self.maxInertiaRatio = maxInertiaRatio
+        self.blobColor = blobColor
+        self.minDistBetweenBlobs = minDistBetweenBlobs
+
+    def detect(self, binary, mask=None):
+        if binary.ndim == 3:
+            binary = cv2.cvtColor(binary, cv2.COLOR_BGR2GRAY)
+        contours, hierarchy = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+        if len(contours) == 0:
+            return([])
+        # A closed contour enclosing minArea has at least 2*sqrt(pi*minArea)
+        # perimeter, and every contour point covers at most sqrt(2) of it. This
+        # drops the threshold noise before any per-contour work is done.
+        lengths = np.fromiter((len(c) for c in contours), dtype=np.int64, count=len(contours))
+        minPoints = 2 * np.sqrt(np.pi * self.minArea) / np.sqrt(2)
+        candidates = np.flatnonzero(lengths >= minPoints)
+        if len(candidates) == 0:
+            return([])
+        return(self._filterContours(binary, [contours[i] for i in candidates]))
+
+    def _filterContours(self, binary, contours):
+        moments = [cv2.moments(c) for c in contours]
+        m00 = np.array([m['m00'] for m in moments])
+        m10 = np.array([m['m10'] for m in moments])
+        m01 = np.array([m['m01'] for m in moments])
+        mu20 = np.array([m['mu20'] for m in moments])
+        mu02 = np.array([m['mu02'] for m in moments])
+        mu11 = np.array([m['mu11'] for m in moments])
+        perimeter = np.array([cv2.arcLength(c, True) for c in contours])
+        hullArea = np.array([cv2.contourArea(cv2.convexHull(c)) for c in contours])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            circularity = 4 * np.pi * m00 / (perimeter * perimeter)
+            convexity = m00 / hullArea
+            # inertia ratio as computed by SimpleBlobDetector
+            denominator = np.sqrt((2 * mu11)**2 + (mu20 - mu02)**2)
+            cosmin = (mu20 - mu02) / denominator
+            sinmin = 2 * mu11 / denominator
+            half = 0.5 * (mu20 + mu02)
+            imin = half - 0.5 * (mu20 - mu02) * cosmin - mu11 * sinmin
+            imax = half + 0.5 * (mu20 - mu02) * cosmin + mu11 * sinmin
+            inertia = np.where(denominator > 1e-2, imin / imax, 1.0)
+            cx = m10 / m00
+            cy = m01 / m00
+        keep = ((m00 > 0) & (m00 >= self.minArea) & (m00 < self.maxArea)
+            & (circularity >= self.minCircularity) & (circularity < self.maxCircularity + 1e-9)
+            & (inertia >= self.minInertiaRatio) & (inertia < self.maxInertiaRatio)
+            & (convexity >= self.minConvexity) & (convexity < self.maxConvexity + 1e-9))
+        keypoints = []
+        for i in np.flatnonzero(keep):
+            px, py = int(round(cx[i])), int(round(cy[i]))
+            if not (0 <= py < binary.shape[0] and 0 <= px < binary.shape[1]) or binary[py,px] != self.blobColor:
+                continue
+            # blob diameter from the median distance of the contour to its centre
+            points = contours[i].reshape(-1,2)
+            radius = np.median(np.hypot(points[:,0] - cx[i], points[:,1] - cy[i]))
+            keypoints.append(cv2.KeyPoint(float(cx[i]), float(cy[i]), float(2*radius)))
+        return(self._mergeKeypoints(keypoints))
+
+    def _mergeKeypoints(self, keypoints):
+        return(mergeKeypoints(keypoints, self.minDistBetweenBlobs))
+
+def mergeKeypoints(keypoints, minDist=10):
+    # Concentric contours (eg. the inside and outside of a nozzle ring) are one
+    # blob, as they are grouped across threshold levels by SimpleBlobDetector.
+    merged = []
+    for keypoint in keypoints:
+        for group in merged:
+            dist = np.hypot(group[0].pt[0] - keypoint.pt[0], group[0].pt[1] - keypoint.pt[1])
+            if dist < minDist or dist < group[0].size/2 or dist < keypoint.size/2:
+                group.append(keypoint)
+                break
+        else:
+            merged.append([keypoint])
+    result = []
+    for group in merged:
+        if len(group) == 1:
+            result.append(group[0])
+            continue
+        # report the innermost contour (the nozzle opening) as the blob size
+        x = np.mean([k.pt[0] for k in group])
+        y = np.mean([k.pt[1] for k in group])
+        result.append(cv2.KeyPoint(float(x), float(y), float(min(k.size for k in group))))
+    return(result)
+
+def pixelJacobian(transform, position, size):
+    # Local derivative of the quadratic camera map (see least_square_mapping) at a
+    # pixel position: machine mm per pixel, as a 2x2 matrix.
+    # transform maps [x^2, y^2, xy, x, y, 1] of normalized coordinates to machine X,Y.
+    (width, height) = size
+    x = position[0] / width - 0.5
+    y = position[1] / height - 0.5
+    T = np.asarray(transform)
+    dx = 2*x*T[0] + y*T[2] + T[3]
+    dy = 2*y*T[1] + x*T[2] + T[4]
+    return(np.column_stack((dx / width, dy / height)))
+
+class NozzleTracker:
+    # Region of interest tracking for nozzle detection.
+    #
+    # After a detection, only a window around the expected nozzle position is
+    # processed. Commanded moves shift the expected position through the camera
+    # transform, a miss widens the window (by growth, maxLevels times) and after
+    # that detection falls back to the full frame.
+    def __init__(self, minHalfSize=48, radiusFactor=4, growth=2, maxLevels=2):
+        self.minHalfSize = minHalfSize
+        self.radiusFactor = radiusFactor
+        self.growth = growth
+        self.maxLevels = maxLevels
+        self._pipeline = None
+        self.reset()
+
+    def reset(self):
+        # forget the nozzle position, next detection runs on the full frame
+        self.position = None
+        self.radius = 0
+        self.level = 0
+        # extra search radius in pixels from moves whose effect could not be predicted
+        self.slack = 0
+        # window used by the last detect() call, None for full frame
+        self.window = None
+
+    def expect(self, x, y):
+        # the nozzle is expected at this pixel position (eg. after an absolute move)
+        if self.position is not None:
+            self.position = (float(x), float(y))
+            self.level = 0
+
+    def predictMove(self, dx, dy, transform=None, mpp=None, size=(640,480)):
+        # Shift the expected position by a relative machine move of dx, dy mm.
+        # Without a transform only the size of the move is known (from mpp), so the
+        # window grows to cover it; with neither the position is dropped.
+        if self.position is None:
+            return
+        if transform is not None and len(transform) > 1:
+            try:
+                step = np.linalg.solve(pixelJacobian(transform, self.position, size), [dx, dy])
+                self.position = (self.position[0] + step[0], self.position[1] + step[1])
+                return
+            except np.linalg.LinAlgError:
+                pass
+        if mpp is not None and mpp > 0:
+            self.slack += np.hypot(dx, dy) / mpp
+        else:
+            self.reset()
+
+    def halfSize(self):
+        half = max(self.minHalfSize, self.radiusFactor * self.radius) + self.slack
+        return(int(half * (self.growth ** self.level)))
+
+    def roi(self, width, height):
+        # (x, y, w, h) of the window to process, or None for the full frame
+        if self.position is None or self.level > self.maxLevels:
+            return(None)
+        half = self.halfSize()
+        if 2*half >= width or 2*half >= height:
+            return(None)
+        # keep the window size constant by sliding it inside the frame
+        x = int(min(max(round(self.position[0]) - half, 0), width - 2*half))
+        y = int(min(max(round(self.position[1]) - half, 0), height - 2*half))
+        return((x, y, 2*half, 2*half))
+
+    def hit(self, keypoint):
+        self.position = keypoint.pt
+        self.radius = keypoint.size / 2
+        self.level = 0
+        self.slack = 0
+
+    def miss(self):
+        if self.position is not None:
+            self.level += 1
+
+    def detect(self, frame, pipeline, detector, fullFrame=None):
+        # Returns keypoints in full frame coordinates. detector is a detector
+        # backend (see DetectorBackend). fullFrame(frame) replaces the full frame
+        # detection (eg. PyramidDetector.detect) when given.
+        (height, width) = frame.shape[:2]
+        self.window = self.roi(width, height)
+        if self.window is None and fullFrame is not None:
+            keypoints = fullFrame(frame)
+        elif self.window is None:
+            keypoints = detector.find(frame, pipeline)
+        else:
+            (x, y, w, h) = self.window
+            if self._pipeline is None:
+                self._pipeline = pipeline.clone()
+            keypoints = [ cv2.KeyPoint(k.pt[0] + x, k.pt[1] + y, k.size) for k in detector.find(frame[y:y+h, x:x+w], self._pipeline) ]
+        if len(keypoints) == 1:
+            self.hit(keypoints[0])
+        elif self.window is not None:
+            self.miss()
+        return(keypoints)
+
+    def detectBatch(self, frames, pipeline, detector, fullFrame=None):
+        # Detect the nozzle in a burst of frames of a static scene, returns one
+        # keypoint list per frame. Without a window the first frame is searched on
+        # its own to find one; the windows of the other frames are stacked into one
+        # image so preprocessing and detection run once for the whole batch.
+        # Backends that are not batchable (eg. template matching) run per frame.
+        if not detector.batchable:
+            return([self.detect(frame, pipeline, detector, fullFrame=fullFrame) for frame in frames])
+        results = []
+        frames = list(frames)
+        while len(frames) > 0 and self.roi(frames[0].shape[1], frames[0].shape[0]) is None:
+            results.append(self.detect(frames.pop(0), pipeline, detector, fullFrame=fullFrame))
+            if len(results[-1]) != 1:
+                # not found: leave the rest to the caller's retry
+                return(results + [[] for frame in frames])
+        if len(frames) == 0:
+            return(results)
+        (x, y, w, h) = self.window = self.roi(frames[0].shape[1], frames[0].shape[0])
+        if self._pipeline is None:
+            self._pipeline = pipeline.clone()
+        stacked = np.concatenate([frame[y:y+h, x:x+w] for frame in frames])
+        batch = [[] for frame in frames]
+        for k in detector.find(stacked, self._pipeline):
+            i = int(k.pt[1] // h)
+            top = k.pt[1] - i*h
+            # blobs cut by the edge between two windows belong to neither
+            if top - k.size/2 < 0 or top + k.size/2 > h:
+                continue
+            batch[i].append(cv2.KeyPoint(k.pt[0] + x, top + y, k.size))
+        found = [keypoints for keypoints in batch if len(keypoints) == 1]
+        if len(found) > 0:
+            self.hit(found[-1][0])
+        else:
+            self.miss()
+        return(results + batch)
+
+def pyramidFactor(width, height, minArea, minCoarseArea=100, minCoarseHeight=360):
+    # Largest downscale factor (4, 2 or 1) that keeps the smallest accepted nozzle
+    # at minCoarseArea pixels and the frame at least minCoarseHeight lines high
+    for factor in (4, 2):
+        if minArea / (factor * factor) >= minCoarseArea and min(width, height) / factor >= minCoarseHeight:
+            return(factor)
+    return(1)
+
+def _odd(value, minimum=3):
+    value = max(minimum, int(round(value)))
+    return(value if value % 2 == 1 else value + 1)
+
+class PyramidDetector:
+    # Coarse-to-fine nozzle detection for high resolution cameras.
+    #
+    # The frame is downscaled by factor, preprocessed and searched with the blur,
+    # threshold block and minimum area scaled to match. Each coarse hit is then
+    # refined at full resolution inside a small window around it.
+    # The coarse detector gets both area limits divided by factor squared, so a
+    # large nozzle is not dropped as too big. Coarse hits the full resolution
+    # pass does not confirm are dropped.
+    # detectorFactory(minArea, maxArea) must return a detector backend (see DetectorBackend).
+    def __init__(self, pipeline, detectorFactory, minArea, maxArea=5000, factor=2, refineFactor=3, minRefineHalfSize=32):
+        self.factor = int(factor)
+        self.refineFactor = refineFactor
+        self.minRefineHalfSize = minRefineHalfSize
+        self.fine = pipeline.clone()
+        self.fineDetector = detectorFactory(minArea, maxArea)
+        self.coarse = PreprocessPipeline(
+            gamma=pipeline.gamma,
+            blurSize=_odd(pipeline.blurSize / self.factor),
+            blurSigma=pipeline.blurSigma / self.factor,
+            blockSize=_odd(pipeline.blockSize / self.factor),
+            thresholdC=pipeline.thresholdC
+        )
+        scale = self.factor * self.factor
+        self.coarseDetector = detectorFactory(minArea / scale, maxArea / scale)
+        self._small = None
+
+    def _downscale(self, frame):
+        (height, width) = frame.shape[:2]
+        size = (width // self.factor, height // self.factor)
+        if self._small is None or self._small.shape[:2] != (size[1], size[0]) or self._small.shape[2:] != frame.shape[2:]:
+            self._small = np.empty((size[1], size[0]) + frame.shape[2:], np.uint8)
+        cv2.resize(frame, size, dst=self._small, interpolation=cv2.INTER_AREA)
+        return(self._small)
+
+    def detect(self, frame):
+        if self.factor <= 1:
+            return(self.fineDetector.find(frame, self.fine))
+        (height, width) = frame.shape[:2]
+        coarse = self.coarseDetector.find(self._downscale(frame), self.coarse)
+        keypoints = []
+        for keypoint in coarse:
+            # centre of the block of full resolution pixels behind the coarse pixel
+            x = keypoint.pt[0] * self.factor + (self.factor - 1) / 2
+            y = keypoint.pt[1] * self.factor + (self.factor - 1) / 2
+            half = int(max(self.minRefineHalfSize, self.refineFactor * keypoint.size * self.factor / 2))
+            left, top = max(int(x) - half, 0), max(int(y) - half, 0)
+            right, bottom = min(int(x) + half, width), min(int(y) + half, height)
+            refined = self.fineDetector.find(frame[top:bottom, left:right], self.fine)
+            if len(refined) > 0:
+                best = min(refined, key=lambda k: np.hypot(k.pt[0] + left - x, k.pt[1] + top - y))
+                keypoints.append(cv2.KeyPoint(best.pt[0] + left, best.pt[1] + top, best.size))
+        return(keypoints)
+
+class CentroidEstimator:
+    # Sub-pixel nozzle centre with an uncertainty estimate.
+    #
+    # Blob keypoints come from a thresholded image, so edge pixels are either in
+    # or out, and the position is rounded before use. Here the grey levels
+    # around the keypoint are used instead: the opening radius is taken from the
+    # radial profile (the keypoint size may belong to the ring around it), then
+    # every pixel inside the opening is weighted by how dark it is between the
+    # opening and the bright ring (partial pixels on the edge count partially)
+    # and the centre is the weighted mean position.
+    # The uncertainty (1 sigma per axis, pixels) propagates the noise measured
+    # inside the opening through the edge pixels, which are the only ones that
+    # move the centre. Low contrast falls back to the keypoint with half a pixel.
+    def __init__(self, searchFactor=1.5, diskFactor=1.25, minContrast=20, minSigma=0.01):
+        self.searchFactor = searchFactor
+        self.diskFactor = diskFactor
+        self.minContrast = minContrast
+        self.minSigma = minSigma
+
+    def estimate(self, frame, keypoint):
+        # Returns (x, y, sigma) in frame coordinates
+        (px, py) = keypoint.pt
+        fallback = (float(px), float(py), 0.5)
+        search = max(keypoint.size / 2, 4.0) * self.searchFactor
+        (height, width) = frame.shape[:2]
+        half = int(np.ceil(search)) + 2
+        left, top = max(int(px) - half, 0), max(int(py) - half, 0)
+        right, bottom = min(int(px) + half + 1, width), min(int(py) + half + 1, height)
+        window = frame[top:bottom, left:right]
+        if window.ndim == 3:
+            window = cv2.cvtColor(window, cv2.COLOR_BGR2GRAY)
+        luma = window.astype(np.float32)
+        ys, xs = np.mgrid[top:bottom, left:right].astype(np.float32)
+        distance = np.hypot(xs - px, ys - py)
+        inside = distance < search
+        core = luma[distance < 2.5]
+        if core.size < 4:
+            return(fallback)
+        dark = np.median(core)
+        bright = np.percentile(luma[inside], 95)
+        contrast = bright - dark
+        if contrast < self.minContrast:
+            return(fallback)
+        # opening radius: first ring of the radial profile brighter than halfway
+        bins = distance.astype(np.int32)[inside]
+        profile = np.bincount(bins, luma[inside]) / np.maximum(np.bincount(bins), 1)
+        outside = np.nonzero(profile > dark + contrast / 2)[0]
+        if len(outside) == 0 or outside[0] < 2:
+            return(fallback)
+        radius = float(outside[0])
+        weights = np.clip((bright - luma) / contrast, 0, 1)
+        weights[distance > radius * self.diskFactor] = 0
+        total = weights.sum()
+        if total <= 0:
+            return(fallback)
+        x = float((weights * xs).sum() / total)
+        y = float((weights * ys).sum() / total)
+        # only pixels on the ramp respond to noise
+        edge = (weights > 0) & (weights < 1)
+        noise = np.std(luma[distance < radius * 0.7]) / contrast
+        varX = (noise**2) * np.sum(((xs - x)**2)[edge]) / total**2
+        varY = (noise**2) * np.sum(((ys - y)**2)[edge]) / total**2
+        sigma = max(float(np.sqrt((varX + varY) / 2)), self.minSigma)
+        return(x, y, sigma)
+
+class CentroidBurst:
+    # Robust centre of a static nozzle from a burst of detections.
+    #
+    # The centre is the trimmed mean of the (x, y) estimates, the spread a
+    # robust standard deviation (scaled median absolute deviation, at least the
+    # per-detection sigma) and the standard error their ratio to the square root
+    # of the frames kept. A burst is done once it has size frames and the
+    # standard error is below targetError, or maxFrames frames. After each burst
+    # size adapts to the jitter seen, so steady setups use minFrames.
+    def __init__(self, minFrames=3, maxFrames=12, targetError=0.05, trim=0.2):
+        self.minFrames = minFrames
+        self.maxFrames = maxFrames
+        self.targetError = targetError
+        self.trim = trim
+        self.size = minFrames
+        self.reset()
+
+    def reset(self):
+        self.estimates = []
+
+    def add(self, x, y, sigma):
+        self.estimates.append((x, y, sigma))
+
+    @property
+    def count(self):
+        return(len(self.estimates))
+
+    def _kept(self):
+        return(max(1, self.count - 2*int(self.count * self.trim)))
+
+    def spread(self):
+        if self.count == 0:
+            return(np.inf)
+        e = np.asarray(self.estimates)
+        mad = np.median(np.abs(e[:,:2] - np.median(e[:,:2], axis=0)), axis=0) * 1.4826
+        return(float(max(mad.max(), np.median(e[:,2]))))
+
+    def standardError(self):
+        return(float(self.spread() / np.sqrt(self._kept())))
+
+    def needed(self):
+        # frames to grab before the next check
+        if self.done():
+            return(0)
+        return(max(1, self.size - self.count))
+
+    def done(self):
+        if self.count >= self.maxFrames:
+            return(True)
+        return(self.count >= self.size and self.standardError() <= self.targetError)
+
+    def result(self):
+        # Returns (x, y, spread, standard error) and adapts the next burst size
+        e = np.sort(np.asarray(self.estimates)[:,:2], axis=0)
+        cut = int(self.count * self.trim)
+        (x, y) = e[cut:self.count-cut].mean(axis=0)
+        spread = self.spread()
+        error = self.standardError()
+        frames = int(np.ceil((spread / self.targetError)**2 / (1 - 2*self.trim)))
+        self.size = int(min(max(frames, self.minFrames), self.maxFrames))
+        return(float(x), float(y), spread, error)
+
+class SettleDetector:
+    # Tells from the camera image when the machine has stopped moving.
+    #
+    # The shift between consecutive frames is measured with phase correlation on
+    # a small grey copy of the frame (or of a window around the nozzle), scaled
+    # back to full resolution pixels. The image has settled once it was seen
+    # moving and then frames shifts in a row stayed below threshold pixels, so
+    # ringing after the move is waited out while a steady image is measured
+    # straight away. If no motion shows up within startFrames (a move too small
+    # to see, or none at all) moved stays False and the caller decides.
+    def __init__(self, threshold=0.25, frames=3, size=256, startFrames=10, maxFrames=90, minResponse=0.05):
+        self.threshold = threshold
+        self.frames = frames
+        self.size = size
+        self.startFrames = startFrames
+        self.maxFrames = maxFrames
+        self.minResponse = minResponse
+        self.small = np.empty((size, size, 3), np.uint8)
+        self.grey = np.empty((size, size), np.uint8)
+        self.current = np.empty((size, size), np.float32)
+        self.previous = np.empty((size, size), np.float32)
+        self.hanning = cv2.createHanningWindow((size, size), cv2.CV_32F)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.still = 0
+        self.moved = False
+        self.shift = 0.0
+        self.region = None
+
+    def add(self, frame, window=None):
+        # Add the next frame; window (x, y, w, h) limits the comparison to a region.
+        # Returns True once the image has settled.
+        if window is not None:
+            (x, y, w, h) = window
+            frame = frame[y:y+h, x:x+w]
+        (height, width) = frame.shape[:2]
+        if frame.ndim == 3:
+            cv2.resize(frame, (self.size, self.size), dst=self.small, interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.grey)
+        else:
+            cv2.resize(frame, (self.size, self.size), dst=self.grey, interpolation=cv2.INTER_AREA)
+        (self.current, self.previous) = (self.previous, self.current)
+        np.copyto(self.current, self.grey)
+        region = (window, width, height)
+        self.count += 1
+        if self.region != region:
+            # first frame, or the region changed: nothing to compare with yet
+            self.region = region
+            self.still = 0
+            return(False)
+        ((dx, dy), response) = cv2.phaseCorrelate(self.previous, self.current, self.hanning)
+        self.shift = float(np.hypot(dx * width / self.size, dy * height / self.size))
+        if response < self.minResponse or self.shift >= self.threshold:
+            # a weak peak says nothing about motion, it only delays settling
+            if response >= self.minResponse and self.shift >= 2 * self.threshold:
+                self.moved = True
+            self.still = 0
+        else:
+            self.still += 1
+        return(self.settled)
+
+    @property
+    def settled(self):
+        return(self.moved and self.still >= self.frames)
+
+    @property
+    def done(self):
+        # stop watching: settled, no motion seen in time, or too many frames
+        return(self.settled or (not self.moved and self.count >= self.startFrames) or self.count >= self.maxFrames)
+
+def combineEstimates(estimates):
+    # Inverse variance weighted mean of (x, y, sigma) estimates: returns (x, y, sigma)
+    estimates = np.asarray(estimates, dtype=float).reshape(-1, 3)
+    weights = 1 / np.square(estimates[:,2])
+    total = weights.sum()
+    x = float((weights * estimates[:,0]).sum() / total)
+    y = float((weights * estimates[:,1]).sum() / total)
+    return(x, y, float(np.sqrt(1 / total)))
+
+def createBlobDetector(binary=True, th1=1, th2=50, thstep=1, minArea=600, maxArea=5000, minCircularity=0.8):
+    # Parameters used by TAMV for nozzle detection. binary=True returns the single
+    # pass BinaryBlobDetector, otherwise the original SimpleBlobDetector sweep.
+    if binary:
+        return(BinaryBlobDetector(minArea=minArea, maxArea=maxArea, minCircularity=minCircularity))
+    params = cv2.SimpleBlobDetector_Params()
+    # Thresholds
+    params.minThreshold = th1
+    params.maxThreshold = th2
+    params.thresholdStep = thstep
+    # Area
+    params.filterByArea = True
+    params.minArea = minArea
+    params.maxArea = maxArea
+    # Circularity
+    params.filterByCircularity = True
+    params.minCircularity = minCircularity
+    params.maxCircularity= 1
+    # Convexity
+    params.filterByConvexity = True
+    params.minConvexity = 0.3
+    params.maxConvexity = 1
+    # Inertia
+    params.filterByInertia = True
+    params.minInertiaRatio = 0.3
+    return(cv2.SimpleBlobDetector_create(params))
+
+class DetectorBackend:
+    # Nozzle detector interface used by NozzleTracker, PyramidDetector and the GUI.
+    #
+    # find(image, pipeline) returns cv2.KeyPoint objects (pt = centre, size =
+    # diameter of the nozzle opening) for a full frame or a window of one, using
+    # the pipeline's buffers. cost is the approximate time per frame relative to
+    # the blob backend, so callers can pick the cheapest adequate backend;
+    # compareBackends() measures the real figures on recorded frames.
+    # batchable backends can run on several windows stacked into one image.
+    name = ''
+    cost = 1.0
+    batchable = True
+
+    def find(self, image, pipeline):
+        raise NotImplementedError
+
+    def reset(self):
+        # forget anything learned about the current nozzle (eg. on a tool change)
+        pass
+
+class BlobBackend(DetectorBackend):
+    # Blob detection on the binarized frame (BinaryBlobDetector or SimpleBlobDetector)
+    name = 'blob'
+    cost = 1.0
+
+    def __init__(self, detector):
+        self.detector = detector
+
+    def find(self, image, pipeline):
+        return(self.detector.detect(pipeline.process(image)))
+
+class HoughBackend(DetectorBackend):
+    # cv2.HoughCircles on the blurred luma plane, radius range from the blob area
+    # limits. Concentric circles (opening and ring) are merged to the innermost.
+    name = 'hough'
+    cost = 0.4
+
+    def __init__(self, minArea=600, maxArea=5000, cannyThreshold=60, accumulatorThreshold=18):
+        self.minRadius = int(np.floor(np.sqrt(minArea / np.pi)))
+        self.maxRadius = int(np.ceil(np.sqrt(maxArea / np.pi)))
+        self.cannyThreshold = cannyThreshold
+        self.accumulatorThreshold = accumulatorThreshold
+
+    def find(self, image, pipeline):
+        pipeline.process(image)
+        circles = cv2.HoughCircles(pipeline.blurred, cv2.HOUGH_GRADIENT, 1, self.minRadius,
+            param1=self.cannyThreshold, param2=self.accumulatorThreshold,
+            minRadius=self.minRadius, maxRadius=self.maxRadius)
+        if circles is None:
+            return([])
+        keypoints = []
+        for (x, y, r) in circles[0]:
+            # the nozzle opening is dark: its centre must be black in the binary image
+            px, py = int(round(x)), int(round(y))
+            if 0 <= py < pipeline.binary.shape[0] and 0 <= px < pipeline.binary.shape[1] and pipeline.binary[py,px] == 0:
+                keypoints.append(cv2.KeyPoint(float(x), float(y), float(2*r)))
+        return(mergeKeypoints(keypoints))
+
+class EllipseBackend(DetectorBackend):
+    # Least squares ellipse fit (cv2.fitEllipse) to every contour of the binary
+    # image within the area limits. Accepts contours whose minor/major axis ratio
+    # is at least minRatio and whose area matches the fitted ellipse within
+    # maxAreaError, which tolerates a nozzle seen at an angle.
+    name = 'ellipse'
+    cost = 1.1
+
+    def __init__(self, minArea=600, maxArea=5000, minRatio=0.8, maxAreaError=0.1):
+        self.minArea = minArea
+        self.maxArea = maxArea
+        self.minRatio = minRatio
+        self.maxAreaError = maxAreaError
+
+    def find(self, image, pipeline):
+        binary = pipeline.process(image)
+        contours, hierarchy = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+        minPoints = 2 * np.sqrt(np.pi * self.minArea) / np.sqrt(2)
+        keypoints = []
+        for contour in contours:
+            if len(contour) < max(5, minPoints):
+                continue
+            area = cv2.contourArea(contour)
+            if area < self.minArea or area >= self.maxArea:
+                continue
+            ((x, y), (a, b), angle) = cv2.fitEllipse(contour)
+            if min(a, b) < self.minRatio * max(a, b):
+                continue
+            if abs(area - np.pi * a * b / 4) > self.maxAreaError * area:
+                continue
+            px, py = int(round(x)), int(round(y))
+            if 0 <= py < binary.shape[0] and 0 <= px < binary.shape[1] and binary[py,px] == 0:
+                keypoints.append(cv2.KeyPoint(float(x), float(y), float((a + b) / 2)))
+        return(mergeKeypoints(keypoints))
+
+class TemplateBackend(DetectorBackend):
+    # Normalized cross-correlation (cv2.TM_CCOEFF_NORMED) against the last good
+    # nozzle image. Until a template exists, and whenever the match score drops
+    # below minScore, the seed backend finds the nozzle and its neighbourhood
+    # becomes the template. The peak is refined to sub-pixel by a parabola fit.
+    name = 'template'
+    cost = 0.7
+    batchable = False
+
+    def __init__(self, seed, minScore=0.7, templateFactor=1.5):
+        self.seed = seed
+        self.minScore = minScore
+        self.templateFactor = templateFactor
+        self.reset()
+
+    def reset(self):
+        self.template = None
+        self.size = 0
+        self.seed.reset()
+
+    def _learn(self, luma, keypoint):
+        half = int(np.ceil(keypoint.size / 2 * self.templateFactor))
+        px, py = int(round(keypoint.pt[0])), int(round(keypoint.pt[1]))
+        if px - half < 0 or py - half < 0 or px + half >= luma.shape[1] or py + half >= luma.shape[0]:
+            return
+        self.template = luma[py-half:py+half+1, px-half:px+half+1].copy()
+        # template centre relative to the keypoint, keeps the sub-pixel part
+        self.offset = (keypoint.pt[0] - px, keypoint.pt[1] - py)
+        self.size = keypoint.size
+
+    def _seed(self, image, pipeline):
+        keypoints = self.seed.find(image, pipeline)
+        if len(keypoints) == 1:
+            # pipeline.luma is gamma corrected in place, which matching uses as well
+            self._learn(pipeline.luma, keypoints[0])
+        return(keypoints)
+
+    def find(self, image, pipeline):
+        if self.template is None:
+            return(self._seed(image, pipeline))
+        luma = pipeline.toLuma(image)
+        cv2.LUT(luma, gammaTable(pipeline.gamma), dst=luma)
+        (th, tw) = self.template.shape
+        if luma.shape[0] < th or luma.shape[1] < tw:
+            return([])
+        scores = cv2.matchTemplate(luma, self.template, cv2.TM_CCOEFF_NORMED)
+        (minValue, maxValue, minLoc, (mx, my)) = cv2.minMaxLoc(scores)
+        if maxValue < self.minScore:
+            self.template = None
+            return(self._seed(image, pipeline))
+        dx = dy = 0.0
+        if 0 < mx < scores.shape[1] - 1:
+            (l, c, r) = scores[my, mx-1:mx+2]
+            if l - 2*c + r < 0:
+                dx = 0.5 * (l - r) / (l - 2*c + r)
+        if 0 < my < scores.shape[0] - 1:
+            (t, c, b) = scores[my-1:my+2, mx]
+            if t - 2*c + b < 0:
+                dy = 0.5 * (t - b) / (t - 2*c + b)
+        x = mx + dx + tw // 2 + self.offset[0]
+        y = my + dy + th // 2 + self.offset[1]
+        return([cv2.KeyPoint(float(x), float(y), float(self.size))])
+
+# backend name -> class. Declared costs are from compareBackends() on 640x480
+# synthetic frames; template matching includes seeding from the blob backend.
+detectorBackends = { 'blob': BlobBackend, 'ellipse': EllipseBackend, 'template': TemplateBackend, 'hough': HoughBackend }
+
+def createBackend(name='blob', binary=True, th1=1, th2=50, thstep=1, minArea=600, maxArea=5000, minCircularity=0.8):
+    # Detector backend from the detection settings. minCircularity (0.8, or 0.3
+    # with the loose setting) is the minimum axis ratio for the ellipse backend;
+    # the template backend is seeded by the blob backend.
+    blob = BlobBackend(createBlobDetector(binary=binary, th1=th1, th2=th2, thstep=thstep, minArea=minArea, maxArea=maxArea, minCircularity=minCircularity))
+    if name == 'blob':
+        return(blob)
+    elif name == 'hough':
+        return(HoughBackend(minArea=minArea, maxArea=maxArea))
+    elif name == 'ellipse':
+        return(EllipseBackend(minArea=minArea, maxArea=maxArea, minRatio=minCircularity))
+    elif name == 'template':
+        return(TemplateBackend(blob))
+    raise ValueError('Unknown detector backend: ' + str(name))
+
+def legacyPreprocess(frame, gamma=1.2):
+    # original analyzeFrame preprocessing, kept for benchmarking
+    invGamma = 1.0 / gamma
+    table = np.array([((i / 255.0) ** invGamma) * 255
+        for i in np.arange(0, 256)]).astype('uint8')
+    frame = cv2.LUT(frame, table)
+    yuv = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV)
+    yuvPlanes = list(cv2.split(yuv))
+    yuvPlanes[0] = cv2.GaussianBlur(yuvPlanes[0],(7,7),6)
+    yuvPlanes[0] = cv2.adaptiveThreshold(yuvPlanes[0],255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,35,1)
+    return(cv2.cvtColor(yuvPlanes[0],cv2.COLOR_GRAY2BGR))
+
+def syntheticFrame(width, height, radius=None, center=None, noise=30, seed=0):
+    # mid-grey background with a bright nozzle ring around a dark opening,
+    # drawn with sub-pixel precision. Used by the benchmarks.
+    rng = np.random.default_rng(seed)
+    frame = np.full((height, width, 3), 120, np.uint8)
+    if center is None:
+        center = (width/2, height/2)
+    if radius is None:
+        radius = max(8, height/32)
+    # 4 fractional bits
+    cx, cy = int(round(center[0]*16)), int(round(center[1]*16))
+    cv2.circle(frame, (cx,cy), int(round(radius*1.8*16)), (220,220,220), -1, cv2.LINE_AA, 4)
+    cv2.circle(frame, (cx,cy), int(round(radius*16)), (40,40,40), -1, cv2.LINE_AA, 4)
+    frame = cv2.add(frame, rng.integers(0, noise, frame.shape, dtype=np.uint8))
+    return(frame)
+
+def _timeit(function, frame, repeats):
+    function(frame)
+    start = time.perf_counter()
+    for i in range(repeats):
+        function(frame)
+    return((time.perf_counter() - start) / repeats * 1000)
+
+def benchmarkPreprocess(resolutions=((640,480),(1920,1080)), repeats=50):
+    pipeline = PreprocessPipeline()
+    results = []
+    for (width, height) in resolutions:
+        frame = syntheticFrame(width, height)
+        legacy_ms = _timeit(legacyPreprocess, frame, repeats)
+        pipeline_ms = _timeit(pipeline.process, frame, repeats)
+        results.append((width, height, legacy_ms, pipeline_ms))
+        print('Preprocess {0}x{1}: legacy {2:7.2f} ms/frame, pipeline {3:7.2f} ms/frame ({4:4.1f}x)'.format(width, height, legacy_ms, pipeline_ms, legacy_ms/pipeline_ms))
+    return(results)
+
+def loadFrames(path, limit=0):
+    # Load recorded frames from a directory of images or from a video file
+    import os
+    frames = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(('.png','.jpg','.jpeg','.bmp','.tif','.tiff')):
+                frame = cv2.imread(os.path.join(path, name))
+                if frame is not None:
+                    frames.append(frame)
+            if limit > 0 and len(frames) >= limit:
+                break
+    else:
+        cap = cv2.VideoCapture(path)
+        while limit <= 0 or len(frames) < limit:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+    logger.info('Loaded ' + str(len(frames)) + ' frames from ' + str(path))
+    return(frames)
+
+def syntheticFrames(width=640, height=480, count=50, radius=None, seed=0):
+    # nozzle frames with random sub-pixel offsets around the image centre
+    rng = np.random.default_rng(seed)
+    if radius is None:
+        radius = max(8, height/32)
+    frames = []
+    for i in range(count):
+        center = (width/2 + rng.uniform(-40,40), height/2 + rng.uniform(-40,40))
+        frames.append(syntheticFrame(width, height, radius=radius, center=center, seed=seed+i))
+    return(frames)
+
+def compareBlobDetectors(frames, minArea=600, minCircularity=0.8):
+    # Run the SimpleBlobDetector sweep and the single pass BinaryBlobDetector on
+    # the same preprocessed frames and report latency, detection rate and the
+    # centroid difference between them.
+    pipeline = PreprocessPipeline()
+    binaries = [pipeline.process(frame).copy() for frame in frames]
+    detectors = [
+        ('SimpleBlobDetector', createBlobDetector(binary=False, minArea=minArea, minCircularity=minCircularity)),
+        ('BinaryBlobDetector', createBlobDetector(binary=True, minArea=minArea, minCircularity=minCircularity))
+    ]
+    results = {}
+    for (name, detector) in detectors:
+        positions = []
+        start = time.perf_counter()
+        for binary in binaries:
+            keypoints = detector.detect(binary)
+            positions.append(keypoints[0].pt if len(keypoints) == 1 else None)
+        elapsed = (time.perf_counter() - start) / max(1,len(binaries)) * 1000
+        results[name] = (elapsed, positions)
+    (reference_ms, reference) = results['SimpleBlobDetector']
+    (binary_ms, candidate) = results['BinaryBlobDetector']
+    detected = [p is not None for p in reference], [p is not None for p in candidate]
+    errors = [np.hypot(a[0]-b[0], a[1]-b[1]) for a, b in zip(reference, candidate) if a is not None and b is not None]
+    report = {
+        'frames': len(binaries),
+        'reference_ms': reference_ms,
+        'binary_ms': binary_ms,
+        'reference_rate': np.mean(detected[0]) if len(binaries) else 0,
+        'binary_rate': np.mean(detected[1]) if len(binaries) else 0,
+        'agreement': np.mean([a == b for a, b in zip(*detected)]) if len(binaries) else 0,
+        'mean_error': np.mean(errors) if len(errors) else 0,
+        'max_error': np.max(errors) if len(errors) else 0
+    }
+    print('Blob detection on ' + str(report['frames']) + ' frames:')
+    print('  SimpleBlobDetector: {0:8.2f} ms/frame, single detection rate {1:5.1f}%'.format(reference_ms, report['reference_rate']*100))
+    print('  BinaryBlobDetector: {0:8.2f} ms/frame, single detection rate {1:5.1f}%'.format(binary_ms, report['binary_rate']*100))
+    print('  Agreement {0:5.1f}%, centroid difference mean {1:.3f}px max {2:.3f}px'.format(report['agreement']*100, report['mean_error'], report['max_error']))
+    return(report)
+
+def comparePyramid(frames, minArea=600, minCircularity=0.8):
+    # Full frame detection against coarse-to-fine detection at the automatically
+    # chosen pyramid factor: latency, detection rate and centroid difference.
+    (height, width) = frames[0].shape[:2]
+    factor = pyramidFactor(width, height, minArea)
+    pipeline = PreprocessPipeline()
+    detector = BlobBackend(createBlobDetector(binary=True, minArea=minArea, minCircularity=minCircularity))
+    pyramid = PyramidDetector(pipeline, lambda area, maxArea: createBackend('blob', minArea=area, maxArea=maxArea, minCircularity=minCircularity), minArea, factor=factor)
+    results = []
+    for function in (lambda frame: detector.find(frame, pipeline), pyramid.detect):
+        positions = []
+        start = time.perf_counter()
+        for frame in frames:
+            keypoints = function(frame)
+            positions.append(keypoints[0].pt if len(keypoints) == 1 else None)
+        results.append(((time.perf_counter() - start) / len(frames) * 1000, positions))
+    ((full_ms, full), (pyramid_ms, coarse)) = results
+    errors = [np.hypot(a[0]-b[0], a[1]-b[1]) for a, b in zip(full, coarse) if a is not None and b is not None]
+    print('Pyramid detection on ' + str(len(frames)) + ' frames of ' + str(width) + 'x' + str(height) + ', factor ' + str(factor) + ':')
+    print('  full frame: {0:8.2f} ms/frame, single detection rate {1:5.1f}%'.format(full_ms, np.mean([p is not None for p in full])*100))
+    print('  pyramid:    {0:8.2f} ms/frame, single detection rate {1:5.1f}%'.format(pyramid_ms, np.mean([p is not None for p in coarse])*100))
+    if len(errors):
+        print('  centroid difference mean {0:.3f}px max {1:.3f}px'.format(np.mean(errors), np.max(errors)))
+    return(full_ms, pyramid_ms, errors)
+
+def compareCentroids(width=640, height=480, count=50, radius=16, noise=30, seed=0):
+    # Centroid error against the known centre of synthetic frames: rounded
+    # keypoint (the old analyzeFrame output), keypoint and CentroidEstimator.
+    pipeline = PreprocessPipeline()
+    detector = createBlobDetector(binary=True)
+    estimator = CentroidEstimator()
+    errors = {'rounded': [], 'keypoint': [], 'estimator': []}
+    sigmas = []
+    for (frame, truth) in zip(*syntheticTruth(width, height, count, radius, noise, seed)):
+        keypoints = detector.detect(pipeline.process(frame))
+        if len(keypoints) != 1:
+            continue
+        (x, y, sigma) = estimator.estimate(frame, keypoints[0])
+        errors['rounded'].extend(np.around(keypoints[0].pt) - truth)
+        errors['keypoint'].extend(np.array(keypoints[0].pt) - truth)
+        errors['estimator'].extend(np.array((x, y)) - truth)
+        sigmas.append(sigma)
+    print('Centroid error on ' + str(len(sigmas)) + ' of ' + str(count) + ' frames of ' + str(width) + 'x' + str(height) + ' (per axis rms):')
+    for name in ('rounded', 'keypoint', 'estimator'):
+        print('  {0:9s} {1:.3f}px'.format(name, np.sqrt(np.mean(np.square(errors[name]))) if len(sigmas) else 0))
+    print('  estimated sigma {0:.3f}px'.format(np.mean(sigmas) if len(sigmas) else 0))
+    return(errors, sigmas)
+
+def syntheticTruth(width=640, height=480, count=50, radius=16, noise=30, seed=0):
+    # synthetic nozzle frames and their true centres
+    rng = np.random.default_rng(seed)
+    frames = []
+    truths = []
+    for i in range(count):
+        center = (width/2 + rng.uniform(-40,40), height/2 + rng.uniform(-40,40))
+        frames.append(syntheticFrame(width, height, radius=radius, center=center, noise=noise, seed=seed+i))
+        # syntheticFrame draws with 4 fractional bits
+        truths.append(tuple(np.around(np.array(center)*16)/16))
+    return(frames, truths)
+
+def syntheticSettle(width=640, height=480, latency=4, travel=60, travelFrames=6, ringing=4.0, decay=0.7, period=3.0, tail=30, noise=8, seed=0):
+    # Frames of a move as the camera sees it: still while the command is on its
+    # way, travel, then damped ringing. Returns (frames, offsets, idle) with the
+    # true x offset of every frame and the index of the first frame after the
+    # commanded motion ended (when the printer reports idle).
+    rng = np.random.default_rng(seed)
+    # textured printhead underside with the nozzle in the middle, larger than the frame
+    texture = cv2.GaussianBlur(rng.integers(0, 255, (height + 80, width + 2*travel + 80), dtype=np.uint8), (0, 0), 6)
+    texture = cv2.normalize(texture, None, 60, 180, cv2.NORM_MINMAX)
+    texture = cv2.cvtColor(texture, cv2.COLOR_GRAY2BGR)
+    nozzle = syntheticFrame(texture.shape[1], texture.shape[0], radius=16, noise=1, seed=seed)
+    mask = cv2.circle(np.zeros(texture.shape[:2], np.uint8), (texture.shape[1]//2, texture.shape[0]//2), 32, 255, -1)
+    texture[mask > 0] = nozzle[mask > 0]
+    offsets = [0.0] * latency
+    offsets += [ travel * (i + 1) / travelFrames for i in range(travelFrames) ]
+    idle = len(offsets)
+    offsets += [ travel + ringing * decay**k * np.cos(2 * np.pi * k / period) for k in range(1, tail) ]
+    frames = []
+    for offset in offsets:
+        shift = np.float32([[1, 0, -(travel/2 + 40) + offset], [0, 1, -40]])
+        frame = cv2.warpAffine(texture, shift, (width, height), flags=cv2.INTER_LINEAR)
+        frames.append(cv2.add(frame, rng.integers(0, noise, frame.shape, dtype=np.uint8)))
+    return(frames, offsets, idle)
+
+def compareSettle(threshold=0.25, tolerance=0.1, runs=5):
+    # Measurement start after a move: at printer idle, or when SettleDetector
+    # says the image stopped moving. Reports the frame index and how far the
+    # nozzle still was from its final position at that frame.
+    settle = SettleDetector(threshold=threshold)
+    rows = []
+    for seed in range(runs):
+        (frames, offsets, idle) = syntheticSettle(seed=seed)
+        final = offsets[-1]
+        steady = next(i for i in range(len(offsets)) if all(abs(o - final) < tolerance for o in offsets[i:]))
+        settle.reset()
+        seen = None
+        start = time.perf_counter()
+        for (i, frame) in enumerate(frames):
+            settle.add(frame)
+            if settle.done:
+                seen = i if settle.settled else None
+                break
+        elapsed = (time.perf_counter() - start) / (i + 1) * 1000
+        rows.append((idle, abs(offsets[idle] - final), seen, abs(offsets[seen] - final) if seen is not None else np.nan, steady, elapsed))
+    print('Settle detection, frame index of the measurement start and remaining motion:')
+    print('  idle frame   error    settled frame   error    truly steady   ms/frame')
+    for (idle, idleError, seen, seenError, steady, elapsed) in rows:
+        print('  {0:10d} {1:7.2f}px {2:12} {3:8.2f}px {4:12d} {5:10.2f}'.format(idle, idleError, str(seen), seenError, steady, elapsed))
+    return(rows)
+
+def compareBackends(frames, truths=None, minArea=600, minCircularity=0.8):
+    # Run every detector backend over the same frames and report latency, single
+    # detection rate and centroid error: against truths when given (synthetic
+    # frames), otherwise against the blob backend.
+    results = {}
+    for name in detectorBackends:
+        backend = createBackend(name, minArea=minArea, minCircularity=minCircularity)
+        pipeline = PreprocessPipeline()
+        positions = []
+        start = time.perf_counter()
+        for frame in frames:
+            keypoints = backend.find(frame, pipeline)
+            positions.append(keypoints[0].pt if len(keypoints) == 1 else None)
+        elapsed = (time.perf_counter() - start) / max(1,len(frames)) * 1000
+        results[name] = (backend.cost, elapsed, positions)
+    reference = truths if truths is not None else results['blob'][2]
+    print('Detector backends on ' + str(len(frames)) + ' frames, centroid error against ' + ('true centres' if truths is not None else 'blob backend') + ':')
+    report = {}
+    for name, (cost, elapsed, positions) in results.items():
+        errors = [np.hypot(a[0]-b[0], a[1]-b[1]) for a, b in zip(reference, positions) if a is not None and b is not None]
+        rate = np.mean([p is not None for p in positions]) if len(frames) else 0
+        rms = np.sqrt(np.mean(np.square(errors))) if len(errors) else np.nan
+        report[name] = { 'cost': cost, 'ms': elapsed, 'rate': rate, 'rms_error': rms }
+        print('  {0:9s} cost {1:3.1f}: {2:8.2f} ms/frame, single detection rate {3:5.1f}%, centroid error rms {4:.3f}px'.format(name, cost, elapsed, rate*100, rms))
+    return(report)
+
+def replayDetection(path, realtime=False, backend='blob', minArea=600, minCircularity=0.8, limit=0):
+    # Run the analyzeFrame detection path (tracker window, pyramid fallback,
+    # detector backend, sub-pixel estimate) over a replay (FrameSource.ReplaySource).
+    # Returns a list of per frame results:
+    #   { 'index', 'coords', 'keypoints': [(x, y, size)], 'estimate': (x, y, sigma) or None, 'ms' }
+    from FrameSource import ReplaySource
+    source = ReplaySource(path, realtime=realtime)
+    pipeline = PreprocessPipeline()
+    detector = createBackend(backend, minArea=minArea, minCircularity=minCircularity)
+    factor = pyramidFactor(source.width, source.height, minArea)
+    pyramid = PyramidDetector(pipeline, lambda area, maxArea: createBackend(backend, minArea=area, maxArea=maxArea, minCircularity=minCircularity), minArea, factor=factor) if factor > 1 else None
+    tracker = NozzleTracker()
+    estimator = CentroidEstimator()
+    results = []
+    seq = 0
+    source.start()
+    start = time.perf_counter()
+    try:
+        while limit <= 0 or len(results) < limit:
+            (seq, stamp, frame) = source.wait(afterSeq=seq, timeout=5)
+            if frame is None:
+                break
+            begin = time.perf_counter()
+            keypoints = tracker.detect(frame, pipeline, detector, fullFrame=pyramid.detect if pyramid is not None else None)
+            estimate = estimator.estimate(frame, keypoints[0]) if len(keypoints) == 1 else None
+            results.append({ 'index': source.index(seq), 'coords': source.coords(seq),
+                'keypoints': [ (k.pt[0], k.pt[1], k.size) for k in keypoints ], 'estimate': estimate,
+                'ms': (time.perf_counter() - begin) * 1000 })
+    finally:
+        source.release()
+    elapsed = time.perf_counter() - start
+    single = sum(1 for r in results if r['estimate'] is not None)
+    print('Replayed ' + str(len(results)) + ' of ' + str(source.count) + ' frames in {0:.2f}s ({1:.1f} frames/s{2})'.format(
+        elapsed, len(results) / max(elapsed, 1e-9), ', real time' if realtime else ''))
+    if len(results):
+        print('  detection {0:.2f} ms/frame, single detection rate {1:5.1f}%'.format(np.mean([r['ms'] for r in results]), 100 * single / len(results)))
+    return(results)
+
+def compareReplay(results, expected, tolerance=0.05):
+    # Regression check of replayDetection results against a stored run: frames
+    # whose detection count changed or whose estimate moved more than tolerance px.
+    expected = { r['index']: r for r in expected }
+    changed = []
+    for result in results:
+        reference = expected.get(result['index'])
+        if reference is None:
+            continue
+        if (reference['estimate'] is None) != (result['estimate'] is None) or len(reference['keypoints']) != len(result['keypoints']):
+            changed.append((result['index'], 'detection'))
+        elif result['estimate'] is not None:
+            shift = np.hypot(result['estimate'][0] - reference['estimate'][0], result['estimate'][1] - reference['estimate'][1])
+            if shift > tolerance:
+                changed.append((result['index'], 'moved {0:.3f}px'.format(shift)))
+    print('Regression check: ' + str(len(changed)) + ' of ' + str(len(results)) + ' frames changed')
+    for (index, reason) in changed[:10]:
+        print('  frame ' + str(index) + ': ' + reason)
+    return(changed)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='TAMV nozzle detection tools')
+    parser.add_argument('--benchmark', action='store_true', help='run the preprocessing microbenchmark')
+    parser.add_argument('--repeats', type=int, default=50, help='frames per benchmark run')
+    parser.add_argument('--compare', nargs='?', const='', default=None, metavar='FRAMES',
+        help='compare blob detectors on recorded frames (image directory or video file), synthetic frames if omitted')
+    parser.add_argument('--pyramid', nargs='?', const='', default=None, metavar='FRAMES',
+        help='compare full frame and coarse-to-fine detection, synthetic 1080p frames if omitted')
+    parser.add_argument('--backends', nargs='?', const='', default=None, metavar='FRAMES',
+        help='compare detector backends on recorded frames, synthetic frames with known centres if omitted')
+    parser.add_argument('--replay', metavar='PATH', help='run the detection path over a recorded replay (see FrameSource.ReplaySource)')
+    parser.add_argument('--realtime', action='store_true', help='replay at the recorded frame times instead of as fast as possible')
+    parser.add_argument('--backend', default='blob', help='detector backend for --replay')
+    parser.add_argument('--output', metavar='JSON', help='store --replay results')
+    parser.add_argument('--expect', metavar='JSON', help='compare --replay results with a stored run, exit status 1 on changes')
+    parser.add_argument('--centroid', action='store_true', help='centroid estimator error on synthetic frames')
+    parser.add_argument('--settle', action='store_true', help='vision settle detection against printer idle on synthetic moves')
+    parser.add_argument('--minArea', type=int, default=600, help='blob detector minimum area')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmarkPreprocess(repeats=args.repeats)
+    if args.compare is not None:
+        if len(args.compare) > 0:
+            frames = loadFrames(args.compare)
+        else:
+            frames = syntheticFrames(radius=16) + syntheticFrames(1920, 1080, count=10, radius=24)
+        compareBlobDetectors(frames, minArea=args.minArea)
+    if args.pyramid is not None:
+        if len(args.pyramid) > 0:
+            frames = loadFrames(args.pyramid)
+        else:
+            frames = syntheticFrames(1920, 1080, count=20, radius=16)
+        comparePyramid(frames, minArea=args.minArea)
+    if args.centroid:
+        compareCentroids()
+    if args.settle:
+        compareSettle()
+    if args.backends is not None:
+        if len(args.backends) > 0:
+            compareBackends(loadFrames(args.backends), minArea=args.minArea)
+        else:
+            compareBackends(*syntheticTruth(), minArea=args.minArea)
+    if args.replay is not None:
+        import json
+        results = replayDetection(args.replay, realtime=args.realtime, backend=args.backend, minArea=args.minArea)
+        if args.output is not None:
+            with open(args.output, 'w') as outputfile:
+                json.dump(results, outputfile)
+        if args.expect is not None:
+            with open(args.expect, 'r') as inputfile:
+                if len(compareReplay(results, json.load(inputfile))) > 0:
+                    raise SystemExit(1)
+    if not args.benchmark and args.compare is None and args.pyramid is None and not args.centroid and not args.settle and args.backends is None and args.replay is None:
+        parser.print_help()
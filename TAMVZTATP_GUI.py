@@ -55,12 +55,21 @@ import cv2
 import numpy as np
 import math
 import DuetWebAPI as DWA
+import FrameSource
+from FrameSource import openFrameSource
+import NozzleDetection
+import AutoTune
+import CalibrationSchedule
+import CalibrationCheckpoint
+import MotionPlanner
+import UserSettings
+from CalibrationEngine import CalibrationEngine, CalibrationStopped, EngineListener
 from time import sleep, time
 import datetime
 import json
 import time
 import socket				#DM added for IP address resolution
-import ctypes                           #DM added for my OK nutton
+import queue
 
 # graphing imports
 import matplotlib
@@ -82,8 +91,6 @@ style_orange = 'background-color: dark-grey; color: orange;'
 # debug flags
 debugging_small_display = False
 
-global resultantOffset
-resultantOffset = []
 global toolZ_offset
 toolZ_offset = []
 
@@ -295,10 +302,7 @@ class CameraSettingsDialog(QDialog):
 
         # Camera Combobox
         self.camera_combo = QComboBox()
-        camera_description = str(video_src) + ': ' \
-            + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FRAME_WIDTH)) \
-            + 'x' + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) + ' @ ' \
-            + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FPS)) + 'fps'
+        camera_description = self.parent().video_thread.sourceDescription()
         self.camera_combo.addItem(camera_description)
         #self.camera_combo.currentIndexChanged.connect(self.parent().video_thread.changeVideoSrc)
         # Get cameras button
@@ -344,6 +348,12 @@ class CameraSettingsDialog(QDialog):
         self.hue_slider.setTickPosition(QSlider.TicksBelow)
         self.hue_slider.setTickInterval(1)
         self.hue_label = QLabel(str(int(hue_input)))
+        # Detection processes
+        self.processes_spinbox = QSpinBox()
+        self.processes_spinbox.setMinimum(0)
+        self.processes_spinbox.setMaximum(max(os.cpu_count() or 1, self.parent().detect_processes))
+        self.processes_spinbox.setValue(self.parent().detect_processes)
+        self.processes_spinbox.setToolTip('Worker processes for nozzle detection during calibration, 0 detects in the video thread.')
         # Reset button
         self.reset_button = QPushButton("Reset to defaults")
         self.reset_button.setToolTip('Reset camera settings to defaults.')
@@ -398,6 +408,12 @@ class CameraSettingsDialog(QDialog):
         self.hue_box.setLayout(hvbox)
         hvbox.addWidget(self.hue_slider)
         hvbox.addWidget(self.hue_label)
+        # Detection processes
+        self.processes_box =QGroupBox('Detection processes')
+        self.layout.addWidget(self.processes_box)
+        pvbox = QHBoxLayout()
+        self.processes_box.setLayout(pvbox)
+        pvbox.addWidget(self.processes_spinbox)
         # Reset button
         self.layout.addWidget(self.reset_button)
         self.layout.addWidget(self.save_button)
@@ -461,10 +477,7 @@ class CameraSettingsDialog(QDialog):
         index = 0
         self.camera_combo.clear()
         _cameras = []
-        original_camera_description = str(video_src) + ': ' \
-            + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FRAME_WIDTH)) \
-            + 'x' + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) + ' @ ' \
-            + str(self.parent().video_thread.cap.get(cv2.CAP_PROP_FPS)) + 'fps'
+        original_camera_description = self.parent().video_thread.sourceDescription()
         _cameras.append(original_camera_description)
         while i > 0:
             if index != video_src:
@@ -488,6 +501,8 @@ class CameraSettingsDialog(QDialog):
     def sendUserParameters(self):
         _tempSrc = self.camera_combo.currentText()
         _tempSrc = _tempSrc[:_tempSrc.find(':')]
+        self.parent().detect_processes = int(self.processes_spinbox.value())
+        self.parent().video_thread.detect_processes = self.parent().detect_processes
         self.parent().saveUserParameters(cameraSrc=_tempSrc)
         self.close()
 
@@ -513,6 +528,30 @@ class OverlayLabel(QLabel):
     def setText(self, textToDisplay):
         self.display_text = textToDisplay
 
+class WorkerListener(EngineListener):
+    # Passes the progress of the calibration engine on to the user interface as
+    # signals of the worker. The engine runs on the worker thread, so the signals
+    # are queued to the GUI thread: neither thread waits on the other.
+    showFrames = True
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def status(self, text):
+        self.worker.status_update.emit(text)
+
+    def message(self, text):
+        self.worker.message_update.emit(text)
+
+    def report(self, text):
+        self.worker.debug_update.emit(text)
+
+    def frame(self, frame, keypoints=None, center=None):
+        self.worker.change_pixmap_signal.emit(self.worker.decorate(frame, keypoints, center))
+
+    def result(self, result):
+        self.worker.result_update.emit(result)
+
 class CalibrateNozzles(QThread):
     # Signals
     status_update = pyqtSignal(str)
@@ -521,17 +560,21 @@ class CalibrateNozzles(QThread):
     calibration_complete = pyqtSignal()
     detection_error = pyqtSignal(str)
     result_update = pyqtSignal(object)
+    debug_update = pyqtSignal(str)
+    cp_captured = pyqtSignal(object)
 
     alignment = False
     _running = False
     display_crosshair = False
     detection_on = False
-    align_endstop = False
 
-    def __init__(self, parent=None, th1=1, th2=50, thstep=1, minArea=600, minCircularity=0.8,numTools=0,cycles=1, align=False):
+    def __init__(self, parent=None, th1=1, th2=50, thstep=1, minArea=600, minCircularity=0.8,numTools=0,cycles=1, align=False, backend='blob', binary=True, processes=0):
         super(QThread,self).__init__(parent=parent)
-        # transformation matrix
-        self.transform_matrix = []
+        # requests of the user interface (calibration runs, CP capture), run one
+        # after the other by the worker, see runRequest
+        self.requests = queue.Queue()
+        # calibration engine, created on the first request (see calibrationEngine)
+        self.engine = None
         self.xray = False
         self.loose = False
         self.detector_changed = False
@@ -540,6 +583,23 @@ class CalibrateNozzles(QThread):
         self.detect_thstep = thstep
         self.detect_minArea = minArea
         self.detect_minCircularity = minCircularity
+        # circularity used when loose detection is off
+        self.detect_circularity = minCircularity
+        # analyzeFrame feeds the detector a binary image, so use the single pass detector
+        self.detect_binary = binary
+        # detector backend: blob, ellipse, template or hough (see NozzleDetection.compareBackends)
+        self.detect_backend = backend
+        # frame preprocessing for nozzle detection, buffers are reused between frames
+        self.preprocessor = NozzleDetection.PreprocessPipeline(gamma=1.2)
+        # region of interest tracking, predicts the nozzle position after each move
+        self.tracker = NozzleDetection.NozzleTracker()
+        # coarse-to-fine detector for high resolution cameras, set up by createDetector
+        self.pyramid = None
+        # sub-pixel nozzle centre and its uncertainty (pixels, 1 sigma)
+        self.centroid = NozzleDetection.CentroidEstimator()
+        # worker processes for burst detection (DetectionPool), 0 detects in this thread
+        self.detect_processes = processes
+        self.xy_sigma = 0.5
         self.numTools = numTools
         self.cycles = cycles
         self.alignment = align
@@ -559,30 +619,13 @@ class CalibrateNozzles(QThread):
         self.saturation = -1
         self.hue = -1
 
-        # Start Video feed
-        self.cap = cv2.VideoCapture(video_src)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-        self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-        #self.cap.set(cv2.CAP_PROP_FPS,25)
-        self.brightness_default = self.cap.get(cv2.CAP_PROP_BRIGHTNESS)
-        self.contrast_default = self.cap.get(cv2.CAP_PROP_CONTRAST)
-        self.saturation_default = self.cap.get(cv2.CAP_PROP_SATURATION)
-        self.hue_default = self.cap.get(cv2.CAP_PROP_HUE)
-
-        self.ret, self.cv_img = self.cap.read()
-        if self.ret:
-            local_img = self.cv_img
-            self.change_pixmap_signal.emit(local_img)
-        else:
-            self.cap.open(video_src)
-            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-            self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-            #self.cap.set(cv2.CAP_PROP_FPS,25)
-            self.ret, self.cv_img = self.cap.read()
-            local_img = self.cv_img
-            self.change_pixmap_signal.emit(local_img)
+        # Video feed: frames are captured on their own thread into a ring buffer from
+        # the camera, or a recording (see FrameSource.ReplaySource) when video_src is a
+        # replay path. Probing a camera takes seconds, so it is opened by the worker
+        # as its first request (see openVideoSrc).
+        self.frames = None
+        self.cap = None
+        self.requests.put(('camera', video_src))
 
     def toggleXray(self):
         if self.xray:
@@ -594,30 +637,32 @@ class CalibrateNozzles(QThread):
         if self.loose:
             self.loose = False
         else: self.loose = True
+        if self.engine is not None:
+            self.engine.setDetection(self.engineDetection())
 
     def setProperty(self,brightness=-1, contrast=-1, saturation=-1, hue=-1):
         try:
             if int(brightness) >= 0:
                 self.brightness = brightness
-                self.cap.set(cv2.CAP_PROP_BRIGHTNESS,self.brightness)
+                self.frames.set(cv2.CAP_PROP_BRIGHTNESS,self.brightness)
         except Exception as b1: 
             logger.warning('Brightness exception: ' + str(b1) )
         try:
             if int(contrast) >= 0:
                 self.contrast = contrast
-                self.cap.set(cv2.CAP_PROP_CONTRAST,self.contrast)
+                self.frames.set(cv2.CAP_PROP_CONTRAST,self.contrast)
         except Exception as c1:
             logger.warning('Contrast exception: ' + str(c1) )
         try:
             if int(saturation) >= 0:
                 self.saturation = saturation
-                self.cap.set(cv2.CAP_PROP_SATURATION,self.saturation)
+                self.frames.set(cv2.CAP_PROP_SATURATION,self.saturation)
         except Exception as s1:
             logger.warning('Saturation exception: ' + str(s1) )
         try:
             if int(hue) >= 0:
                 self.hue = hue
-                self.cap.set(cv2.CAP_PROP_HUE,self.hue)
+                self.frames.set(cv2.CAP_PROP_HUE,self.hue)
         except Exception as h1:
             logger.warning('Hue exception: '  + str(h1) )
 
@@ -632,234 +677,177 @@ class CalibrateNozzles(QThread):
         self.createDetector()
         logger.debug('Alignment detector created.')
         while True:
-            if self.detection_on:
-                if self.alignment:
-                    logger.debug('Alignment active')
-                    try:
-                        logger.debug('Setting parameters for nozzle detection alignment algorithm..')
+            try:
+                if self.frames is None:
+                    # no video source (yet): wait for the next request
+                    (request, argument) = self.requests.get(timeout=0.5)
+                else:
+                    (request, argument) = self.requests.get_nowait()
+            except queue.Empty:
+                request = None
+            if request is not None:
+                self.runRequest(request, argument)
+            elif self.frames is None:
+                continue
+            elif self.detection_on:
+                # don't run alignment - fetch frames and detect only
+                try:
+                    self._running = True
+                    while self._running and self.detection_on and self.requests.empty():
+                        # Process runtime algorithm changes
                         if self.loose:
                             self.detect_minCircularity = 0.3
-                        else: self.detect_minCircularity = 0.8
+                        else: self.detect_minCircularity = self.detect_circularity
                         if self.detector_changed:
                             self.createDetector()
                             self.detector_changed = False
-                        self._running = True
-                        logger.debug('Algorithm parameters set, commencing calibration..')
-                        while self._running:
-                            self.cycles = self.parent().cycles
-                            for rep in range(self.cycles):
-                                for tool in range(self.parent().num_tools):
-                                    logger.debug('Processing events before tool')
-                                    # process GUI events
-                                    app.processEvents()
-                                    # Update status bar
-                                    self.status_update.emit('Calibrating T' + str(tool) + ', cycle: ' + str(rep+1) + '/' + str(self.cycles))
-                                    # Load next tool for calibration
-                                    logger.debug('Sending tool pickup to printer..' + 'T'+str(tool) )
-                                    self.parent().printer.gCode('T'+str(tool))
-                                    # Move tool to CP coordinates
-                                    logger.debug('XX - Jogging tool to calibration set point..')
-                                    self.parent().printer.gCode('G1 X' + str(self.parent().cp_coords['X']))
-                                    self.parent().printer.gCode('G1 Y' + str(self.parent().cp_coords['Y']))
-                                    self.parent().printer.gCode('G1 Z' + str(self.parent().cp_coords['Z']))
-                                    logger.debug('XX - Tool moved to calibration point.')
-                                    # Wait for moves to complete
-                                    while self.parent().printer.getStatus() not in 'idle':
-                                        logger.debug('XX - Waiting for printer idle status')
-                                        # process GUI events
-                                        app.processEvents()
-                                        logger.debug('XX - Fetching frame.')
-                                        self.ret, self.cv_img = self.cap.read()
-                                        if self.ret:
-                                            logger.debug('XX - Updating frame to GUI')
-                                            local_img = self.cv_img
-                                            self.change_pixmap_signal.emit(local_img)
-                                        else:
-                                            logger.debug('XX - Video source invalid, resetting.')
-                                            self.cap.open(video_src)
-                                            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-                                            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-                                            self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-                                            #self.cap.set(cv2.CAP_PROP_FPS,25)
-                                            self.ret, self.cv_img = self.cap.read()
-                                            local_img = self.cv_img
-                                            self.change_pixmap_signal.emit(local_img)
-                                            continue
-                                    # Update message bar
-                                    self.message_update.emit('Searching for nozzle..')
-                                    # Process runtime algorithm changes
-                                    if self.loose:
-                                        self.detect_minCircularity = 0.3
-                                    else: self.detect_minCircularity = 0.8
-                                    if self.detector_changed:
-                                        self.createDetector()
-                                        self.detector_changed = False
-                                    # Analyze frame for blobs
-                                    logger.debug('alignment analyzing frame..')
-                                    (c, transform, mpp) = self.calibrateTool(tool, rep)
-                                    logger.debug('alignment analyzing frame complete')
-
-
-
-                                    # Calibrate Z offset using knob sensor if it exists.
-                                    resultantOffset.append(toolZ_offset[tool])
-                                    if hasKnob:
-                                        try:
-                                            probeInfo = self.parent().printer.getModelQuery(["sensors","probes"])
-                                            if probeInfo[3]['value'][0] != 0:
-                                                logger.info('Sensor triggered before homing, ask user to correct')
-                                                # sensor is triggered before probing notify user to correct
-                                                ctypes.windll.user32.MessageBoxW(0, "Sensor triggered before homing, please correct and press a key", "Sensor triggered", 0)
-                                                probeInfo = self.parent().printer.getModelQuery(["sensors","probes"])
-                                                if probeInfo[3]['value'][0] != 0:
-                                                    logger.info('Sensor still triggered before homing, skipping z offset for this tool')
-                                                    break
-                                        except Exception as c1:
-                                            # sensor is triggered before probing notify user to correct
-                                            logger.warning( 'Data not returned, skipping z offset for this tool, Error was ' + str(c1) )
-                                            break
-                                        logger.debug('move to Knob sensor position of X:' + str(self.parent().cp_coords['X'] + 40) + ' Y:' + str(self.parent().cp_coords['Y']) + ' Z:' + str(self.parent().cp_coords['Z']))
-                                        savez = str(self.parent().cp_coords['Z'])
-                                        self.parent().printer.gCode('G1 X' + str(self.parent().cp_coords['X'] + 40))
-                                        while self.parent().printer.getStatus() not in 'idle':
-                                            # process GUI events
-                                            app.processEvents()
-                                        self.parent().printer.gCode('G30 S-1 K3')
-                                        while self.parent().printer.getStatus() not in 'idle':
-                                            # process GUI events
-                                            app.processEvents()
-                                        try:
-                                            # capture tool location in machine space before processing
-                                            currentPosition = self.parent().printer.getCoords()
-                                            logger.info('triggered at Z: ' + str(currentPosition['Z']) )
-                                            resultantOffset[tool] = round((toolZ_offset[tool] - probeHeight) - (currentPosition['Z'] - endstopPoint),3)
-                                            logger.info('original offset: ' + str(toolZ_offset[tool]))
-                                            logger.info('New calculated offset: ' + str(resultantOffset[tool]))
-                                        except Exception as c1:
-                                            currentPosition = None
-                                            logger.warning( 'Tool coordinates cannot be determined:' + str(c1) )
-                                        logger.debug('Moving carriage..')
-                                        self.parent().printer.gCode('G1 Z' + savez)
-                                        while self.parent().printer.getStatus() not in 'idle':
-                                            # process GUI events
-                                            app.processEvents()
-                                    # apply offsets to machine
-                                    app.processEvents()
-                                    toolZ_offset[tool] = resultantOffset[tool]
-                                    self.parent().printer.gCode( 'G10 P' + str(tool) + ' X' + str(c['X']) + ' Y' + str(c['Y']) + ' Z' + str(resultantOffset[tool]))
-                            # signal end of execution
-                            self._running = False
-                        # Update status bar
-                        self.status_update.emit('Calibration complete: Resetting machine.')
-                        # HBHBHB
-                        # Update debug window with results
-                        # self.parent().debugString += '\nCalibration output:\n'
-                        self.parent().printer.gCode('T-1')
-                        self.parent().printer.gCode('G1 X' + str(self.parent().cp_coords['X']))
-                        self.parent().printer.gCode('G1 Y' + str(self.parent().cp_coords['Y']))
-                        self.parent().printer.gCode('G1 Z' + str(self.parent().cp_coords['Z']))
-                        self.status_update.emit('Calibration complete: Done.')
-                        self.alignment = False
-                        self.detection_on = False
-                        self.display_crosshair = False
-                        self._running = False
-                        self.calibration_complete.emit()
-                    except Exception as mn1:
-                        self.alignment = False
-                        self.detection_on = False
-                        self.display_crosshair = False
-                        self._running = False
-                        self.detection_error.emit('Error 0x00: ' + str(mn1))
-                        logger.error('Error 0x00: ' + str(mn1))
-                        self.cap.release()
-                else:
-                    # don't run alignment - fetch frames and detect only
-                    try:
-                        if self.loose:
-                            self.detect_minCircularity = 0.3
-                        else: self.detect_minCircularity = 0.8
-                        self._running = True
-                        # transformation matrix
-                        #self.transform_matrix = []
-                        while self._running and self.detection_on:
-                            # Update status bar
-                            #self.status_update.emit('Detection mode: ON')
-                            # Process runtime algorithm changes
-                            if self.loose:
-                                self.detect_minCircularity = 0.3
-                            else: self.detect_minCircularity = 0.8
-                            if self.detector_changed:
-                                self.createDetector()
-                                self.detector_changed = False
-                            # Run detection and update output
-                            self.analyzeFrame()
-                            # process GUI events
-                            app.processEvents()
-                    except Exception as mn1:
-                        self._running = False
-                        self.detection_error.emit('Error 0x00a: ' + str(mn1))
-                        logger.error('Detection error (non-alignment cycle): ' + str(mn1))
-                        self.cap.release()
-            elif self.align_endstop:
+                        # Run detection and update output
+                        self.analyzeFrame()
+                except Exception as mn1:
+                    self._running = False
+                    self.detection_error.emit('Error 0x00a: ' + str(mn1))
+                    logger.error('Detection error (non-alignment cycle): ' + str(mn1))
+                    self.frames.release()
+            else:
+                try:
+                    # waits for the next captured frame, camera resets are handled by the grabber
+                    self.ret, self.cv_img = self.frames.read()
+                    if self.ret:
+                        local_img = self.cv_img
+                        self.change_pixmap_signal.emit(local_img)
+                except Exception as mn2:
+                    self.status_update.emit( 'Error 0x01: ' + str(mn2) )
+                    logger.error( 'Detection unhandled exception: ' + str(mn2))
+                    self.frames.release()
+                    self.detection_on = False
+                    self._running = False
+                    exit()
+        if self.frames is not None:
+            self.frames.release()
+
+    ####
+    # Requests of the user interface
+    ####
+
+    def startCalibration(self, checkpoint=None):
+        # calibration run of all tools, or the rest of an interrupted run
+        self.requests.put(('calibrate', checkpoint))
+
+    def startEndstop(self):
+        # CP centred on the endstop, signals cp_captured
+        self.requests.put(('endstop', None))
+
+    def startReference(self, cp):
+        # Z reference of the knob sensor (if there is one) for the CP
+        self.requests.put(('reference', dict(cp)))
+
+    def runRequest(self, request, argument):
+        # Runs a request on the calibration engine. Everything the user interface
+        # sees of it arrives through the (queued) signals.
+        if request == 'camera':
+            self.openVideoSrc(argument)
+            return
+        if self.frames is None:
+            self.detection_error.emit('Error 0x02: no video source')
+            return
+        engine = self.calibrationEngine()
+        self._running = True
+        try:
+            if request == 'calibrate':
+                self.alignment = True
+                self.calibrateTools(engine, argument)
+            elif request == 'endstop':
                 logger.debug('Starting auto-CP detection..')
                 self.status_update.emit('Starting auto-CP detection..')
-                self._running = True
-                while self._running:
-                    # process GUI events
-                    app.processEvents()
-                    # Update status bar
-                    self.status_update.emit('Self-calibrating CP...')
-                    # Unload tool to start and restore starting position
-                    self.cp_coords = self.parent().printer.getCoords()
-                    self.parent().printer.gCode('T-1')
-                    # Update message bar
-                    self.message_update.emit('Searching for endstop..')
-                    # Process runtime algorithm changes
-                    # Analyze frame for blobs
-                    self.calibrateTool(tool='endstop', rep=1)
-                    # process GUI events
-                    app.processEvents()
-                    self._running = False
-                    self.align_endstop = False
-                # Update status bar
+                cp = engine.captureCP(auto=True)
                 self.status_update.emit('CP auto-calibrated.')
-                self.parent().printer.gCode('T-1')
-                self.parent().printer.gCode('G1 X' + str(self.parent().cp_coords['X']))
-                self.parent().printer.gCode('G1 Y' + str(self.parent().cp_coords['Y']))
-                self.parent().printer.gCode('G1 Z' + str(self.parent().cp_coords['Z']))
-                self._running = False
                 logger.info('Controlled point has been automatically calibrated.')
-            else:
-                while not self.detection_on and not self.align_endstop:
-                    try:
-                        self.ret, self.cv_img = self.cap.read()
-                        if self.ret:
-                            local_img = self.cv_img
-                            self.change_pixmap_signal.emit(local_img)
-                        else:
-                            # reset capture
-                            self.cap.open(video_src)
-                            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-                            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-                            self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-                            #self.cap.set(cv2.CAP_PROP_FPS,25)
-                            self.ret, self.cv_img = self.cap.read()
-                            if self.ret:
-                                local_img = self.cv_img
-                                self.change_pixmap_signal.emit(local_img)
-                            continue
-                        app.processEvents()
-                    except Exception as mn2:
-                        self.status_update( 'Error 0x01: ' + str(mn2) )
-                        logger.error( 'Detection unhandled exception: ' + str(mn2))
-                        self.cap.release()
-                        self.detection_on = False
-                        self._running = False
-                        exit()
-                    app.processEvents()
-                app.processEvents()
-                continue
-        self.cap.release()
+                self.cp_captured.emit(cp)
+            elif request == 'reference':
+                engine.cp = argument
+                engine.probeReference()
+        except CalibrationStopped:
+            logger.info('Calibration stopped.')
+        except Exception as mn1:
+            self.detection_error.emit('Error 0x00: ' + str(mn1))
+            logger.error('Error 0x00: ' + str(mn1))
+            if request == 'calibrate' and CalibrationCheckpoint.loadCheckpoint() is not None:
+                logger.info('Calibration progress is saved in ' + CalibrationCheckpoint.defaultPath + ', start the calibration again to resume it.')
+        self.alignment = False
+        self.display_crosshair = False
+        self._running = False
+
+    def calibrateTools(self, engine, checkpoint):
+        parent = self.parent()
+        self.cycles = parent.cycles
+        engine.cp = dict(parent.cp_coords)
+        engine.zOffsets = list(toolZ_offset)
+        if checkpoint is None:
+            # order of the tool alignments, as few tool changes as the schedule allows
+            steps = CalibrationSchedule.schedule(parent.num_tools, self.cycles, parent.schedule_strategy, parent.schedule_redock)
+            logger.info('Calibration schedule: ' + parent.schedule_strategy + ', estimated run times:')
+            for line in engine.costs.report(parent.num_tools, self.cycles, parent.schedule_redock):
+                logger.info('  ' + line)
+            # progress is saved after every step, see CalibrationCheckpoint
+            adaptive = dict(parent.adaptive_settings) if parent.schedule_adaptive else None
+            if adaptive is not None:
+                logger.info('Adaptive cycles: up to ' + str(self.cycles) + ' per tool, until the offsets are known to +/-' + str(adaptive['target']) + 'mm')
+            checkpoint = CalibrationCheckpoint.Checkpoint(parent.printerURL, engine.cp, parent.num_tools,
+                self.cycles, steps, parent.schedule_strategy, parent.schedule_redock, adaptive=adaptive)
+        else:
+            logger.info('Resuming calibration run at step ' + str(checkpoint.position + 1) + ' of ' + str(len(checkpoint.steps)))
+        engine.calibrate(checkpoint)
+        CalibrationSchedule.saveCosts(engine.costs)
+        checkpoint.clear()
+        self.status_update.emit('Calibration complete: Done.')
+        self.detection_on = False
+        self.calibration_complete.emit()
+
+    def calibrationEngine(self):
+        # The engine keeps the camera calibration from run to run, the printer,
+        # travel moves and run costs are those of the current connection
+        parent = self.parent()
+        if self.engine is None:
+            self.engine = CalibrationEngine(parent.printer, self.frames, camera_width, camera_height,
+                detection=self.engineDetection(), listener=WorkerListener(self), workers=self.detect_processes)
+        self.engine.printer = parent.printer
+        self.engine.setWorkers(self.detect_processes)
+        self.engine.motion = parent.motion
+        self.engine.costs = parent.run_costs
+        self.engine.setDetection(self.engineDetection())
+        return(self.engine)
+
+    def engineDetection(self):
+        # detection settings of the calibration engine (see AutoTune.detectionKeys)
+        return({
+            'backend': self.detect_backend,
+            'binary': self.detect_binary,
+            'th1': self.detect_th1,
+            'th2': self.detect_th2,
+            'thstep': self.detect_thstep,
+            'minArea': self.detect_minArea,
+            'minCircularity': 0.3 if self.loose else self.detect_circularity
+        })
+
+    def decorate(self, frame, keypoints=None, center=None):
+        # frame for display: x-ray, crosshair and the nozzle or endstop found
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        if self.xray:
+            frame = cv2.cvtColor(self.preprocessor.process(frame), cv2.COLOR_GRAY2BGR)
+        else:
+            frame = frame.copy()
+        if self.display_crosshair:
+            target = [int(np.around(frame.shape[1]/2)),int(np.around(frame.shape[0]/2))]
+            frame = cv2.line(frame, (target[0],    target[1]-25), (target[0],    target[1]+25), (0, 255, 0), 1)
+            frame = cv2.line(frame, (target[0]-25, target[1]   ), (target[0]+25, target[1]   ), (0, 255, 0), 1)
+        if keypoints is not None and len(keypoints) > 0:
+            color = (0,0,255) if len(keypoints) == 1 else (255,255,255)
+            frame = cv2.drawKeypoints(frame, keypoints, np.array([]), color, cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+        if center is not None:
+            frame = cv2.circle(frame, center, 150, (255,0,0), 5)
+            frame = cv2.circle(frame, center, 5, (255,0,255), 2)
+        return(frame)
 
     def analyzeFrame(self):
         logger.debug('Starting analyzeFrame')
@@ -869,65 +857,57 @@ class CalibrateNozzles(QThread):
         nocircle = 0
         # Random time offset
         rd = int(round(time.time()*1000))
-        # reset capture
-        #self.cap.open(video_src)
-        #self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-        #self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-        #self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-        #self.cap.set(cv2.CAP_PROP_FPS,25)
-
-        while True and self.detection_on:
-            logger.debug('Processing events.')
-            app.processEvents()
-            logger.debug('Events processed.')
+
+        # a request of the user interface ends the detection
+        while self.detection_on and self.requests.empty():
             logger.debug('Reading frame from camera.')
-            self.ret, self.frame = self.cap.read()
+            self.ret, self.frame = self.frames.read()
             logger.debug('Frame loaded.')
             if not self.ret:
-                # reset capture
-                logger.debug('Resetting camera capture!')
-                self.cap.open(video_src)
-                self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-                self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-                self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-                logger.debug('Camera source reset.')
-                #self.cap.set(cv2.CAP_PROP_FPS,25)
+                # no new frame yet, the grabber resets the camera if needed
                 continue
             #if self.alignment:
             logger.debug('starting detection steps..')
             try:
-                # capture tool location in machine space before processing
-                toolCoordinates = self.parent().printer.getCoords()
+                # capture tool location in machine space before processing, read
+                # once per move and reused for the frames that follow
+                toolCoordinates = self.parent().printer.getCachedCoords()
             except Exception as c1:
                 toolCoordinates = None
                 logger.warning( 'Tool coordinates cannot be determined:' + str(c1) )
             # capture first clean frame for display
             cleanFrame = self.frame
-            # apply nozzle detection algorithm
-            # Detection algorithm 1:
-            #    gamma correction -> use Y channel from YUV -> GaussianBlur (7,7),6 -> adaptive threshold
-            gammaInput = 1.2
-            logger.debug('adjusting image.')
-            self.frame = self.adjust_gamma(image=self.frame, gamma=gammaInput)
-            yuv = cv2.cvtColor(self.frame, cv2.COLOR_BGR2YUV)
-            yuvPlanes = cv2.split(yuv)
-            yuvPlanes[0] = cv2.GaussianBlur(yuvPlanes[0],(7,7),6)
-            yuvPlanes[0] = cv2.adaptiveThreshold(yuvPlanes[0],255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,35,1)
-            self.frame = cv2.cvtColor(yuvPlanes[0],cv2.COLOR_GRAY2BGR)
-            logger.debug('Image adjustment complete.')
+            rawFrame = self.frame
             target = [int(np.around(self.frame.shape[1]/2)),int(np.around(self.frame.shape[0]/2))]
             # Process runtime algorithm changes
             if self.loose:
                 self.detect_minCircularity = 0.3
-            else: self.detect_minCircularity = 0.8
+            else: self.detect_minCircularity = self.detect_circularity
             if self.detector_changed:
                 self.createDetector()
                 self.detector_changed = False
-            # run nozzle detection for keypoints
-            keypoints = self.detector.detect(self.frame)
-            # draw the timestamp on the frame AFTER the circle detector! Otherwise it finds the circles in the numbers.
+            # apply nozzle detection algorithm
+            # Detection algorithm 1:
+            #    use Y channel from YUV -> gamma correction -> GaussianBlur (7,7),6 -> adaptive threshold
+            logger.debug('adjusting image.')
             if self.xray:
-                cleanFrame = self.frame
+                # xray displays the whole binary image, so process the full frame
+                keypoints = self.detector.find(self.frame, self.preprocessor)
+                # template matching does not binarize the frame
+                if isinstance(self.detector, NozzleDetection.TemplateBackend):
+                    self.preprocessor.process(self.frame)
+                self.frame = self.preprocessor.binary
+                # binary image is single channel and reused, convert a copy for display
+                cleanFrame = cv2.cvtColor(self.frame,cv2.COLOR_GRAY2BGR)
+            else:
+                # only the region around the predicted nozzle position is processed,
+                # without a prediction the pyramid detector searches the full frame
+                fullFrame = self.pyramid.detect if self.pyramid is not None else None
+                keypoints = self.tracker.detect(self.frame, self.preprocessor, self.detector, fullFrame=fullFrame)
+            logger.debug('Image adjustment complete.')
+            # sub-pixel centre from the camera frame, before anything is drawn on it
+            if len(keypoints) == 1:
+                (u, v, sigma) = self.centroid.estimate(rawFrame, keypoints[0])
             # check if we are displaying a crosshair
             if self.display_crosshair:
                 self.frame = cv2.line(cleanFrame, (target[0],    target[1]-25), (target[0],    target[1]+25), (0, 255, 0), 1)
@@ -964,14 +944,14 @@ class CalibrateNozzles(QThread):
             # Found one and only one circle.  Put it on the frame.
             logger.debug('Nozzle detected successfully.')
             nocircle = 0 
-            xy = np.around(keypoints[0].pt)
+            xy = np.array([u, v])
+            self.xy_sigma = sigma
             r = np.around(keypoints[0].size/2)
             # draw the blobs that look circular
             logger.debug('Drawing keypoints.')
             self.frame = cv2.drawKeypoints(self.frame, keypoints, np.array([]), (0,0,255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
             # Note its radius and position
-            ts =  'U{0:3.0f} V{1:3.0f} R{2:2.0f}'.format(xy[0],xy[1],r)
-            xy = np.uint16(xy)
+            ts =  'U{0:5.1f} V{1:5.1f} R{2:2.0f}'.format(xy[0],xy[1],r)
             #self.frame = self.putText(self.frame, ts, offsety=2, color=(0, 255, 0), stroke=2)
             self.message_update.emit(ts)
             # show the frame
@@ -982,339 +962,18 @@ class CalibrateNozzles(QThread):
             #end the loop
             break
         # and tell our parent.
-        if self.detection_on:
+        if self.detection_on and self.requests.empty():
             logger.debug('Nozzle detection complete, exiting')
             return (xy, target, toolCoordinates, r)
         else:
             logger.debug('AnaylzeFrame completed.')
             return
 
-    def analyzeEndstop(self):
-        # Placeholder coordinates
-        xy = [0,0]
-        # Counter of frames with no circle.
-        nocircle = 0
-        # Random time offset
-        rd = int(round(time.time()*1000))
-        while True:
-            app.processEvents()
-            self.ret, self.frame = self.cap.read()
-            if not self.ret:
-                # reset capture
-                self.cap.open(video_src)
-                self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-                self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-                self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-                continue
-                # capture tool location in machine space before processing
-                toolCoordinates = self.parent().printer.getCoords()
-            # capture first clean frame for display
-            cleanFrame = self.frame
-            # apply endstop detection algorithm
-            yuv = cv2.cvtColor(cleanFrame, cv2.COLOR_BGR2YUV)
-            yuvPlanes = cv2.split(yuv)
-            still = yuvPlanes[0]
-            
-            black = np.zeros((still.shape[0],still.shape[1]), np.uint8)
-            black2 = black.copy()
-            kernel = np.ones((5,5),np.uint8)
-
-            img_blur = cv2.GaussianBlur(still, (9, 9), 3)
-            img_canny = cv2.Canny(img_blur, 50, 190)
-            img_dilate = cv2.morphologyEx(img_canny, cv2.MORPH_DILATE, kernel, iterations=3)
-
-            cnt, hierarchy = cv2.findContours(img_dilate, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-            black = cv2.drawContours(black, cnt, -1, (255, 0, 255), -1)
-            black = cv2.morphologyEx(black, cv2.MORPH_DILATE, kernel, iterations=2)
-            cnt2, hierarchy2 = cv2.findContours(black, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-            if len(cnt2) > 0:
-                myContours = []
-                for k in range(len(cnt2)):
-                    if hierarchy2[0][k][3] > -1:
-                        myContours.append(cnt2[k])
-                if len(myContours) > 0:
-                    blobContours = max(myContours, key=lambda el: cv2.contourArea(el))
-                    if len(blobContours) > 0:
-                        M = cv2.moments(blobContours)
-                        center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
-                        self.frame = cv2.circle(self.frame, center, 150, (255,0,0), 5)
-                        self.frame = cv2.circle(self.frame, center, 5, (255,0,255), 2)
-                        self.change_pixmap_signal.emit(self.frame)
-                        return ( center, self.parent().printer.getCoords() )
-            else:
-                self.parent().updateStatusbar('Cannot find endstop! Cancel.')
-                self.change_pixmap_signal.emit(self.frame)
-            continue
-
-    def calibrateTool(self, tool, rep):
-        # timestamp for caluclating tool calibration runtime
-        self.startTime = time.time()
-        # average location of keypoints in frame
-        self.average_location=[0,0]
-        # current location
-        self.current_location = {'X':0,'Y':0}
-        # guess position used for camera calibration
-        self.guess_position  = [1,1]
-        # current keypoint location
-        self.xy = [0,0]
-        # previous keypoint location
-        self.oldxy  = self.xy
-        # Tracker flag to set which state algorithm is running in
-        self.state = 0
-        # detected blob counter
-        self.detect_count = 0
-        # Save CP coordinates to local class
-        self.cp_coordinates = self.parent().cp_coords
-        # number of average position loops
-        self.position_iterations = 5
-        # calibration move set (0.5mm radius circle over 10 moves)
-        self.calibrationCoordinates = [ [0,-0.5], [0.294,-0.405], [0.476,-0.155], [0.476,0.155], [0.294,0.405], [0,0.5], [-0.294,0.405], [-0.476,0.155], [-0.476,-0.155], [-0.294,-0.405] ]
-
-        # Check if camera calibration matrix is already defined
-        if len(self.transform_matrix) > 1:
-            # set state flag to Step 2: nozzle alignment stage
-            self.state = 200
-            if str(tool) not in "endstop":
-                self.parent().debugString += '\nCalibrating T'+str(tool)+':C'+str(rep)+': '
-        
-        # Space coordinates
-        self.space_coordinates = []
-        self.camera_coordinates = []
-        self.calibration_moves = 0
-
-        while True:
-            logger.debug('Running calibrate tool..')
-            if str(tool) not in "endstop":
-                (self.xy, self.target, self.tool_coordinates, self.radius) = self.analyzeFrame()
-            else:
-                (self.xy, self.tool_coordinates) = self.analyzeEndstop()
-            logger.debug('Captured reference.')
-            # analyzeFrame has returned our target coordinates, average its location and process according to state
-            self.average_location[0] += self.xy[0]
-            self.average_location[1] += self.xy[1]
-            
-            self.detect_count += 1
-
-            # check if we've reached our number of detections for average positioning
-            if self.detect_count >= self.position_iterations:
-                # calculate average X Y position from detection
-                self.average_location[0] /= self.detect_count
-                self.average_location[1] /= self.detect_count
-                # round to 3 decimal places
-                self.average_location = np.around(self.average_location,3)
-                # get another detection validated
-                if str(tool) not in "endstop":
-                    (self.xy, self.target, self.tool_coordinates, self.radius) = self.analyzeFrame()
-                else:
-                    (self.xy, self.tool_coordinates) = self.analyzeEndstop()
-                
-                #### Step 1: camera calibration and transformation matrix calculation
-                if self.state == 0:
-                    logger.debug('Starting camera calibration..')
-                    self.parent().debugString += 'Calibrating camera...\n'
-                    # Update GUI thread with current status and percentage complete
-                    self.status_update.emit('Calibrating camera..')
-                    self.message_update.emit('Calibrating rotation.. (10%)')
-                    # Save position as previous location
-                    self.oldxy = self.xy
-                    # Reset space and camera coordinates
-                    self.space_coordinates = []
-                    self.camera_coordinates = []
-                    # save machine coordinates for detected nozzle
-                    self.space_coordinates.append( (self.tool_coordinates['X'], self.tool_coordinates['Y']) )
-                    # save camera coordinates
-                    self.camera_coordinates.append( (self.xy[0],self.xy[1]) )
-                    # move carriage for calibration
-                    self.offsetX = self.calibrationCoordinates[0][0]
-                    self.offsetY = self.calibrationCoordinates[0][1]
-                    logger.debug('Moving carriage..')
-                    self.parent().printer.gCode('G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
-                    # Update state tracker to second nozzle calibration move
-                    self.state = 1
-                    continue
-                # Check if camera is still being calibrated
-                elif self.state >= 1 and self.state < len(self.calibrationCoordinates):
-                    logger.debug('Moving carriage again..')
-                    # Update GUI thread with current status and percentage complete
-                    self.status_update.emit('Calibrating camera..')
-                    self.message_update.emit('Calibrating rotation.. (' + str(self.state*10) + '%)')
-                    # check if we've already moved, and calculate mpp value
-                    if self.state == 1:
-                        self.mpp = np.around(0.5/self.getDistance(self.oldxy[0],self.oldxy[1],self.xy[0],self.xy[1]),4)
-                    # save position as previous position
-                    self.oldxy = self.xy
-                    # save machine coordinates for detected nozzle
-                    self.space_coordinates.append( (self.tool_coordinates['X'], self.tool_coordinates['Y']) )
-                    # save camera coordinates
-                    self.camera_coordinates.append( (self.xy[0],self.xy[1]) )
-                    # return carriage to relative center of movement
-                    self.offsetX = -1*self.offsetX
-                    self.offsetY = -1*self.offsetY
-                    self.parent().printer.gCode('G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
-                    logger.debug('Moving carriage again: sent gCode:' + 'G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
-                    # move carriage a random amount in X&Y to collect datapoints for transform matrix
-                    self.offsetX = self.calibrationCoordinates[self.state][0]
-                    self.offsetY = self.calibrationCoordinates[self.state][1]
-                    logger.debug('Moving carriage again: seng gCode again..')
-                    self.parent().printer.gCode('G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
-                    logger.debug('Finished: ' + 'G91 G1 X' + str(self.offsetX) + ' Y' + str(self.offsetY) +' F3000 G90 ')
-                    # increment state tracker to next calibration move
-                    self.state += 1
-                    logger.debug('Moving carriage next step..')
-                    continue
-                # check if final calibration move has been completed
-                elif self.state == len(self.calibrationCoordinates):
-                    logger.debug('Camera calibration finalizing..')
-                    calibration_time = np.around(time.time() - self.startTime,1)
-                    self.parent().debugString += 'Camera calibration completed in ' + str(calibration_time) + ' seconds.\n'
-                    self.parent().debugString += 'Millimeters per pixel: ' + str(self.mpp) + '\n\n'
-                    logger.info('Millimeters per pixel: ' + str(self.mpp))
-                    logger.info('Camera calibration completed in ' + str(calibration_time) + ' seconds.')
-                    # Update GUI thread with current status and percentage complete
-                    self.message_update.emit('Calibrating rotation.. (100%) - MPP = ' + str(self.mpp))
-                    if str(tool) not in "endstop":
-                        self.status_update.emit('Calibrating T' + str(tool) + ', cycle: ' + str(rep+1) + '/' + str(self.cycles))
-                    # save position as previous position
-                    self.oldxy = self.xy
-                    # save machine coordinates for detected nozzle
-                    self.space_coordinates.append( (self.tool_coordinates['X'], self.tool_coordinates['Y']) )
-                    # save camera coordinates
-                    self.camera_coordinates.append( (self.xy[0],self.xy[1]) )
-                    # calculate camera transformation matrix
-                    self.transform_input = [(self.space_coordinates[i], self.normalize_coords(camera)) for i, camera in enumerate(self.camera_coordinates)]
-                    self.transform_matrix, self.transform_residual = self.least_square_mapping(self.transform_input)
-                    # define camera center in machine coordinate space
-                    self.newCenter = self.transform_matrix.T @ np.array([0, 0, 0, 0, 0, 1])
-                    self.guess_position[0]= np.around(self.newCenter[0],3)
-                    self.guess_position[1]= np.around(self.newCenter[1],3)
-                    logger.debug('finalizing calibration: sending gCode..')
-                    self.parent().printer.gCode('G90 G1 X{0:-1.3f} Y{1:-1.3f} F1000 G90 '.format(self.guess_position[0],self.guess_position[1]))
-                    # update state tracker to next phase
-                    self.state = 200
-                    # start tool calibration timer
-                    self.startTime = time.time()
-                    if str(tool) not in "endstop":
-                        self.parent().debugString += '\nCalibrating T'+str(tool)+':C'+str(rep)+': '
-                    else:
-                        self.parent().debugString += '\nCP Autocalibration..'
-                    continue
-                #### Step 2: nozzle alignment stage
-                elif self.state == 200:
-                    logger.debug('Nozzle alignment start..')
-                    # Update GUI thread with current status and percentage complete
-                    if str(tool) not in "endstop":
-                        self.message_update.emit('Tool calibration move #' + str(self.calibration_moves))
-                        self.status_update.emit('Calibrating T' + str(tool) + ', cycle: ' + str(rep+1) + '/' + str(self.cycles))
-                    else:
-                        self.message_update.emit('CP calibration move #' + str(self.calibration_moves))
-                    # increment moves counter
-                    self.calibration_moves += 1
-                    # nozzle detected, frame rotation is set, start
-                    logger.debug('Normalizing..')
-                    self.cx,self.cy = self.normalize_coords(self.xy)
-                    self.v = [self.cx**2, self.cy**2, self.cx*self.cy, self.cx, self.cy, 0]
-                    self.offsets = -1*(0.55*self.transform_matrix.T @ self.v)
-                    self.offsets[0] = np.around(self.offsets[0],3)
-                    self.offsets[1] = np.around(self.offsets[1],3)
-                    # Move it a bit
-                    logger.debug('Moving nozzle for detection..')
-                    self.parent().printer.gCode( 'M564 S1' )
-                    self.parent().printer.gCode( 'G91 G1 X{0:-1.3f} Y{1:-1.3f} F1000 G90 '.format(self.offsets[0],self.offsets[1]) )
-                    logger.debug('Nozzle movement complete ' + 'G91 G1 X{0:-1.3f} Y{1:-1.3f} F1000 G90 '.format(self.offsets[0],self.offsets[1]))
-                    # save position as previous position
-                    self.oldxy = self.xy
-                    if ( self.offsets[0] == 0.0 and self.offsets[1] == 0.0 ):
-                        logger.debug('Updating GUI..')
-                        self.parent().debugString += str(self.calibration_moves) + ' moves.\n'
-                        self.parent().printer.gCode( 'G1 F13200' )
-                        # Update GUI with progress
-                        # calculate final offsets and return results
-                        if str(tool) not in "endstop":
-                            self.tool_offsets = self.parent().printer.getG10ToolOffset(tool)
-                        else:
-                            #HBHBHB: TODO ADD PROBE OFFSETS TO THIS CALCULATION
-                            self.tool_offsets = {
-                                'X' : 0,
-                                'Y' : 0,
-                                'Z' : 0
-                            }
-                        if str(tool) not in "endstop":
-                            logger.debug('Calculating offsets.')
-                            final_x = np.around( (self.cp_coordinates['X'] + self.tool_offsets['X']) - self.tool_coordinates['X'], 3 )
-                            final_y = np.around( (self.cp_coordinates['Y'] + self.tool_offsets['Y']) - self.tool_coordinates['Y'], 3 )
-                            string_final_x = "{:.3f}".format(final_x)
-                            string_final_y = "{:.3f}".format(final_y)
-                            # Save offset to output variable
-                            # HBHBHBHB
-                            _return = {}
-                            _return['X'] = final_x
-                            _return['Y'] = final_y
-                            _return['MPP'] = self.mpp
-                            _return['time'] = np.around(time.time() - self.startTime,1)
-                            self.message_update.emit('Nozzle calibrated: offset coordinates X' + str(_return['X']) + ' Y' + str(_return['Y']) )
-                            self.parent().debugString += 'T' + str(tool) + ', cycle ' + str(rep+1) + ' completed in ' + str(_return['time']) + ' seconds.\n'
-                            self.message_update.emit('T' + str(tool) + ', cycle ' + str(rep+1) + ' completed in ' + str(_return['time']) + ' seconds.')
-                            logger.debug('T' + str(tool) + ', cycle ' + str(rep+1) + ' completed in ' + str(_return['time']) + 's and ' + str(self.calibration_moves) + ' movements.')
-                            logger.info( 'Tool ' + str(tool) +' offsets are X' + str(_return['X']) + ' Y' + str(_return['Y']) + '(G10 P' + str(tool) + ' X' + str(_return['X']) + ' Y' + str(_return['Y']) + ')')
-                        else:
-                            self.message_update.emit('CP auto-calibrated.')
-                        self.parent().printer.gCode( 'G1 F13200' )
-
-                        if str(tool) not in "endstop":
-                            logger.debug('Generating G10 commands.')
-                            self.parent().debugString += 'G10 P' + str(tool) + ' X' + string_final_x + ' Y' + string_final_y + '\n'
-                            x_tableitem = QTableWidgetItem(string_final_x)
-                            x_tableitem.setBackground(QColor(100,255,100,255))
-                            y_tableitem = QTableWidgetItem(string_final_y)
-                            y_tableitem.setBackground(QColor(100,255,100,255))
-                            #self.parent().offsets_table.setItem(tool,0,x_tableitem)
-                            #self.parent().offsets_table.setItem(tool,1,y_tableitem)
-
-                            self.result_update.emit({
-                                'tool': str(tool),
-                                'cycle': str(rep),
-                                'mpp': str(self.mpp),
-                                'X': string_final_x,
-                                'Y': string_final_y
-                            })
-                            return(_return, self.transform_matrix, self.mpp)
-                        else: return
-                    else:
-                        self.state = 200
-                        continue
-                self.avg = [0,0]
-                self.location = {'X':0,'Y':0}
-                self.count = 0
-
-    def normalize_coords(self,coords):
-        xdim, ydim = camera_width, camera_height
-        return (coords[0] / xdim - 0.5, coords[1] / ydim - 0.5)
-
-    def least_square_mapping(self,calibration_points):
-        # Compute a 2x2 map from displacement vectors in screen space to real space.
-        n = len(calibration_points)
-        real_coords, pixel_coords = np.empty((n,2)),np.empty((n,2))
-        for i, (r,p) in enumerate(calibration_points):
-            real_coords[i] = r
-            pixel_coords[i] = p
-        x,y = pixel_coords[:,0],pixel_coords[:,1]
-        A = np.vstack([x**2,y**2,x * y, x,y,np.ones(n)]).T
-        transform = np.linalg.lstsq(A, real_coords, rcond = None)
-        return transform[0], transform[1].mean()
-
-    def getDistance(self, x1, y1, x0, y0 ):
-        x1_float = float(x1)
-        x0_float = float(x0)
-        y1_float = float(y1)
-        y0_float = float(y0)
-        x_dist = (x1_float - x0_float) ** 2
-        y_dist = (y1_float - y0_float) ** 2
-        retVal = np.sqrt((x_dist + y_dist))
-        return np.around(retVal,3)
-
     def stop(self):
         self._running = False
         self.detection_on = False
+        if self.engine is not None:
+            self.engine.stop()
         try:
             tempCoords = self.printer.getCoords()
             if self.printer.isIdle():
@@ -1323,46 +982,38 @@ class CalibrateNozzles(QThread):
                 while self.parent().printer.getStatus() not in 'idle':
                     time.sleep(1)
         except: None
-        self.cap.release()
+        if self.frames is not None:
+            self.frames.release()
+        if self.engine is not None:
+            self.engine.release()
         self.exit()
 
     def createDetector(self):
-        # Setup SimpleBlobDetector parameters.
-        params = cv2.SimpleBlobDetector_Params()
-        # Thresholds
-        params.minThreshold = self.detect_th1
-        params.maxThreshold = self.detect_th2
-        params.thresholdStep = self.detect_thstep
-
-        # Area
-        params.filterByArea = True         # Filter by Area.
-        params.minArea = self.detect_minArea
-
-        # Circularity
-        params.filterByCircularity = True  # Filter by Circularity
-        params.minCircularity = self.detect_minCircularity
-        params.maxCircularity= 1
-
-        # Convexity
-        params.filterByConvexity = True    # Filter by Convexity
-        params.minConvexity = 0.3
-        params.maxConvexity = 1
-
-        # Inertia
-        params.filterByInertia = True      # Filter by Inertia
-        params.minInertiaRatio = 0.3
-
-        # create detector
-        self.detector = cv2.SimpleBlobDetector_create(params)
+        # create detector backend. The blob backend uses BinaryBlobDetector (one contour
+        # pass on the binarized frame) or SimpleBlobDetector (sweeps thresholds th1..th2
+        # in steps of thstep).
+        self.detector = self.scaledDetector(self.detect_minArea)
+        # high resolution cameras search a downscaled frame first, then refine around each hit
+        factor = NozzleDetection.pyramidFactor(camera_width, camera_height, self.detect_minArea)
+        if factor > 1:
+            self.pyramid = NozzleDetection.PyramidDetector(self.preprocessor, self.scaledDetector, self.detect_minArea, factor=factor)
+        else: self.pyramid = None
+
+    def scaledDetector(self, minArea, maxArea=5000):
+        return NozzleDetection.createBackend(
+            self.detect_backend,
+            binary=self.detect_binary,
+            th1=self.detect_th1,
+            th2=self.detect_th2,
+            thstep=self.detect_thstep,
+            minArea=minArea,
+            maxArea=maxArea,
+            minCircularity=self.detect_minCircularity
+        )
 
     def adjust_gamma(self, image, gamma=1.2):
-        # build a lookup table mapping the pixel values [0, 255] to
-        # their adjusted gamma values
-        invGamma = 1.0 / gamma
-        table = np.array([((i / 255.0) ** invGamma) * 255
-            for i in np.arange(0, 256)]).astype('uint8')
-        # apply gamma correction using the lookup table
-        return cv2.LUT(image, table)
+        # apply gamma correction using the cached lookup table
+        return cv2.LUT(image, NozzleDetection.gammaTable(gamma))
 
     def putText(self, frame,text,color=(0, 0, 255),offsetx=0,offsety=0,stroke=1):  # Offsets are in character box size in pixels. 
         if (text == 'timestamp'): text = datetime.datetime.now().strftime('%m-%d-%Y %H:%M:%S')
@@ -1383,33 +1034,64 @@ class CalibrateNozzles(QThread):
             cv2.FONT_HERSHEY_SIMPLEX, fontScale, color, stroke)
         return(frame)
 
+    def openCamera(self, src):
+        # Frame source for src in the capture mode cached in settings.json. A camera
+        # without a cached mode (or another camera or resolution) is probed first
+        # and the mode found is stored for the next start. Runs on the worker thread.
+        global capture_mode
+        if not FrameSource.ReplaySource.isReplay(src):
+            if capture_mode is None or str(capture_mode.get('src')) != str(src) \
+                or (capture_mode['width'], capture_mode['height']) != (int(camera_width), int(camera_height)):
+                logger.info('Probing capture modes of camera ' + str(src) + '..')
+                self.message_update.emit('Probing capture modes of camera ' + str(src) + '..')
+                capture_mode = FrameSource.negotiateMode(src, camera_width, camera_height)
+                if capture_mode is not None:
+                    capture_mode = dict(capture_mode, src=src)
+                    FrameSource.saveCaptureMode(capture_mode, src)
+        return(openFrameSource(src, camera_width, camera_height, mode=capture_mode))
+
     def changeVideoSrc(self, newSrc=-1):
-        self.cap.release()
-        video_src = newSrc
-        # Start Video feed
-        self.cap.open(video_src)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-        self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-        #self.cap.set(cv2.CAP_PROP_FPS,25)
-        self.brightness_default = self.cap.get(cv2.CAP_PROP_BRIGHTNESS)
-        self.contrast_default = self.cap.get(cv2.CAP_PROP_CONTRAST)
-        self.saturation_default = self.cap.get(cv2.CAP_PROP_SATURATION)
-        self.hue_default = self.cap.get(cv2.CAP_PROP_HUE)
-
-        self.ret, self.cv_img = self.cap.read()
+        # Restart video feed on the new source, which may be a camera or a replay.
+        # Returns at once, the worker opens the source (see openVideoSrc).
+        self.requests.put(('camera', newSrc))
+
+    def openVideoSrc(self, src):
+        # (Re)open the video feed on the worker thread, probing the camera if needed
+        if self.frames is not None:
+            self.frames.release()
+            self.frames = None
+            self.cap = None
+        # the camera calibration belongs to the old camera
+        if self.engine is not None:
+            self.engine.release()
+            self.engine = None
+        try:
+            frames = self.openCamera(src)
+        except Exception as vs1:
+            self.status_update.emit('Error 0x02: cannot open video source ' + str(src))
+            logger.error('Cannot open video source ' + str(src) + ': ' + str(vs1))
+            return
+        self.brightness_default = frames.get(cv2.CAP_PROP_BRIGHTNESS)
+        self.contrast_default = frames.get(cv2.CAP_PROP_CONTRAST)
+        self.saturation_default = frames.get(cv2.CAP_PROP_SATURATION)
+        self.hue_default = frames.get(cv2.CAP_PROP_HUE)
+        frames.start()
+        self.cap = frames.cap
+        self.frames = frames
+        self.message_update.emit('Video source ' + str(src) + ' opened.')
+
+        self.ret, self.cv_img = self.frames.read(timeout=2)
         if self.ret:
             local_img = self.cv_img
             self.change_pixmap_signal.emit(local_img)
-        else:
-            self.cap.open(video_src)
-            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-            self.cap.set(cv2.CAP_PROP_BUFFERSIZE,1)
-            #self.cap.set(cv2.CAP_PROP_FPS,25)
-            self.ret, self.cv_img = self.cap.read()
-            local_img = self.cv_img
-            self.change_pixmap_signal.emit(local_img)
+
+    def sourceDescription(self):
+        # video source, resolution and frame rate for the camera settings dialog
+        if self.frames is None:
+            return(str(video_src) + ': opening..')
+        return(str(video_src) + ': ' + str(self.frames.get(cv2.CAP_PROP_FRAME_WIDTH))
+            + 'x' + str(self.frames.get(cv2.CAP_PROP_FRAME_HEIGHT)) + ' @ '
+            + str(self.frames.get(cv2.CAP_PROP_FPS)) + 'fps')
 
 class App(QMainWindow):
     cp_coords = {}
@@ -1557,6 +1239,11 @@ class App(QMainWindow):
         grid.addWidget( self.repeat_label,          7,  3,  1,  1,  Qt.AlignLeft )
         # cycle repeat selector
         grid.addWidget( self.repeatSpinBox,         7,  4,  1,  1,  Qt.AlignLeft )
+        # calibration schedule selector and adaptive cycles
+        schedule_layout = QHBoxLayout()
+        schedule_layout.addWidget( self.scheduleCombo )
+        schedule_layout.addWidget( self.adaptive_box )
+        grid.addLayout( schedule_layout,            7,  5,  1,  1,  Qt.AlignLeft )
         # CP auto calibration button
         grid.addWidget( self.cp_calibration_button, 7,  7,  1,  1,  Qt.AlignRight )
         # manual alignment button
@@ -1619,6 +1306,22 @@ class App(QMainWindow):
         self.repeatSpinBox.setMinimum(1)
         self.repeatSpinBox.setSingleStep(1)
         self.repeatSpinBox.setDisabled(True)
+        self.repeatSpinBox.valueChanged.connect(self.updateScheduleEstimate)
+        # Calibration schedule (order of tools and cycles)
+        self.scheduleCombo = QComboBox()
+        self.scheduleCombo.addItem('Interleaved', 'interleaved')
+        self.scheduleCombo.addItem('Grouped', 'grouped')
+        self.scheduleCombo.addItem('Re-dock every ' + str(self.schedule_redock), 'hybrid')
+        self.scheduleCombo.setCurrentIndex(CalibrationSchedule.strategies.index(self.schedule_strategy))
+        self.scheduleCombo.currentIndexChanged.connect(self.changeSchedule)
+        self.scheduleCombo.setDisabled(True)
+        # Adaptive cycles: stop repeating a tool once its offsets have converged
+        self.adaptive_box = QCheckBox('Adaptive')
+        self.adaptive_box.setToolTip('Stop repeating a tool once its X and Y offsets are known to +/-' + str(self.adaptive_settings['target'])
+            + 'mm (95% confidence),\nafter at least ' + str(self.adaptive_settings['minCycles']) + ' cycles. Cycles is the maximum.')
+        self.adaptive_box.setChecked(self.schedule_adaptive)
+        self.adaptive_box.stateChanged.connect(self.toggle_adaptive)
+        self.adaptive_box.setDisabled(True)
         # Manual alignment button
         self.manual_button = QPushButton('Capture')
         self.manual_button.setToolTip('After jogging tool to the correct position in the window, capture and calculate offset.')
@@ -1897,13 +1600,14 @@ class App(QMainWindow):
         self.buttons_layout.addWidget(self.button_z_up,3,2)
 
     def calibrate_CP(self):
-        self.video_thread.align_endstop = True
-        while self.video_thread.align_endstop and self.video_thread._running:
-            app.processEvents()
+        # the worker centres the carriage on the endstop and signals cp_captured
+        self.cp_calibration_button.setDisabled(True)
+        self.video_thread.startEndstop()
+
+    @pyqtSlot(object)
+    def captureAutoCP(self, coords):
         # Capture new position as CP
-        logger.debug('Calibrate fetching printer coordinates')
-        self.cp_coords = self.printer.getCoords()
-        logger.debug('Calibrate - coordinates retrieved')
+        self.cp_coords = coords
         self.cp_string = '(' + str(self.cp_coords['X']) + ', ' + str(self.cp_coords['Y']) + ')'
         self.readyToCalibrate()
 
@@ -1945,16 +1649,38 @@ class App(QMainWindow):
         return( _errCode, _errMsg, _printerURL )
 
     def loadUserParameters(self):
-        global camera_width, camera_height, video_src
+        global camera_width, camera_height, video_src, capture_mode
+        self.detection_settings = None
+        capture_mode = None
+        self.run_costs = CalibrationSchedule.RunCosts()
+        self.motion = MotionPlanner.TravelPlanner()
+        self.schedule_strategy = 'interleaved'
+        self.schedule_redock = 2
+        self.schedule_adaptive = False
+        self.adaptive_settings = dict(CalibrationSchedule.EarlyStopping.defaults)
+        # worker processes for burst detection, 0 detects in the video thread
+        self.detect_processes = 0
         try:
             with open('settings.json','r') as inputfile:
                 options = json.load(inputfile)
+            self.detection_settings = AutoTune.loadDetection(options)
             camera_settings = options['camera'][0]
             camera_height = int( camera_settings['display_height'] )
             camera_width = int( camera_settings['display_width'] )
-            video_src = camera_settings['video_src']
-            if len(str(video_src)) == 1: video_src = int(video_src)
+            video_src = UserSettings.cameraSource(camera_settings['video_src'])
+            self.detect_processes = max(int(camera_settings.get('detect_processes', 0)), 0)
+            capture_mode = FrameSource.loadCaptureMode(options, video_src, camera_width, camera_height)
             printer_settings = options['printer'][0]
+            self.run_costs = CalibrationSchedule.loadCosts(options)
+            self.motion = MotionPlanner.loadPlanner(options)
+            schedule_settings = printer_settings.get('schedule', {})
+            if schedule_settings.get('strategy') in CalibrationSchedule.strategies:
+                self.schedule_strategy = schedule_settings['strategy']
+            self.schedule_redock = max(int(schedule_settings.get('redock', self.schedule_redock)), 1)
+            adaptive = CalibrationSchedule.loadAdaptive(options)
+            self.schedule_adaptive = adaptive is not None
+            if adaptive is not None:
+                self.adaptive_settings = adaptive
             tempURL = printer_settings['address']
             ( _errCode, _errMsg, self.printerURL ) = self.cleanPrinterURL(tempURL)
             if _errCode > 0:
@@ -1964,52 +1690,39 @@ class App(QMainWindow):
                 self.printerURL = 'http://localhost'
         except FileNotFoundError:
             # create parameter file with standard parameters
-            options = {}
-            options['camera'] = []
-            options['camera'].append( {
-                'video_src': 0,
-                'display_width': '640',
-                'display_height': '480'
-            } )
-            options['printer'] = []
-            options['printer'].append( {
-                'address': 'http://localhost',
-                'name': 'Default'
-            } )
-            try:
-                camera_width = 640
-                camera_height = 480
-                video_src = 1
-                with open('settings.json','w') as outputfile:
-                    json.dump(options, outputfile)
-            except Exception as e1:
-                logger.error( 'Error reading user settings file.' + str(e1) )
+            camera_width = 640
+            camera_height = 480
+            video_src = 1
+            if not UserSettings.saveProfile(
+                camera={ 'video_src': 0, 'display_width': '640', 'display_height': '480' },
+                printer={ 'address': 'http://localhost', 'name': 'Default' }):
+                logger.error( 'Error creating user settings file.' )
 
     def saveUserParameters(self, cameraSrc=-2):
+        # cameraSrc is a camera index or a replay path, -2 keeps the current source
         global camera_width, camera_height, video_src
-        cameraSrc = int(cameraSrc)
-        try:
-            if cameraSrc > -2:
-                video_src = cameraSrc
-            options = {}
-            options['camera'] = []
-            options['camera'].append( {
+        previous_src = video_src
+        if str(cameraSrc) != '-2':
+            video_src = UserSettings.cameraSource(cameraSrc)
+        # anything else stored in the file (eg. tuned detection settings) is kept
+        saved = UserSettings.saveProfile(
+            camera={
                 'video_src': video_src,
                 'display_width': camera_width,
-                'display_height': camera_height
-            } )
-            options['printer'] = []
-            options['printer'].append( {
+                'display_height': camera_height,
+                'detect_processes': self.detect_processes
+            },
+            printer={
                 'address': self.printerURL,
-                'name': 'Default printer'
+                'name': 'Default printer',
+                'schedule': dict(self.adaptive_settings, strategy=self.schedule_strategy, redock=self.schedule_redock, adaptive=self.schedule_adaptive)
             } )
-            with open('settings.json','w') as outputfile:
-                json.dump(options, outputfile)
-        except Exception as e1:
-            logger.error( 'Error saving user settings file.' + str(e1) )
-        if int(video_src) != cameraSrc:
-            self.video_thread.changeVideoSrc(newSrc=cameraSrc)
-        self.updateStatusbar('Current profile saved to settings.json')
+        if str(video_src) != str(previous_src):
+            self.video_thread.changeVideoSrc(newSrc=video_src)
+        if saved:
+            self.updateStatusbar('Current profile saved to settings.json')
+        else:
+            self.updateStatusbar('Error saving user settings file, please check terminal for details.')
 
     def _createMenuBar(self):
         # Issue #25: fullscreen mode menu error: can't disable items
@@ -2052,7 +1765,7 @@ class App(QMainWindow):
         self.debugAction.triggered.connect(self.displayDebug)
         self.cameraAction.triggered.connect(self.displayCameraSettings)
         self.quitAction.triggered.connect(self.close)
-        self.saveAction.triggered.connect(self.saveUserParameters)
+        self.saveAction.triggered.connect(lambda: self.saveUserParameters())
 
         self.graphAction.triggered.connect(lambda: self.analyzeResults(graph=True))
         self.exportAction.triggered.connect(lambda: self.analyzeResults(export=True))
@@ -2116,7 +1829,11 @@ class App(QMainWindow):
 
     def startVideo(self):
         # create the video capture thread
-        self.video_thread = CalibrateNozzles(parent=self,numTools=0, cycles=1,minArea=600, align=False)
+        # detection parameters from AutoTune.py stored with the camera profile, if any
+        if self.detection_settings is not None:
+            self.video_thread = CalibrateNozzles(parent=self,numTools=0, cycles=1, align=False, processes=self.detect_processes, **self.detection_settings)
+        else:
+            self.video_thread = CalibrateNozzles(parent=self,numTools=0, cycles=1,minArea=600, align=False, processes=self.detect_processes)
         # connect its signal to the update_image slot
         # connect its signal to the update_image slot
         self.video_thread.detection_error.connect(self.updateStatusbar)
@@ -2125,6 +1842,8 @@ class App(QMainWindow):
         self.video_thread.change_pixmap_signal.connect(self.update_image)
         self.video_thread.calibration_complete.connect(self.applyCalibration)
         self.video_thread.result_update.connect(self.addCalibrationResult)
+        self.video_thread.debug_update.connect(self.addDebugText)
+        self.video_thread.cp_captured.connect(self.captureAutoCP)
 
         # start the thread
         self.video_thread.start()
@@ -2163,6 +1882,8 @@ class App(QMainWindow):
         self.cp_label.setText('<b>CP:</b> <i>undef</i>')
         self.cp_label.setStyleSheet(style_orange)
         self.repeatSpinBox.setDisabled(True)
+        self.scheduleCombo.setDisabled(True)
+        self.adaptive_box.setDisabled(True)
         self.xray_box.setDisabled(True)
         self.xray_box.setChecked(False)
         self.xray_box.setVisible(False)
@@ -2309,16 +2030,10 @@ class App(QMainWindow):
             if status == QMessageBox.Yes:
                 self.toolButtons[int(self.sender().text()[1:])].setChecked(False)
                 if len(self.cp_coords) > 0:
-                    self.printer.gCode('T-1')
-                    self.printer.gCode('G1 X' + str(self.cp_coords['X']))
-                    self.printer.gCode('G1 Y' + str(self.cp_coords['Y']))
-                    self.printer.gCode('G1 Z' + str(self.cp_coords['Z']))
+                    self.motion.travel(self.printer, self.cp_coords, tools=['T-1'])
                 else:
                     tempCoords = self.printer.getCoords()
-                    self.printer.gCode('T-1')
-                    self.printer.gCode('G1 X' + str(tempCoords['X']))
-                    self.printer.gCode('G1 Y' + str(tempCoords['Y']))
-                    self.printer.gCode('G1 Z' + str(tempCoords['Z']))
+                    self.motion.travel(self.printer, tempCoords, tools=['T-1'])
                 # End video threads and restart default thread
                 self.video_thread.alignment = False
 
@@ -2338,18 +2053,10 @@ class App(QMainWindow):
             if status == QMessageBox.Yes:
                 # return carriage to controlled point position
                 if len(self.cp_coords) > 0:
-                    self.printer.gCode('T-1')
-                    self.printer.gCode(sender.text())
-                    self.printer.gCode('G1 X' + str(self.cp_coords['X']))
-                    self.printer.gCode('G1 Y' + str(self.cp_coords['Y']))
-                    self.printer.gCode('G1 Z' + str(self.cp_coords['Z']))
+                    self.motion.travel(self.printer, self.cp_coords, tools=['T-1', sender.text()])
                 else:
                     tempCoords = self.printer.getCoords()
-                    self.printer.gCode('T-1')
-                    self.printer.gCode(self.sender().text())
-                    self.printer.gCode('G1 X' + str(tempCoords['X']))
-                    self.printer.gCode('G1 Y' + str(tempCoords['Y']))
-                    self.printer.gCode('G1 Z' + str(tempCoords['Z']))
+                    self.motion.travel(self.printer, tempCoords, tools=['T-1', sender.text()])
                 # START DETECTION THREAD HANDLING
                 # close camera settings dialog so it doesn't crash
                 try:
@@ -2361,6 +2068,8 @@ class App(QMainWindow):
                 self.panel_box.setDisabled(False)
                 self.calibration_button.setDisabled(True)
                 self.repeatSpinBox.setDisabled(True)
+                self.scheduleCombo.setDisabled(True)
+                self.adaptive_box.setDisabled(True)
 
             else:
                 self.toolButtons[int(self.sender().text()[1:])].setChecked(False)
@@ -2376,6 +2085,8 @@ class App(QMainWindow):
         self.cp_label.setText('<b>CP:</b> <i>undef</i>')
         self.cp_label.setStyleSheet(style_red)
         self.repeatSpinBox.setDisabled(True)
+        self.scheduleCombo.setDisabled(True)
+        self.adaptive_box.setDisabled(True)
         if not self.small_display:
             self.analysisMenu.setDisabled(True)
         self.detect_box.setChecked(False)
@@ -2433,12 +2144,6 @@ class App(QMainWindow):
         return
     
     def captureControlPoint(self):
-        #global probePoint
-        #global offsetProbe
-        global endstopPoint
-        global probeHeight
-        global hasKnob
-
         # reset state flag
         self.flag_CP_setup = False
         # When user confirms everything is done, capture CP values and store
@@ -2446,76 +2151,11 @@ class App(QMainWindow):
         self.cp_string = '(' + str(self.cp_coords['X']) + ', ' + str(self.cp_coords['Y']) + ')'
         # Disable crosshair
         self.crosshair = False
-
-        # Calibrate Z offset using knob sensor if it exists.
-        logger.debug('move to Knob sensor position of X:' + str(self.cp_coords['X'] + 40) + ' Y:' + str(self.cp_coords['Y']) + ' Z:' + str(self.cp_coords['Z']))
-        savez = str(self.cp_coords['Z'])
-    
-        # Get probe offsets from machine
-        try:
-            probeInfo = self.printer.getModelQuery(["sensors","probes"])
-            probeHeight = 0
-            probeHeight = probeInfo[0]['triggerHeight']
-            #logger.info('probeHeight: ' + str(probeInfo[0]))
-        except Exception as c1:
-            probeHeight = 0
-            probeInfo = ''
-            logger.warning( 'Data not returned, Error was ' + str(c1) )
-        
-        logger.info('Omron probeOffset: ' + str(probeHeight))
-        try:
-            hasKnob = False
-            if probeInfo[3]['value'][0] == 0:
-                hasKnob = True
-        except: None
-        logger.info('Existing Doorknob sensor: ' + str(hasKnob))
-
-        if hasKnob:
-            logger.info('Getting Z axis reference triggers')
-            self.printer.gCode('G1 X' + str(self.cp_coords['X'] + 40))
-
-            #self.printer.gCode('G30 S-1 K3')
-            #while self.printer.getStatus() not in 'idle':
-            #    # process GUI events
-            #    app.processEvents()
-            #try:
-            #    # capture tool location in machine space before processing
-            #    currentPosition = self.printer.getCoords()
-            #    probePoint = currentPosition['Z']
-            #    logger.info('Doorknob sensor triggered at Z: ' + str(currentPosition['Z']) )
-            #except Exception as c1:
-            #    currentPosition = None
-            #    logger.warning( 'Z coordinates cannot be determined:' + str(c1) )
-            #self.printer.gCode('G91 G1 Z5 G90')
-
-            while self.printer.getStatus() not in 'idle':
-                # process GUI events
-                app.processEvents()
-            self.printer.gCode('G30 S-1 K0')
-            while self.printer.getStatus() not in 'idle':
-                # process GUI events
-                app.processEvents()
-            try:
-                # capture tool location in machine space before processing
-                currentPosition = self.printer.getCoords()
-                endstopPoint = currentPosition['Z']
-                #offsetProbe = endstopPoint - probePoint
-                logger.info('Omron switch triggered at Z: ' + str(currentPosition['Z']) )
-            except Exception as c1:
-                currentPosition = None
-                logger.warning( 'Z coordinates cannot be determined:' + str(c1) )
-            logger.debug('Moving carriage..')
-            self.printer.gCode('G1 Z' + savez)
-        # process GUI events 
-        app.processEvents()
+        # Z reference of the knob sensor (if there is one) is probed by the worker,
+        # which returns the carriage to the CP afterwards
+        self.video_thread.startReference(self.cp_coords)
         # Setup GUI for next step
         self.readyToCalibrate()
-        # Move printer to CP to prepare for next step
-        self.printer.gCode('G90 G1 X' + str(self.cp_coords['X']) + ' Y' + str(self.cp_coords['Y']))
-
-
-
-
 
     def readyToCalibrate(self):
         for item in self.toolButtons:
@@ -2545,6 +2185,9 @@ class App(QMainWindow):
 
         self.tool_box.setVisible(True)
         self.repeatSpinBox.setDisabled(False)
+        self.scheduleCombo.setDisabled(False)
+        self.adaptive_box.setDisabled(False)
+        self.updateScheduleEstimate()
 
         if len(self.calibrationResults) > 1:
             # Issue #25: fullscreen mode menu error: can't disable items
@@ -2723,7 +2366,10 @@ class App(QMainWindow):
         # Report on repeated executions
         ###################################################################################
         print('')
-        print('Repeatability statistics for '+str(self.cycles)+' repeats:')
+        if self.schedule_adaptive:
+            print('Repeatability statistics for up to '+str(self.cycles)+' repeats (adaptive cycles):')
+        else:
+            print('Repeatability statistics for '+str(self.cycles)+' repeats:')
         print('+-------------------------------------------------------------------------------------------------------+')
         print('|   |                   X                             |                        Y                        |')
         print('| T |   Avg   |   Max   |   Min   |  StdDev |  Range  |   Avg   |   Max   |   Min   |  StdDev |  Range  |')
@@ -2760,6 +2406,8 @@ class App(QMainWindow):
                 + '|'
             )        
         print('+-------------------------------------------------------------------------------------------------------+')
+        if self.schedule_adaptive:
+            print('Cycles run: ' + ', '.join('T' + str(index) + ' ' + str(len([line for line in self.calibrationResults if line['tool'] == str(index)])) for index in range(self.num_tools)))
         print('Note: Repeatability cannot be better than one pixel (MPP=' + str(mpp_value) + ').')
 
     def parseData( self, rawData ):
@@ -2818,6 +2466,8 @@ class App(QMainWindow):
         self.cp_label.setText('<b>CP:</b> <i>undef</i>')
         self.cp_label.setStyleSheet(style_orange)
         self.repeatSpinBox.setDisabled(True)
+        self.scheduleCombo.setDisabled(True)
+        self.adaptive_box.setDisabled(True)
         self.xray_box.setDisabled(True)
         self.xray_box.setChecked(False)
         self.loose_box.setDisabled(True)
@@ -2838,16 +2488,11 @@ class App(QMainWindow):
         _ret_error = self.printer.gCode('M400')
         if self.printer.isIdle():
             tempCoords = self.printer.getCoords()
-            _ret_error += self.printer.gCode('T-1')
-            # return carriage to controlled point position
+            # unload tools and return carriage to controlled point position
             if len(self.cp_coords) > 0:
-                _ret_error += self.printer.gCode('G1 X' + str(self.cp_coords['X']))
-                _ret_error += self.printer.gCode('G1 Y' + str(self.cp_coords['Y']))
-                _ret_error += self.printer.gCode('G1 Z' + str(self.cp_coords['Z']))
+                _ret_error += self.motion.travel(self.printer, self.cp_coords, tools=['T-1'])
             else:
-                _ret_error += self.printer.gCode('G1 X' + str(tempCoords['X']))
-                _ret_error += self.printer.gCode('G1 Y' + str(tempCoords['Y']))
-                _ret_error += self.printer.gCode('G1 Z' + str(tempCoords['Z']))
+                _ret_error += self.motion.travel(self.printer, tempCoords, tools=['T-1'])
         # update status with disconnection state
         if _ret_error == 0:
             self.updateStatusbar('Disconnected.')
@@ -2874,6 +2519,8 @@ class App(QMainWindow):
         self.cp_label.setText('<b>CP:</b> <i>undef</i>')
         self.cp_label.setStyleSheet(style_red)
         self.repeatSpinBox.setDisabled(True)
+        self.scheduleCombo.setDisabled(True)
+        self.adaptive_box.setDisabled(True)
         self.xray_box.setDisabled(True)
         self.loose_box.setDisabled(True)
         self.resetConnectInterface()
@@ -2895,6 +2542,25 @@ class App(QMainWindow):
         returnValue = msgBox.exec_()
         if msgBox.clickedButton() == no_button:
             return
+        # offer to resume a run that was interrupted on this machine and CP
+        self.resume_checkpoint = None
+        checkpoint = CalibrationCheckpoint.loadCheckpoint()
+        if CalibrationCheckpoint.resumable(checkpoint, self.printerURL, self.cp_coords, self.num_tools):
+            msg = QMessageBox()
+            status = msg.question( self, 'Resume calibration', 'A calibration run stopped after ' + str(checkpoint.position) + ' of ' + str(len(checkpoint.steps)) + ' tool alignments. Resume it?', QMessageBox.Yes | QMessageBox.No )
+            if status == QMessageBox.Yes:
+                self.resume_checkpoint = checkpoint
+                self.calibrationResults = list(checkpoint.results)
+                self.repeatSpinBox.setValue(checkpoint.cycles)
+            else:
+                checkpoint.clear()
+        # fetch all tool offsets in a single object model request
+        try:
+            snapshot = self.printer.getMachineSnapshot()
+        except Exception as e1:
+            logger.error('Failed to read tool offsets: ' + str(e1))
+            self.updateStatusbar('Error reading tool offsets from the printer, calibration not started.')
+            return
         # close camera settings dialog so it doesn't crash
         try:
             if self.camera_dialog.isVisible():
@@ -2914,12 +2580,13 @@ class App(QMainWindow):
         self.detect_box.setVisible(False)
         self.cp_calibration_button.setDisabled(True)
         logger.debug('Updating tool interface..')
+        del toolZ_offset[:]
         for i in range(self.num_tools):
-            current_tool = self.printer.getG10ToolOffset(i)
-            toolZ_offset.append(current_tool['Z'])
+            current_tool = snapshot.tools[i]
+            toolZ_offset.append(current_tool.offset('Z'))
             logger.info('Tool' + str(i) + ' Z offset: ' + str(toolZ_offset[i]))
-            x_tableitem = QTableWidgetItem("{:.3f}".format(current_tool['X']))
-            y_tableitem = QTableWidgetItem("{:.3f}".format(current_tool['Y']))
+            x_tableitem = QTableWidgetItem("{:.3f}".format(current_tool.offset('X')))
+            y_tableitem = QTableWidgetItem("{:.3f}".format(current_tool.offset('Y')))
             x_tableitem.setBackground(QColor(255,255,255,255))
             y_tableitem.setBackground(QColor(255,255,255,255))
             # self.offsets_table.setVerticalHeaderItem(i,QTableWidgetItem('T'+str(i)))
@@ -2927,17 +2594,40 @@ class App(QMainWindow):
             # self.offsets_table.setItem(i,1,y_tableitem)
         # get number of repeat cycles
         self.repeatSpinBox.setDisabled(True)
+        self.scheduleCombo.setDisabled(True)
+        self.adaptive_box.setDisabled(True)
         self.cycles = self.repeatSpinBox.value()
 
-        # create the Nozzle detection capture thread
+        # the Nozzle detection capture thread runs the calibration
         logger.debug('Launching calibration threads..')
         self.video_thread.display_crosshair = True
-        self.video_thread.detection_on = True
+        self.video_thread.detection_on = False
         self.video_thread.xray = False
         self.video_thread.loose = False
         self.video_thread.alignment = True
+        self.video_thread.startCalibration(self.resume_checkpoint)
+        self.resume_checkpoint = None
         logger.debug('Calibration setup method exiting.')
 
+    def changeSchedule(self, index):
+        self.schedule_strategy = self.scheduleCombo.itemData(index)
+        self.updateScheduleEstimate()
+
+    def updateScheduleEstimate(self, value=None):
+        # show the estimated run time of each schedule on the selector
+        try:
+            lines = self.run_costs.report(self.num_tools, self.repeatSpinBox.value(), self.schedule_redock)
+            if self.schedule_adaptive:
+                self.scheduleCombo.setToolTip('Order of tools and cycles. Estimated run time (at most, with adaptive cycles):\n' + '\n'.join(lines))
+            else:
+                self.scheduleCombo.setToolTip('Order of tools and cycles. Estimated run time:\n' + '\n'.join(lines))
+        except Exception:
+            self.scheduleCombo.setToolTip('Order of tools and cycles.')
+
+    def toggle_adaptive(self):
+        self.schedule_adaptive = self.adaptive_box.isChecked()
+        self.updateScheduleEstimate()
+
 
     def toggle_xray(self):
         try:
@@ -3042,6 +2732,10 @@ class App(QMainWindow):
     def addCalibrationResult(self, result={}):
         self.calibrationResults.append(result)
 
+    @pyqtSlot(str)
+    def addDebugText(self, text):
+        self.debugString += text
+
 if __name__=='__main__':
     os.putenv("QT_LOGGING_RULES","qt5ct.debug=false")
     # Create main application logger
@@ -0,0 +1,159 @@
+# Python Script containing the headless (command line) tool alignment of TAMV.
+#
+# Runs the same calibration as TAMVZTATP_GUI.py without a display: connects to
+# the printer and camera of settings.json (or the ones given), captures the CP,
+# calibrates the camera, aligns every tool in XY (and Z with the knob sensor),
+# applies the offsets and writes the results as JSON. No Qt is imported and no
+# frames are drawn, so it starts quickly on a Raspberry Pi and can be run from
+# scripts, eg. for recalibrating a fleet of machines:
+#   python TAMVZTATP_headless.py --printer http://192.168.1.20 --cycles 3 --output T.json
+# Progress is checkpointed after every tool; --resume continues an interrupted run.
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3, OpenCV and numpy
+
+import argparse
+import datetime
+import json
+import logging
+import sys
+
+import AutoTune
+import CalibrationCheckpoint
+import CalibrationSchedule
+import DuetWebAPI as DWA
+import FrameSource
+import MotionPlanner
+import UserSettings
+from CalibrationEngine import CalibrationEngine
+
+logger = logging.getLogger('TAMV')
+
+def openCamera(options, src, width, height, path):
+    # frame source in the capture mode cached in settings.json, probed when there is none
+    mode = None
+    if not FrameSource.ReplaySource.isReplay(src):
+        mode = FrameSource.loadCaptureMode(options, src, width, height)
+        if mode is None:
+            logger.info('Probing capture modes of camera ' + str(src) + '..')
+            mode = FrameSource.negotiateMode(src, width, height)
+            if mode is not None:
+                mode = dict(mode, src=src)
+                FrameSource.saveCaptureMode(mode, src, path)
+    return(FrameSource.openFrameSource(src, width, height, mode=mode))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='TAMV headless tool alignment')
+    parser.add_argument('--settings', default='settings.json', help='settings file (printer, camera, detection and stored calibrations)')
+    parser.add_argument('--printer', default=None, help='printer URL (default: from the settings file)')
+    parser.add_argument('--camera', default=None, help='camera index, device path or replay (default: from the settings file)')
+    parser.add_argument('--width', type=int, default=None, help='camera frame width')
+    parser.add_argument('--height', type=int, default=None, help='camera frame height')
+    parser.add_argument('--cp', type=float, nargs=3, metavar=('X', 'Y', 'Z'), default=None, help='controlled point (default: the current position)')
+    parser.add_argument('--auto-cp', action='store_true', help='centre the CP on the endstop seen from the current position')
+    parser.add_argument('--tools', type=int, default=None, help='number of tools (default: all tools of the printer)')
+    parser.add_argument('--cycles', type=int, default=1, help='alignments per tool (the maximum with adaptive cycles)')
+    parser.add_argument('--adaptive', action='store_true', help='stop repeating a tool once its offsets are known to --target (default: from the settings file)')
+    parser.add_argument('--target', type=float, default=None, help='adaptive cycles: half width (mm) of the 95%% confidence interval of the X and Y offsets')
+    parser.add_argument('--min-cycles', type=int, default=None, help='adaptive cycles: alignments per tool at least')
+    parser.add_argument('--schedule', choices=CalibrationSchedule.strategies, default=None, help='order of tools and cycles (default: from the settings file)')
+    parser.add_argument('--redock', type=int, default=None, help='cycles per pickup for the hybrid schedule')
+    parser.add_argument('--no-z', action='store_true', help='do not probe Z offsets with the knob sensor')
+    parser.add_argument('--no-apply', action='store_true', help='report the offsets without applying them (G10)')
+    parser.add_argument('--workers', type=int, default=None, help='detection worker processes, 0 detects in the main process (default: from the settings file)')
+    parser.add_argument('--checkpoint', default=CalibrationCheckpoint.defaultPath, help='checkpoint file')
+    parser.add_argument('--resume', action='store_true', help='resume the run in the checkpoint file')
+    parser.add_argument('--output', default='-', help='results file (default: standard output)')
+    parser.add_argument('--verbose', action='store_true', help='log debug messages')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(levelname)-9s: %(message)s', stream=sys.stderr)
+
+    options = UserSettings.loadSettings(args.settings)
+    printerSettings = (options.get('printer') or [{}])[0]
+    cameraSettings = (options.get('camera') or [{}])[0]
+    url = args.printer or printerSettings.get('address', 'http://localhost')
+    src = UserSettings.cameraSource(args.camera if args.camera is not None else cameraSettings.get('video_src', 0))
+    width = args.width or int(cameraSettings.get('display_width', 640))
+    height = args.height or int(cameraSettings.get('display_height', 480))
+    workers = args.workers if args.workers is not None else int(cameraSettings.get('detect_processes', 0))
+    schedule = printerSettings.get('schedule', {})
+    strategy = args.schedule or schedule.get('strategy', 'interleaved')
+    redock = args.redock or int(schedule.get('redock', 2))
+    adaptive = CalibrationSchedule.loadAdaptive(options)
+    if adaptive is None and (args.adaptive or args.target is not None or args.min_cycles is not None):
+        adaptive = dict(CalibrationSchedule.EarlyStopping.defaults)
+    if adaptive is not None:
+        if args.target is not None:
+            adaptive['target'] = args.target
+        if args.min_cycles is not None:
+            adaptive['minCycles'] = args.min_cycles
+
+    printer = DWA.DuetWebAPI(url)
+    if not printer.printerType():
+        logger.error('Device at ' + url + ' either did not respond or is not a Duet V2 or V3 printer.')
+        return(2)
+    frames = openCamera(options, src, width, height, args.settings)
+    frames.start()
+    engine = CalibrationEngine(printer, frames, width, height, detection=AutoTune.loadDetection(options),
+        motion=MotionPlanner.loadPlanner(options), costs=CalibrationSchedule.loadCosts(options), settingsPath=args.settings, workers=workers)
+    checkpoint = None
+    try:
+        tools = args.tools if args.tools is not None else printer.getNumTools()
+        if args.resume:
+            checkpoint = CalibrationCheckpoint.loadCheckpoint(args.checkpoint)
+            if checkpoint is None or checkpoint.printer != url or checkpoint.tools != tools:
+                logger.error('No run of ' + str(tools) + ' tools on ' + url + ' to resume in ' + args.checkpoint)
+                return(2)
+            logger.info('Resuming at step ' + str(checkpoint.position + 1) + ' of ' + str(len(checkpoint.steps)))
+            engine.cp = dict(checkpoint.cp)
+            engine.motion.travel(printer, engine.cp, tools=['T-1'])
+            engine.waitIdle()
+        else:
+            if args.cp is not None:
+                engine.cp = dict(zip('XYZ', args.cp))
+                engine.motion.travel(printer, engine.cp, tools=['T-1'])
+                engine.waitIdle()
+            else:
+                engine.captureCP(auto=args.auto_cp)
+            steps = CalibrationSchedule.schedule(tools, args.cycles, strategy, redock)
+            for line in engine.costs.report(tools, args.cycles, redock):
+                logger.info(line)
+            if adaptive is not None:
+                logger.info('Adaptive cycles: {0} to {1} per tool, until the offsets are known to +/-{2}mm'.format(
+                    min(adaptive['minCycles'], args.cycles), args.cycles, adaptive['target']))
+            checkpoint = CalibrationCheckpoint.Checkpoint(url, engine.cp, tools, args.cycles, steps, strategy, redock, path=args.checkpoint, adaptive=adaptive)
+        if not args.no_z:
+            engine.probeReference()
+        results = engine.calibrate(checkpoint, apply=not args.no_apply)
+        CalibrationSchedule.saveCosts(engine.costs, args.settings)
+        checkpoint.clear()
+    except Exception as e1:
+        logger.error('Calibration failed: ' + str(e1))
+        if checkpoint is not None and checkpoint.position > 0:
+            logger.info('Progress is saved in ' + args.checkpoint + ', run again with --resume to continue.')
+        return(1)
+    finally:
+        engine.release()
+        frames.release()
+    output = {
+        'printer': url,
+        'datetime': datetime.datetime.now().isoformat(),
+        'cp': engine.cp,
+        'camera': { 'src': src, 'width': width, 'height': height, 'mpp': engine.mpp, 'transform': engine.transform.tolist(), 'residual': engine.residual },
+        'applied': not args.no_apply,
+        'adaptive': checkpoint.adaptive,
+        'offsets': { 'T' + str(tool): offsets for (tool, offsets) in sorted(checkpoint.offsets.items()) },
+        'results': results
+    }
+    if args.output == '-':
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as outputfile:
+            json.dump(output, outputfile, indent=2)
+        logger.info('Results written to ' + args.output)
+    return(0)
+
+if __name__ == '__main__':
+    sys.exit(main())
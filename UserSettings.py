@@ -0,0 +1,75 @@
+# Python Script containing the settings file access used by TAMV.
+#
+# settings.json holds a list of camera profiles and a list of printer profiles.
+# Several modules store their own keys in a profile (capture mode, camera
+# calibrations, tuned detection settings, run costs) and must keep everything
+# else in the file, so they all go through updateSettings:
+#   UserSettings.updateSettings(lambda options: UserSettings.profile(options, 'camera').update(key=value))
+# A missing file or profile is created, and the file is replaced atomically
+# (written to a temporary file first), so a crash while writing leaves the
+# previous settings.
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3
+
+# create logger
+import logging
+logger = logging.getLogger('TAMV.UserSettings')
+
+import json
+import os
+
+defaultPath = 'settings.json'
+
+def loadSettings(path=defaultPath):
+    # Contents of the settings file, one empty camera and printer profile if there is none
+    try:
+        with open(path, 'r') as inputfile:
+            return(json.load(inputfile))
+    except FileNotFoundError:
+        return({ 'camera': [{}], 'printer': [{}] })
+
+def profile(options, section, index=0):
+    # Profile index of a section ('camera' or 'printer'), created empty when missing
+    profiles = options.get(section)
+    if not isinstance(profiles, list):
+        profiles = options[section] = []
+    while len(profiles) <= index:
+        profiles.append({})
+    return(profiles[index])
+
+def updateSettings(update, path=defaultPath):
+    # Read the settings file, let update(options) change it and write it back.
+    # Returns True once saved; errors are logged and return False.
+    temporary = path + '.tmp'
+    try:
+        options = loadSettings(path)
+        update(options)
+        with open(temporary, 'w') as outputfile:
+            json.dump(options, outputfile)
+        os.replace(temporary, path)
+        return(True)
+    except Exception as e1:
+        logger.warning('Cannot save the settings file ' + str(path) + ': ' + str(e1))
+        return(False)
+
+def cameraSource(src):
+    # video_src setting as opened by OpenCV: a camera index, or a device or
+    # replay path (see FrameSource.openFrameSource)
+    if isinstance(src, str) and src.strip().isdigit():
+        return(int(src))
+    return(src)
+
+def saveProfile(camera=None, printer=None, path=defaultPath, index=0):
+    # Store values with the camera and printer profiles, returns True once saved.
+    # video_src is stored as given: a camera index or a path.
+    def update(options):
+        if camera is not None:
+            values = dict(camera)
+            if 'video_src' in values:
+                values['video_src'] = cameraSource(values['video_src'])
+            profile(options, 'camera', index).update(values)
+        if printer is not None:
+            profile(options, 'printer', index).update(printer)
+    return(updateSettings(update, path))
@@ -0,0 +1,64 @@
+# Python Script containing tests for the calibration run checkpoint in CalibrationCheckpoint.
+#
+# Run with: python -m pytest test_CalibrationCheckpoint.py
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3.6 or later, numpy and pytest
+import os
+
+import numpy as np
+
+import CalibrationCheckpoint
+import CalibrationSchedule
+
+cp = { 'X': 100.0, 'Y': 100.0, 'Z': 20.0 }
+
+def _checkpoint(tmp_path, tools=3, cycles=2, strategy='hybrid', adaptive=None):
+    steps = CalibrationSchedule.schedule(tools, cycles, strategy, 2)
+    return(CalibrationCheckpoint.Checkpoint('http://printer', cp, tools, cycles, steps, strategy, 2,
+        path=str(tmp_path / 'checkpoint.json'), adaptive=adaptive))
+
+def _finish(checkpoint, x=0.1, y=-0.2, z=-1.0):
+    tool = checkpoint.remaining[0][0]
+    result = { 'tool': str(tool), 'cycle': str(checkpoint.remaining[0][1]), 'X': str(x), 'Y': str(y), 'Z': str(z) }
+    checkpoint.finishStep(result, { 'X': x, 'Y': y, 'Z': z }, [-1.0, -1.1, -1.2])
+
+def test_roundTrip(tmp_path):
+    checkpoint = _checkpoint(tmp_path, adaptive={ 'target': 0.01, 'minCycles': 2 })
+    transform = np.arange(12, dtype=float).reshape(6, 2)
+    checkpoint.setCalibration(transform, 0.01, residual=0.001, information=np.eye(2))
+    _finish(checkpoint)
+    checkpoint.skipStep()
+    _finish(checkpoint, x=0.3)
+    assert not os.path.exists(checkpoint.path + '.tmp')
+    loaded = CalibrationCheckpoint.loadCheckpoint(checkpoint.path)
+    record = loaded.record()
+    assert record == dict(checkpoint.record(), time=record['time'])
+    assert loaded.steps == checkpoint.steps
+    assert loaded.position == 3
+    assert loaded.offsets == { 0: { 'X': 0.1, 'Y': -0.2, 'Z': -1.0 }, 1: { 'X': 0.3, 'Y': -0.2, 'Z': -1.0 } }
+    assert loaded.calibration['transform'] == transform.tolist()
+    assert loaded.adaptive == { 'target': 0.01, 'minCycles': 2 }
+    assert CalibrationCheckpoint.resumable(loaded, 'http://printer', cp, 3)
+    assert not CalibrationCheckpoint.resumable(loaded, 'http://printer', dict(cp, X=101.0), 3)
+
+def test_completeNotLoaded(tmp_path):
+    checkpoint = _checkpoint(tmp_path, tools=1, cycles=1)
+    _finish(checkpoint)
+    assert checkpoint.complete
+    assert CalibrationCheckpoint.loadCheckpoint(checkpoint.path) is None
+    checkpoint.clear()
+    assert not os.path.exists(checkpoint.path)
+
+def test_dropToolKeepsPickups(tmp_path):
+    checkpoint = _checkpoint(tmp_path, tools=3, cycles=4, strategy='hybrid')
+    _finish(checkpoint)
+    others = [ step for step in checkpoint.remaining if step[0] != 1 ]
+    assert checkpoint.dropTool(1) == 4
+    # the steps of the other tools are left as they were, pickups included
+    assert checkpoint.remaining == others
+    assert [ step for step in checkpoint.remaining if step[2] ] == [ step for step in others if step[2] ]
+    # the current step is never dropped
+    assert checkpoint.dropTool(checkpoint.remaining[0][0]) == 2
+    assert checkpoint.remaining[0] == others[0]
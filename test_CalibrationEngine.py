@@ -0,0 +1,221 @@
+# Python Script containing tests for the calibration run state machine in CalibrationEngine.
+#
+# The runs use a simulated printer (tool offsets and a nozzle position error per
+# tool) and a camera drawing the nozzle where the printer put it, see
+# NozzleDetection.syntheticFrame.
+#
+# Run with: python -m pytest test_CalibrationEngine.py
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3.6 or later, numpy, OpenCV and pytest
+import re
+import time
+
+import numpy as np
+import pytest
+
+import CalibrationCheckpoint
+import CalibrationSchedule
+import NozzleDetection
+from CalibrationEngine import CalibrationEngine, CalibrationStopped, EngineListener
+
+# nozzle position error of each tool (mm), what the calibration finds
+errors = { 0: (0.3, -0.2), 1: (-0.15, 0.4) }
+cp = { 'X': 100.0, 'Y': 100.0, 'Z': 20.0 }
+
+class _Tool:
+    def __init__(self, offsets):
+        self.offsets = offsets
+
+    def offset(self, axis):
+        return(self.offsets[axis])
+
+class _Snapshot:
+    def __init__(self, tools):
+        self.tools = tools
+
+class _FakePrinter:
+    # the G-code the engine sends: G90/G91, G1 moves, G10 offsets and tool changes
+    def __init__(self, errors):
+        self.errors = errors
+        self.position = { 'X': 95.0, 'Y': 103.0, 'Z': 20.0 }
+        self.offsets = { tool: { 'X': 0.0, 'Y': 0.0, 'Z': -1.0 } for tool in errors }
+        self.relative = False
+        self.tool = -1
+        self.motionSeq = 0
+
+    def gCode(self, command):
+        for line in command.split('\n'):
+            self.motionSeq += 1
+            # a command and its parameter words, several commands per line
+            for (code, words) in re.findall(r'([GMT]-?\d+)((?:\s+[A-FH-LN-SU-Z]-?[\d.]+)*)', line):
+                values = { word[0]: float(word[1:]) for word in words.split() }
+                if code == 'G90':
+                    self.relative = False
+                elif code == 'G91':
+                    self.relative = True
+                elif code == 'G1':
+                    for axis in 'XYZ':
+                        if axis in values:
+                            self.position[axis] = (self.position[axis] if self.relative else 0) + values[axis]
+                elif code == 'G10':
+                    self.offsets[int(values['P'])].update({ axis: values[axis] for axis in 'XYZ' if axis in values })
+                elif code.startswith('T'):
+                    self.tool = int(code[1:])
+        return(0)
+
+    def nozzle(self):
+        # nozzle XY: the head is at the position less the tool offset
+        if self.tool < 0:
+            return(self.position['X'], self.position['Y'])
+        (dx, dy) = self.errors[self.tool]
+        return(self.position['X'] - self.offsets[self.tool]['X'] + dx, self.position['Y'] - self.offsets[self.tool]['Y'] + dy)
+
+    def getStatus(self):
+        return('idle')
+
+    def getCoords(self):
+        return(dict(self.position))
+
+    def getCachedCoords(self):
+        return(dict(self.position))
+
+    def getG10ToolOffset(self, tool):
+        return(dict(self.offsets[tool]))
+
+    def getMachineSnapshot(self):
+        return(_Snapshot([ _Tool(self.offsets[tool]) for tool in sorted(self.offsets) ]))
+
+    def getProbes(self):
+        raise ValueError('no probes')
+
+class _FakeCamera:
+    # frame source (see FrameSource) of a camera looking up at cp
+    def __init__(self, printer, width=640, height=480, mpp=0.01, angle=0.05):
+        self.printer = printer
+        self.width = width
+        self.height = height
+        self.mpp = mpp
+        self.angle = angle
+        self.src = 'fake'
+        self.rawLuma = False
+        self.shape = (height, width, 3)
+        self.sequence = 0
+
+    def _frame(self):
+        (x, y) = self.printer.nozzle()
+        (dx, dy) = ((x - cp['X']) / self.mpp, (y - cp['Y']) / self.mpp)
+        (c, s) = (np.cos(self.angle), np.sin(self.angle))
+        self.sequence += 1
+        return(NozzleDetection.syntheticFrame(self.width, self.height, radius=20,
+            center=(self.width/2 + c*dx - s*dy, self.height/2 + s*dx + c*dy), seed=self.sequence))
+
+    def wait(self, afterSeq=0, timeout=1.0, out=None, luma=False):
+        frame = self._frame()
+        if out is not None:
+            out[...] = frame
+            frame = out
+        return(self.sequence, time.monotonic(), frame)
+
+    def waitAfter(self, after, timeout=2.0, out=None, luma=False):
+        return(self.wait(out=out))
+
+    def latest(self, out=None, luma=False):
+        return(self.wait(out=out))
+
+class _Listener(EngineListener):
+    def __init__(self):
+        self.states = []
+        self.results = []
+        self.reports = []
+
+    def state(self, state):
+        self.states.append(state)
+
+    def report(self, text):
+        self.reports.append(text)
+
+    def result(self, result):
+        self.results.append(result)
+
+def _run(tmp_path, cycles=1, strategy='interleaved', listener=None, printer=None):
+    printer = printer if printer is not None else _FakePrinter(errors)
+    listener = listener if listener is not None else _Listener()
+    engine = CalibrationEngine(printer, _FakeCamera(printer), 640, 480, listener=listener,
+        settingsPath=str(tmp_path / 'settings.json'), poll=0)
+    engine.cp = dict(cp)
+    steps = CalibrationSchedule.schedule(len(errors), cycles, strategy, 2)
+    checkpoint = CalibrationCheckpoint.Checkpoint('http://printer', cp, len(errors), cycles, steps, strategy,
+        path=str(tmp_path / 'checkpoint.json'))
+    return(engine, checkpoint, printer, listener)
+
+def _assertOffsets(printer, tools=errors):
+    for tool in tools:
+        assert printer.offsets[tool]['X'] == pytest.approx(errors[tool][0], abs=0.005)
+        assert printer.offsets[tool]['Y'] == pytest.approx(errors[tool][1], abs=0.005)
+
+def test_stateOrder(tmp_path):
+    (engine, checkpoint, printer, listener) = _run(tmp_path)
+    results = engine.calibrate(checkpoint)
+    # the camera is calibrated on the first tool, the second one only aligns
+    assert listener.states == ['toolchange', 'travel', 'align', 'camera', 'align', 'apply',
+        'toolchange', 'travel', 'align', 'apply', 'park', 'done']
+    assert [ (r['tool'], r['cycle']) for r in results ] == [('0', '0'), ('1', '0')]
+    assert all(r['converged'] for r in results)
+    _assertOffsets(printer)
+    assert checkpoint.complete
+
+def test_skipStep(tmp_path):
+    (engine, checkpoint, printer, listener) = _run(tmp_path)
+    align = engine.align
+    def notConverged(tool, rep=0):
+        (coords, moves, converged, seconds) = align(tool, rep)
+        return(coords, moves, converged and tool != 1, seconds)
+    engine.align = notConverged
+    results = engine.calibrate(checkpoint)
+    # T1 is skipped: no result, its offsets left as they were
+    assert [ r['tool'] for r in results ] == ['0']
+    assert listener.states[-4:] == ['travel', 'align', 'park', 'done']
+    assert checkpoint.complete
+    assert checkpoint.position == 2
+    assert sorted(checkpoint.offsets) == [0]
+    _assertOffsets(printer, tools=[0])
+    assert printer.offsets[1] == { 'X': 0.0, 'Y': 0.0, 'Z': -1.0 }
+    assert any('did not converge' in text for text in listener.reports)
+
+def test_zProbeFailureKeepsXY(tmp_path):
+    (engine, checkpoint, printer, listener) = _run(tmp_path)
+    # knob sensor found when the run started, but its probe data is gone
+    engine.hasKnob = True
+    engine.endstopPoint = 10.0
+    results = engine.calibrate(checkpoint)
+    assert listener.states.count('zprobe') == 2
+    assert [ r['Z'] for r in results ] == ['-1.0', '-1.0']
+    _assertOffsets(printer)
+    assert all(printer.offsets[tool]['Z'] == -1.0 for tool in errors)
+    assert sum('Z probe failed' in text for text in listener.reports) == 2
+
+def test_resume(tmp_path):
+    class _StopAfterFirst(_Listener):
+        def result(self, result):
+            super().result(result)
+            engine.stop()
+    listener = _StopAfterFirst()
+    (engine, checkpoint, printer, listener) = _run(tmp_path, cycles=2, listener=listener)
+    with pytest.raises(CalibrationStopped):
+        engine.calibrate(checkpoint)
+    assert listener.states[-1] == 'stopped'
+    resumed = CalibrationCheckpoint.loadCheckpoint(str(tmp_path / 'checkpoint.json'))
+    assert resumed is not None
+    assert resumed.position == 1
+    assert len(resumed.remaining) == 3
+    # resumed by a new engine on the same printer, with the stored camera calibration
+    (engine, unused, printer, listener) = _run(tmp_path, cycles=2, printer=printer)
+    results = engine.calibrate(resumed)
+    assert 'camera' not in listener.states
+    assert listener.states[0] == 'toolchange'
+    assert [ (r['tool'], r['cycle']) for r in results ] == [('0', '0'), ('1', '0'), ('0', '1'), ('1', '1')]
+    assert len(listener.results) == 3
+    assert resumed.complete
+    _assertOffsets(printer)
@@ -0,0 +1,60 @@
+# Python Script containing tests for the calibration run scheduler in CalibrationSchedule.
+#
+# Run with: python -m pytest test_CalibrationSchedule.py
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3.6 or later and pytest
+import pytest
+
+import CalibrationSchedule
+
+@pytest.mark.parametrize('strategy, steps', [
+    ('interleaved', [(0,0,True), (1,0,True), (0,1,True), (1,1,True), (0,2,True), (1,2,True)]),
+    ('grouped', [(0,0,True), (0,1,False), (0,2,False), (1,0,True), (1,1,False), (1,2,False)]),
+    ('hybrid', [(0,0,True), (0,1,False), (1,0,True), (1,1,False), (0,2,True), (1,2,True)])
+])
+def test_stepOrder(strategy, steps):
+    assert CalibrationSchedule.schedule(2, 3, strategy, redock=2) == steps
+
+@pytest.mark.parametrize('strategy, changes', [('interleaved', 7), ('grouped', 3), ('hybrid', 5)])
+def test_toolChanges(strategy, changes):
+    assert CalibrationSchedule.toolChanges(CalibrationSchedule.schedule(2, 3, strategy, redock=2)) == changes
+
+def test_unknownStrategy():
+    with pytest.raises(ValueError):
+        CalibrationSchedule.schedule(2, 3, 'random')
+
+def _stopping(xs, **adaptive):
+    stopping = CalibrationSchedule.EarlyStopping(**adaptive)
+    done = []
+    for x in xs:
+        stopping.add(0, x, 0.0)
+        done.append(stopping.done(0))
+    return(stopping, done)
+
+def test_halfWidth():
+    (stopping, done) = _stopping([0.0, 0.01, 0.02], target=0.01, minCycles=2, maxCycles=10)
+    # 95% t quantile for 2 degrees of freedom, standard deviation 0.01
+    assert stopping.halfWidth(0) == pytest.approx(4.303 * 0.01 / 3**0.5)
+    assert stopping.cycles(0) == 3
+    assert done == [False, False, False]
+    assert CalibrationSchedule.EarlyStopping().halfWidth(0) == float('inf')
+
+def test_doneAtMinCycles():
+    # repeatable offsets: done once minCycles are in, not before
+    (stopping, done) = _stopping([0.1] * 5, target=0.01, minCycles=3, maxCycles=10)
+    assert done == [False, False, True, True, True]
+
+def test_doneAtMaxCycles():
+    # offsets spread too wide for the target: done after maxCycles anyway
+    (stopping, done) = _stopping([0.0, 0.1] * 3, target=0.01, minCycles=2, maxCycles=4)
+    assert done == [False, False, False, True, True, True]
+
+@pytest.mark.parametrize('minCycles, maxCycles, clamped', [(0, 10, 2), (1, 10, 2), (5, 3, 3), (3, 0, 1)])
+def test_minCyclesClamped(minCycles, maxCycles, clamped):
+    stopping = CalibrationSchedule.EarlyStopping(target=1.0, minCycles=minCycles, maxCycles=maxCycles)
+    assert stopping.minCycles == clamped
+    assert stopping.maxCycles == max(maxCycles, 1)
+    (stopping, done) = _stopping([0.1] * 4, target=1.0, minCycles=minCycles, maxCycles=maxCycles)
+    assert done.index(True) + 1 == clamped
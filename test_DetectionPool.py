@@ -0,0 +1,77 @@
+# Python Script containing tests for the multi-process nozzle detection in DetectionPool.
+#
+# The worker loop is run in the test process with plain queues, the pool itself
+# only where worker processes are needed.
+#
+# Run with: python -m pytest test_DetectionPool.py
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3.8 or later, OpenCV, numpy and pytest
+import queue
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+import pytest
+
+import DetectionPool
+import NozzleDetection
+
+class _CountingBackend(NozzleDetection.DetectorBackend):
+    name = 'counting'
+
+    def __init__(self, fail=False):
+        self.resets = 0
+        self.fail = fail
+
+    def find(self, image, pipeline):
+        if self.fail:
+            raise ValueError('broken frame')
+        # the number of resets so far as the keypoint size
+        return([ cv2.KeyPoint(10.0, 10.0, float(self.resets)) ])
+
+    def reset(self):
+        self.resets += 1
+
+@pytest.fixture
+def memory():
+    block = shared_memory.SharedMemory(create=True, size=2 * 32 * 32 * 3)
+    yield block
+    block.close()
+    block.unlink()
+
+def _run(memory, monkeypatch, generations, fail=False):
+    backend = _CountingBackend(fail=fail)
+    monkeypatch.setattr(DetectionPool, '_detector',
+        lambda settings: (NozzleDetection.PreprocessPipeline(), backend, None, NozzleDetection.CentroidEstimator()))
+    tasks = queue.Queue()
+    results = queue.Queue()
+    for (seq, generation) in enumerate(generations):
+        tasks.put((memory.name, (2, 32, 32, 3), seq % 2, seq, None, {}, generation))
+    tasks.put(None)
+    DetectionPool._worker(tasks, results)
+    return([ results.get_nowait() for seq in generations ])
+
+def test_resetOnNewGeneration(memory, monkeypatch):
+    detections = _run(memory, monkeypatch, [0, 0, 1, 1, 1, 2])
+    assert [ d.keypoints[0][2] for d in detections ] == [1, 1, 2, 2, 2, 3]
+
+def test_errorRecord(memory, monkeypatch):
+    detections = _run(memory, monkeypatch, [0, 0], fail=True)
+    assert [ d.seq for d in detections ] == [0, 1]
+    assert all('broken frame' in d.error for d in detections)
+
+def test_poolGeneration():
+    pool = DetectionPool.DetectionPool(workers=1, shape=(32, 32, 3), slots=2)
+    try:
+        assert pool.generation == 0
+        pool.reset()
+        assert pool.generation == 1
+        # no slot can be freed: nothing is outstanding
+        pool.acquire()
+        pool.acquire()
+        with pytest.raises(DetectionPool.DetectionError):
+            pool.acquire(timeout=0.1)
+    finally:
+        pool.close()
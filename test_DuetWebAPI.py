@@ -0,0 +1,45 @@
+# Python Script containing tests for the motion tracking of DuetWebAPI (cached coordinates).
+#
+# Run with: python -m pytest test_DuetWebAPI.py
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3.6 or later, requests and pytest
+import pytest
+
+import DuetWebAPI
+
+@pytest.mark.parametrize('command', [
+    'G0 X10', 'G1 X10 Y20 F6000', 'G1 Z-0.2', 'g1 x1', 'G01 Y5', 'G1 F6000 X10', 'M564 S1 G1 X1',
+    'G91 G1 X-0.100 Y0.050 F1000 G90', 'G90\nG1 X100 Y100', 'G1 U10',
+    'G2 X10 Y10 I5', 'G28', 'G28 Z', 'G10 P0 X0.1 Y0.2', 'G30 S-1 K3', 'G31', 'G32', 'G92 Z0', 'G54',
+    'T0', 'T1', 'T-1', 'M98 P"tpre0.g"', 'M121'
+])
+def test_motionCode(command):
+    assert DuetWebAPI._motionCode.search(command) is not None
+
+@pytest.mark.parametrize('command', [
+    'G0', 'G1', 'G1 F6000', 'G1 E5', 'G1 E-2 F300', 'G1 F13200', 'G1 F600 ; X10 in a comment',
+    'G1 F600 G90', 'M400', 'M117 Move X10', 'M564 S1', 'G90', 'G91', 'G4 P100', 'G100 X1', 'M114'
+])
+def test_noMotionCode(command):
+    assert DuetWebAPI._motionCode.search(command) is None
+
+def test_cachedCoords():
+    # an API object without a connection, its position read counted
+    printer = DuetWebAPI.DuetWebAPI.__new__(DuetWebAPI.DuetWebAPI)
+    reads = []
+    def getCoords():
+        reads.append(printer.motionSeq)
+        return({ 'X': 1.0, 'Y': 2.0, 'Z': 3.0 })
+    printer.getCoords = getCoords
+    assert printer.getCachedCoords() == { 'X': 1.0, 'Y': 2.0, 'Z': 3.0 }
+    printer._countMotion('G1 F6000')
+    printer._countMotion('M400')
+    assert printer.getCachedCoords() == { 'X': 1.0, 'Y': 2.0, 'Z': 3.0 }
+    assert len(reads) == 1
+    printer._countMotion('G1 X5')
+    printer.getCachedCoords()
+    printer.invalidatePosition()
+    printer.getCachedCoords()
+    assert len(reads) == 3
@@ -0,0 +1,51 @@
+# Python Script containing tests for the coarse-to-fine nozzle detection in NozzleDetection.
+#
+# Run with: python -m pytest test_NozzleDetection.py
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3.6 or later, numpy, OpenCV and pytest
+import numpy as np
+import pytest
+import NozzleDetection
+
+def _pyramid(pipeline, factor=2):
+    return(NozzleDetection.PyramidDetector(pipeline,
+        lambda minArea, maxArea: NozzleDetection.createBackend('blob', minArea=minArea, maxArea=maxArea),
+        600, maxArea=5000, factor=factor))
+
+class _NoNozzle(NozzleDetection.DetectorBackend):
+    name = 'none'
+
+    def find(self, image, pipeline):
+        return([])
+
+def test_coarseAreaLimitsScaled():
+    pyramid = _pyramid(NozzleDetection.PreprocessPipeline(), factor=2)
+    assert pyramid.fineDetector.detector.minArea == 600
+    assert pyramid.fineDetector.detector.maxArea == 5000
+    assert pyramid.coarseDetector.detector.minArea == pytest.approx(150)
+    assert pyramid.coarseDetector.detector.maxArea == pytest.approx(1250)
+
+@pytest.mark.parametrize('radius', [30, 36])
+def test_largeNozzle(radius):
+    # large nozzle on a high resolution camera: the pyramid finds what the full frame pass finds
+    pipeline = NozzleDetection.PreprocessPipeline(blockSize=75)
+    center = (900.3, 500.7)
+    frame = NozzleDetection.syntheticFrame(1920, 1080, radius=radius, center=center)
+    factor = NozzleDetection.pyramidFactor(1920, 1080, 600)
+    assert factor > 1
+    full = NozzleDetection.createBackend('blob').find(frame, pipeline)
+    keypoints = _pyramid(pipeline, factor=factor).detect(frame)
+    assert len(full) == 1
+    assert len(keypoints) == 1
+    assert np.hypot(keypoints[0].pt[0] - center[0], keypoints[0].pt[1] - center[1]) < 0.5
+    assert np.hypot(keypoints[0].pt[0] - full[0].pt[0], keypoints[0].pt[1] - full[0].pt[1]) < 0.1
+
+def test_unconfirmedCoarseHitDropped():
+    pipeline = NozzleDetection.PreprocessPipeline()
+    frame = NozzleDetection.syntheticFrame(1920, 1080, radius=16)
+    pyramid = _pyramid(pipeline, factor=2)
+    assert len(pyramid.detect(frame)) == 1
+    pyramid.fineDetector = _NoNozzle()
+    assert pyramid.detect(frame) == []
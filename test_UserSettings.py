@@ -0,0 +1,99 @@
+# Python Script containing tests for the settings file access in UserSettings.
+#
+# Run with: python -m pytest test_UserSettings.py
+#
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Requires Python3.6 or later, OpenCV, numpy and pytest
+import json
+import os
+
+import cv2
+
+import AutoTune
+import CalibrationSchedule
+import CameraCalibration
+import FrameSource
+import NozzleDetection
+import UserSettings
+
+def _read(path):
+    with open(path, 'r') as inputfile:
+        return(json.load(inputfile))
+
+def test_missingFileCreated(tmp_path):
+    path = str(tmp_path / 'settings.json')
+    assert UserSettings.updateSettings(lambda options: UserSettings.profile(options, 'camera').update(video_src=1), path)
+    assert _read(path) == { 'camera': [{ 'video_src': 1 }], 'printer': [{}] }
+    assert not os.path.exists(path + '.tmp')
+
+def test_missingProfileCreated(tmp_path):
+    path = str(tmp_path / 'settings.json')
+    with open(path, 'w') as outputfile:
+        json.dump({ 'camera': [], 'printer': [{ 'address': 'http://printer' }] }, outputfile)
+    assert AutoTune.saveDetection(dict(backend='blob', binary=True, th1=1, th2=50, thstep=1, minArea=600, minCircularity=0.8), path, camera=1)
+    options = _read(path)
+    assert options['camera'][0] == {}
+    assert options['camera'][1]['detection']['minArea'] == 600
+    assert options['printer'] == [{ 'address': 'http://printer' }]
+
+def test_saveDetectionWithoutSettingsFile(tmp_path):
+    path = str(tmp_path / 'settings.json')
+    params = dict(backend='ellipse', binary=True, th1=1, th2=50, thstep=1, minArea=400, minCircularity=0.7)
+    assert AutoTune.saveDetection(params, path)
+    assert AutoTune.loadDetection(_read(path)) == params
+
+def test_everythingElseKept(tmp_path):
+    path = str(tmp_path / 'settings.json')
+    with open(path, 'w') as outputfile:
+        json.dump({ 'camera': [{ 'video_src': 0, 'display_width': 640 }], 'printer': [{ 'address': 'http://printer' }], 'other': 1 }, outputfile)
+    mode = { 'fourcc': 'YUYV', 'width': 640, 'height': 480, 'fps': 30, 'measured': 30.0, 'luma': True }
+    assert FrameSource.saveCaptureMode(mode, 0, path)
+    assert CalibrationSchedule.saveCosts(CalibrationSchedule.RunCosts(), path)
+    record = { 'src': 0, 'width': 640, 'height': 480, 'cp': [100, 100, 20], 'time': 1, 'mpp': 0.01, 'transform': [[0, 0]] * 6 }
+    assert CameraCalibration.saveCalibration(record, path)
+    options = _read(path)
+    assert options['other'] == 1
+    assert options['camera'][0]['display_width'] == 640
+    assert options['camera'][0]['capture']['src'] == 0
+    assert options['camera'][0]['calibrations'] == [record]
+    assert options['printer'][0]['address'] == 'http://printer'
+    assert 'costs' in options['printer'][0]
+
+def test_failedUpdateKeepsFile(tmp_path):
+    path = str(tmp_path / 'settings.json')
+    with open(path, 'w') as outputfile:
+        json.dump({ 'camera': [{ 'video_src': 0 }] }, outputfile)
+    def update(options):
+        options['camera'][0]['video_src'] = 2
+        raise ValueError('no')
+    assert not UserSettings.updateSettings(update, path)
+    assert _read(path) == { 'camera': [{ 'video_src': 0 }] }
+
+def test_replaySourceProfile(tmp_path):
+    # the camera profile of a replay directory keeps its path (TAMVZTATP_GUI.saveUserParameters)
+    replay = tmp_path / 'replay'
+    replay.mkdir()
+    cv2.imwrite(str(replay / 'frame0000.png'), NozzleDetection.syntheticFrame(640, 480))
+    path = str(tmp_path / 'settings.json')
+    assert UserSettings.saveProfile(camera={ 'video_src': str(replay), 'display_width': 640, 'display_height': 480 },
+        printer={ 'address': 'http://printer' }, path=path)
+    src = UserSettings.cameraSource(UserSettings.loadSettings(path)['camera'][0]['video_src'])
+    assert src == str(replay)
+    assert FrameSource.ReplaySource.isReplay(src)
+    source = FrameSource.openFrameSource(src, 640, 480)
+    try:
+        assert isinstance(source, FrameSource.ReplaySource)
+        assert source.count == 1
+    finally:
+        source.release()
+    # saved again unchanged: the source is the same, no camera change
+    assert UserSettings.saveProfile(camera={ 'video_src': src }, path=path)
+    assert str(UserSettings.cameraSource(UserSettings.loadSettings(path)['camera'][0]['video_src'])) == str(src)
+
+def test_cameraIndexProfile(tmp_path):
+    path = str(tmp_path / 'settings.json')
+    assert UserSettings.saveProfile(camera={ 'video_src': '2' }, path=path)
+    assert UserSettings.loadSettings(path)['camera'][0]['video_src'] == 2
+    assert UserSettings.cameraSource(0) == 0
+    assert UserSettings.cameraSource('/dev/video0') == '/dev/video0'